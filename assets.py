@@ -0,0 +1,27 @@
+# load the required dependencies
+import json
+import pickle
+from functools import lru_cache
+from pathlib import Path
+
+
+BASE_DIR = Path(__file__).parent
+
+
+# static assets are read from disk once per process and shared by every session and rerun
+# function to load the lottie animation
+@lru_cache(maxsize=None)
+def load_lottiefile(filepath='image/animation.json'):
+    with (BASE_DIR / filepath).open('r') as f:
+        return json.load(f)
+
+# function to load an image as bytes
+@lru_cache(maxsize=None)
+def load_image(filepath='image/BCEAD.png'):
+    return (BASE_DIR / filepath).read_bytes()
+
+# function to load the hashed passwords of the login page
+@lru_cache(maxsize=None)
+def load_hashed_passwords(filepath='hashed_pw.pkl'):
+    with (BASE_DIR / filepath).open('rb') as file:
+        return pickle.load(file)
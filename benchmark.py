@@ -0,0 +1,499 @@
+# load the required dependencies
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import helper
+import storage
+from cache import FigureCache
+
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+################################################################################################################
+# function to build a synthetic Sheet1 dataframe shaped like the invoice records stored in the database
+def make_invoice_frame(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    order_dates = pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 4 * 365, n_rows), unit='D')
+    delivery_dates = order_dates + pd.to_timedelta(rng.integers(1, 15, n_rows), unit='D')
+    invoice_dates = delivery_dates + pd.to_timedelta(rng.integers(0, 5, n_rows), unit='D')
+    order_total = rng.uniform(5, 800, n_rows).round(2)
+    tax = (order_total * 0.09).round(2)
+    return pd.DataFrame({
+        'Invoice_Number': np.arange(10000000, 10000000 + n_rows),
+        'Invoice_Date': invoice_dates.strftime('%d %b %Y'),
+        'Order_Total': [f'S$ {value:.2f}' for value in order_total],
+        'Tax': [f'S$ {value:.2f}' for value in tax],
+        'Invoice_Total': [f'S$ {value:.2f}' for value in order_total + tax],
+        'DO_Number': rng.integers(5000000, 6000000, n_rows),
+        'PO_Number': rng.choice(np.arange(4500000000, 4500000040), n_rows),
+        'Order_Date': order_dates.strftime('%d %b %Y'),
+        'Sale_Order': rng.integers(20000000, 30000000, n_rows),
+        'Delivery_Date': delivery_dates.strftime('%d %b %Y'),
+    })
+
+# function to build synthetic line items for the invoices of make_invoice_frame, items_per_invoice oligos each
+def make_line_item_frame(df_sheet1, items_per_invoice=4, seed=0):
+    rng = np.random.default_rng(seed)
+    n_items = df_sheet1.shape[0] * items_per_invoice
+    # a pool of sequences keeps the frame quick to build, every item still has its own row
+    pool = np.array([''.join(rng.choice(list('ACGT'), length)) for length in rng.integers(18, 60, 1000)], dtype=object)
+    pool[::10] = [f'/5Phos/{sequence}' for sequence in pool[::10]]
+    prices = rng.uniform(5, 80, n_items).round(2)
+    return pd.DataFrame({
+        'Invoice_Number': np.repeat(df_sheet1['Invoice_Number'].to_numpy(), items_per_invoice),
+        'Item': np.tile(np.arange(1, items_per_invoice + 1), df_sheet1.shape[0]),
+        'Name': [f'Oligo-{i:06d}' for i in range(n_items)],
+        'Scale': rng.choice(['25 nmole', '100 nmole', '250 nmole'], n_items),
+        'Sequence': pool[rng.integers(0, len(pool), n_items)],
+        'Quantity': 1,
+        'Unit_Price': [f'S$ {value:.2f}' for value in prices],
+        'Line_Total': [f'S$ {value:.2f}' for value in prices],
+    })
+
+# function to build a synthetic Sheet2 dataframe mapping the POs of make_invoice_frame to their WBS numbers
+def make_po_frame():
+    po_numbers = np.arange(4500000000, 4500000040)
+    return pd.DataFrame({
+        'PO_Number': po_numbers,
+        'WBS_Number': [f'R-{571 + i % 7:03d}-000-{i:03d}-112' for i in range(len(po_numbers))],
+    })
+
+# function to render a synthetic invoice laid out like the IDT invoices read by helper.extract_pdf_data
+# returns the PDF bytes and the record the parser is expected to extract from it
+def make_invoice_pdf(invoice_number, seed=0, n_items=10, lines_per_page=60, page_footer=False):
+    import pymupdf
+    rng = np.random.default_rng(seed)
+    order_date = pd.Timestamp('2021-01-01') + pd.Timedelta(days=int(rng.integers(0, 4 * 365)))
+    ship_date = order_date + pd.Timedelta(days=int(rng.integers(1, 15)))
+    invoice_date = ship_date + pd.Timedelta(days=int(rng.integers(0, 5)))
+    prices = rng.uniform(5, 80, n_items).round(2)
+    order_total = prices.sum().round(2)
+    tax = round(order_total * 0.09, 2)
+    record = {
+        'Invoice_Number': str(invoice_number),
+        'Invoice_Date': invoice_date.strftime('%d %b %Y'),
+        'Order_Total': f'S$ {order_total:.2f}',
+        'Tax': f'S$ {tax:.2f}',
+        'Invoice_Total': f'S$ {order_total + tax:.2f}',
+        'DO_Number': str(rng.integers(5000000, 6000000)),
+        'PO_Number': str(rng.integers(4500000000, 4500000040)),
+        'Order_Date': order_date.strftime('%d %b %Y'),
+        'Sale_Order': str(rng.integers(20000000, 30000000)),
+        'Delivery_Date': ship_date.strftime('%d %b %Y'),
+    }
+    lines = [
+        'Integrated DNA Technologies Pte. Ltd.',
+        'INVOICE',
+        f"Invoice Nbr: {record['Invoice_Number']}",
+        f"Invoice Date: {record['Invoice_Date']}",
+        f"Package Ids: {record['DO_Number']}",
+        # order table: six header cells followed by their six values
+        'P.O. #', 'Order Date', 'Sales Order #', 'Ship Date', 'Terms', 'Ship Via',
+        record['PO_Number'], record['Order_Date'], record['Sale_Order'], record['Delivery_Date'], 'Net 30', 'FedEx',
+        'Item', 'Description', 'Qty', 'Unit Price', 'Amount',
+    ]
+    for item, price in enumerate(prices, start=1):
+        bases = int(rng.integers(18, 60))
+        sequence = ''.join(rng.choice(list('ACGT'), bases))
+        lines += [f'{item}', f'Oligo-{item:04d} 25 nmole DNA Oligo', sequence, '1', f'S$ {price:.2f}', f'S$ {price:.2f}']
+    lines += [f"Order Total: {record['Order_Total']}", f"Tax: {record['Tax']}", f"Invoice Total: {record['Invoice_Total']}"]
+
+    pages = [lines[start:start + lines_per_page] for start in range(0, len(lines), lines_per_page)]
+    if page_footer:
+        # like the printed invoices: a footer on every page and the table header repeated on the next page,
+        # whatever item the page break falls in
+        pages = [(['Item', 'Description', 'Qty', 'Unit Price', 'Amount'] if number > 1 else []) + page +
+                 [f'Page {number} of {len(pages)}'] for number, page in enumerate(pages, start=1)]
+    document = pymupdf.open()
+    for page_lines in pages:
+        page = document.new_page()
+        for row, line in enumerate(page_lines):
+            page.insert_text((50, 40 + row * 12), line, fontsize=9)
+    pdf_bytes = document.tobytes()
+    document.close()
+    return pdf_bytes, record
+
+# the element-wise clean_df shipped before the schema-driven version, kept as the benchmark reference
+def legacy_clean_df(df):
+    month_mapping = {1:'Jan', 2:'Feb', 3: 'Mar', 4: 'Apr', 5: 'May', 6: 'Jun', 7: 'Jul', 8: 'Aug', 9: 'Sep', 10: 'Oct', 11: 'Nov', 12: 'Dec'}
+    df_deduped = df.drop_duplicates(subset=['Invoice_Number'])
+    df_deduped['Invoice_Date'] = df_deduped['Invoice_Date'].apply(lambda x: pd.to_datetime(x, format='%d %b %Y'))
+    df_deduped['Order_Date'] = df_deduped['Order_Date'].apply(lambda x: pd.to_datetime(x, format='%d %b %Y'))
+    df_deduped['Delivery_Date'] = df_deduped['Delivery_Date'].apply(lambda x: pd.to_datetime(x, format='%d %b %Y'))
+    df_deduped['Order_Total'] = df_deduped['Order_Total'].apply(lambda x: float(x.strip('S$ ')))
+    df_deduped['Tax'] = df_deduped['Tax'].apply(lambda x: float(x.strip('S$ ')))
+    df_deduped['PO_Number'] = df_deduped['PO_Number'].astype(str)
+    df_deduped['Delivery_Leadtime'] = (df_deduped['Delivery_Date'] - df_deduped['Order_Date']).dt.days
+    df_deduped['Invoice_Number'] = df_deduped['Invoice_Number'].astype(str)
+    df_deduped['Sale_Order'] = df_deduped['Sale_Order'].astype(str)
+    df_deduped['DO_Number'] = df_deduped['DO_Number'].astype(str)
+    df_deduped['Invoice_Total'] = df_deduped['Invoice_Total'].apply(lambda x: float(x.strip('S$ ')))
+    df_deduped['Invoice_Year'] = df_deduped['Invoice_Date'].dt.year
+    df_deduped['Invoice_Month'] = df_deduped['Invoice_Date'].dt.month
+    df_deduped['Invoice_Month'] = df_deduped['Invoice_Month'].map(month_mapping)
+    return df_deduped
+
+# function to time a callable, returns the best of `repeat` runs in seconds
+def best_time(func, *args, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+################################################################################################################
+
+
+################################################################################################################
+# benchmark --- schema-driven clean_df against the element-wise version
+def bench_clean_df(sizes):
+    print(f"{'rows':>8} {'legacy (s)':>12} {'clean_df (s)':>13} {'speedup':>8}")
+    for n_rows in sizes:
+        frame = make_invoice_frame(n_rows)
+        # the legacy version has no compact dtypes, the values are compared with the columns cast to its dtypes
+        legacy_frame = legacy_clean_df(frame.copy())
+        pd.testing.assert_frame_equal(legacy_frame, helper.clean_df(frame).astype(legacy_frame.dtypes.to_dict()))
+        legacy = best_time(lambda: legacy_clean_df(frame.copy()))
+        current = best_time(lambda: helper.clean_df(frame))
+        print(f'{n_rows:>8} {legacy:>12.4f} {current:>13.4f} {legacy / current:>7.1f}x')
+
+
+################################################################################################################
+# benchmark suite --- times every stage of the pipeline, the results are compared against a stored baseline
+# function to time the extraction, cleaning, metrics and figure building stages
+def run_suite(sizes, n_invoices=50):
+    import tempfile
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+
+    pdf_documents = [make_invoice_pdf(10000000 + i, seed=i)[0] for i in range(n_invoices)]
+    results[f'extract_pdf[{n_invoices}]'] = best_time(lambda: helper.process_pdf_directory(pdf_documents))
+    results['plot_donut'] = best_time(lambda: helper.plot_donut(100.0, 1000.0))
+
+    df_sheet2 = make_po_frame()
+    po_wbs = dict(zip(df_sheet2['PO_Number'], df_sheet2['WBS_Number']))
+    for n_rows in sizes:
+        df_sheet1 = make_invoice_frame(n_rows)
+        cleaned = helper.clean_df(df_sheet1)
+        cube = helper.build_cube(cleaned)
+        po_index = helper.build_po_index(cleaned)
+        figure_cache = FigureCache()
+        figures = [(helper.plot_heatmap, (cube,), ()), (helper.plot_bar, (cube,), ()),
+                   (helper.plot_bar_month, (cube,), (2023,)), (helper.plot_donut, (), (100.0, 1000.0))]
+        stages = {
+            'clean_df': lambda: helper.clean_df(df_sheet1),
+            'build_cube': lambda: helper.build_cube(cleaned),
+            'build_po_index': lambda: helper.build_po_index(cleaned),
+            'sync_dashboard_data': lambda: helper.sync_dashboard_data({}, df_sheet1, 0),
+            'display_key_metrics': lambda: helper.display_key_metrics(2023, cube),
+            'po_lookup': lambda: helper.po_lookup(po_index, po_wbs, df_sheet2['PO_Number'].iloc[0]),
+            'plot_heatmap': lambda: helper.plot_heatmap(cube),
+            'plot_bar': lambda: helper.plot_bar(cube),
+            'plot_bar_month': lambda: helper.plot_bar_month(cube, 2023),
+            # the four figures of a Dashboard rerun once they are in the figure cache
+            'cached_figures': lambda: [figure_cache.figure(n_rows, func, data, args) for func, data, args in figures],
+        }
+        for stage, func in stages.items():
+            results[f'{stage}[{n_rows}]'] = best_time(func)
+
+        # line items, four per invoice, the dashboard metrics are computed on the cleaned columnar table
+        df_items = make_line_item_frame(df_sheet1)
+        items = helper.clean_line_items(df_items)
+        state = helper.sync_dashboard_data({}, df_sheet1, 0)
+        helper.sync_line_item_data(state, lambda start: df_items.iloc[start:], 0)
+        stages = {
+            'clean_line_items': lambda: helper.clean_line_items(df_items),
+            'build_item_cube': lambda: helper.build_item_cube(items, state['periods']),
+            'key_metrics_line_items': lambda: helper.display_key_metrics(2023, cube, state['item_cube']),
+        }
+        for stage, func in stages.items():
+            results[f'{stage}[{len(df_items)}]'] = best_time(func)
+
+        # date-range metrics answered from the prefix sums of the time index, next to the cube scan of a year
+        time_index = state['time_index']
+        stages = {
+            'build_time_index': lambda: helper.build_time_index(state['periods']),
+            'range_key_metrics': lambda: helper.range_key_metrics(time_index, '2023-03-15', '2024-02-10',
+                                                                  state['item_time_index']),
+            'rolling_spend': lambda: helper.rolling_spend(time_index),
+        }
+        for stage, func in stages.items():
+            results[f'{stage}[{n_rows}]'] = best_time(func)
+
+        # queries pushed down to the indexed SQLite database, next to a full read filtered in pandas
+        database = storage.SQLiteBackend(os.path.join(tmp_dir, f'invoices_{n_rows}.sqlite'))
+        database.replace_all(df_sheet1.to_dict('records'), po_wbs)
+        po_number = df_sheet1['PO_Number'].iloc[0]
+        stages = {
+            'sqlite_query_po': lambda: database.query_invoices(po_number=po_number),
+            'sqlite_query_year': lambda: database.query_invoices(year=2023),
+            'full_read_query_po': lambda: storage.StorageBackend.query_invoices(database, po_number=po_number),
+            # rows read by a Dashboard rerun, from the database and from the data cache shared by the sessions
+            'read_invoices': lambda: database.read_invoices(),
+            'cached_invoices': lambda: database.cached_invoices(),
+        }
+        for stage, func in stages.items():
+            results[f'{stage}[{n_rows}]'] = best_time(func)
+    return results
+
+# function to compare a run with the baseline, returns the stages slower than the baseline by more than threshold
+# a stage must also be at least min_seconds slower, millisecond timings are too noisy to compare on ratios alone
+def find_regressions(results, baseline, threshold=0.25, min_seconds=0.01):
+    regressions = {}
+    for stage, seconds in results.items():
+        if stage in baseline and seconds > baseline[stage] * (1 + threshold) and seconds - baseline[stage] > min_seconds:
+            regressions[stage] = (baseline[stage], seconds)
+    return regressions
+
+# function to print the timings of a run next to the baseline
+def print_results(results, baseline):
+    print(f"{'stage':<34} {'baseline (s)':>13} {'current (s)':>12} {'change':>8}")
+    for stage, seconds in results.items():
+        if stage in baseline:
+            change = f'{(seconds / baseline[stage] - 1) * 100:+.0f}%' if baseline[stage] else ''
+            print(f'{stage:<34} {baseline[stage]:>13.4f} {seconds:>12.4f} {change:>8}')
+        else:
+            print(f"{stage:<34} {'-':>13} {seconds:>12.4f}")
+
+
+################################################################################################################
+# memory check --- the extraction of an upload batch must not grow with the number of files
+# function to read the current resident set size in bytes
+def current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * 4096
+
+# child process: hold n_files invoices in memory like the uploader does, then report the RSS growth of the extraction
+# with max_workers > 1 the growth is the one of this process, which sends the files to the pool (the workers parse
+# one file at a time and do not depend on the batch size)
+def _measure_extraction_rss(n_files, max_workers, queue):
+    documents = [memoryview(make_invoice_pdf(10000000 + i, seed=i, n_items=150)[0]) for i in range(n_files)]
+    peak = baseline = current_rss()
+    done = threading.Event()
+    def sample():
+        nonlocal peak
+        while not done.is_set():
+            peak = max(peak, current_rss())
+            time.sleep(0.002)
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    helper.process_pdf_directory(documents, max_workers=max_workers)
+    done.set()
+    sampler.join()
+    queue.put(max(peak, current_rss()) - baseline)
+
+# function to measure the RSS growth of the extraction in a fresh process
+def extraction_rss_growth(n_files, max_workers=1):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_measure_extraction_rss, args=(n_files, max_workers, queue))
+    process.start()
+    growth = queue.get()
+    process.join()
+    return growth
+
+# the growth at the large batch may exceed the small batch by at most `slack` bytes, checked in the current process
+# and with a pool of workers (PDF_WORKERS on the Home page, every core by default)
+def bench_memory(small=10, large=100, slack=16 * 2**20, workers=(1, 4)):
+    ok = True
+    for max_workers in workers:
+        growth_small = extraction_rss_growth(small, max_workers)
+        growth_large = extraction_rss_growth(large, max_workers)
+        print(f'extraction RSS growth, {max_workers} worker(s): {small} files {growth_small / 2**20:.1f} MB, '
+              f'{large} files {growth_large / 2**20:.1f} MB')
+        ok = ok and growth_large <= growth_small + slack
+    return ok
+
+
+
+################################################################################################################
+# dtype check --- the compact dtypes of clean_df must shrink the cleaned frame without changing the dashboard
+# dtypes of the derived columns before they were made compact
+LEGACY_DTYPES = {'Invoice_Month': object, 'PO_Number': object, 'Invoice_Year': 'int64', 'Delivery_Leadtime': 'int64'}
+
+# function to collect every number shown by the dashboard for a cleaned dataframe
+def dashboard_numbers(cleaned):
+    cube = helper.build_cube(cleaned)
+    po_index = helper.build_po_index(cleaned)
+    heatmap = helper.plot_heatmap(cube).data[0]
+    numbers = {
+        'metrics': [helper.display_key_metrics(year, cube)
+                    for year in ['All Years'] + sorted(cube['Invoice_Year'].unique())],
+        # heatmap cells keyed by year and month, the column order of the matrix is not shown
+        'heatmap': sorted(((int(year), str(month)), heatmap.z[i][j])
+                          for i, year in enumerate(heatmap.y) for j, month in enumerate(heatmap.x)),
+        'bar': [(list(map(str, bar.x)), list(bar.y)) for bar in helper.plot_bar(cube).data],
+        'bar_month': [(list(map(str, bar.x)), list(bar.y)) for year in sorted(cube['Invoice_Year'].unique())
+                      for bar in helper.plot_bar_month(cube, year).data],
+        'po': {po: (entry['Orders'], entry['Order_Total'], entry['Invoice_Total']) for po, entry in po_index.items()},
+    }
+    return numbers
+
+# function to compare the footprint of the cleaned frame with and without the compact dtypes
+def bench_dtypes(n_rows=100000):
+    cleaned = helper.clean_df(make_invoice_frame(n_rows))
+    legacy = cleaned.astype(LEGACY_DTYPES)
+    compact_bytes = cleaned.memory_usage(deep=True).sum()
+    legacy_bytes = legacy.memory_usage(deep=True).sum()
+    print(f'cleaned frame, {n_rows} rows: {legacy_bytes / 2**20:.1f} MB before, {compact_bytes / 2**20:.1f} MB compact '
+          f'({(1 - compact_bytes / legacy_bytes) * 100:.0f}% smaller)')
+    for column in LEGACY_DTYPES:
+        print(f'  {column:<18} {legacy[column].memory_usage(deep=True) / 2**20:>6.2f} MB -> '
+              f'{cleaned[column].memory_usage(deep=True) / 2**20:>6.2f} MB')
+    # compared through repr, months without orders are NaN in both and NaN != NaN
+    unchanged = repr(dashboard_numbers(cleaned)) == repr(dashboard_numbers(legacy))
+    print(f"dashboard numbers {'unchanged' if unchanged else 'CHANGED'}")
+    return unchanged and compact_bytes < legacy_bytes
+
+
+
+################################################################################################################
+# function to compare a sequential and a concurrent sync of Sheet1 and Sheet2 against a fake Sheets API
+# latency: seconds added to every request, a first load (full download) and an incremental append are timed
+def bench_sheet_load(latency=0.2, n_rows=5000):
+    import tempfile
+    import replica
+    import sheets
+    tmp_dir = tempfile.mkdtemp()
+    frames = {'Sheet1': make_invoice_frame(n_rows), 'Sheet2': make_po_frame()}
+    print(f'fake Sheets API latency: {latency:.3f} s per request')
+    print(f"{'load':<12} {'sequential (s)':>15} {'concurrent (s)':>15} {'speedup':>8}")
+    timings = {}
+    for mode in ['sequential', 'concurrent']:
+        store = replica.SheetReplica(os.path.join(tmp_dir, f'{mode}.sqlite'))
+        worksheets = {name: sheets.FakeWorksheet([list(frame.columns)] + frame.astype(str).values.tolist(),
+                                                 title=name, latency=latency) for name, frame in frames.items()}
+        def load():
+            if mode == 'sequential':
+                for sheet_name in frames:
+                    store.sync(sheet_name, lambda: worksheets[sheet_name], force=True)
+            else:
+                store.sync_many(list(frames), worksheets.get, force=True)
+        start = time.perf_counter()
+        load()
+        first = time.perf_counter() - start
+        worksheets['Sheet1'].rows.append(list(worksheets['Sheet1'].rows[-1]))
+        start = time.perf_counter()
+        load()
+        timings[mode] = (first, time.perf_counter() - start)
+    for i, name in enumerate(['first load', 'append']):
+        sequential, concurrent = timings['sequential'][i], timings['concurrent'][i]
+        print(f'{name:<12} {sequential:>15.3f} {concurrent:>15.3f} {sequential / concurrent:>7.1f}x')
+    return timings
+
+
+
+################################################################################################################
+# startup check --- first run of each page in a fresh process (cold) and a rerun of the same session (warm)
+# streamlit itself is imported before timing, the server process has it loaded already
+# the login page includes the 0.7 s pause streamlit_authenticator takes before drawing the login form
+STARTUP_BUDGETS = {
+    'streamlit_app.py': (1.0, 0.8),
+    'pages/Home.py': (0.45, 0.05),
+    'pages/Dashboard.py': (1.0, 0.15),
+}
+
+# function to fill a local replica with synthetic Sheet1/Sheet2 data, so the dashboard runs offline
+def seed_replica(path, n_rows=1000):
+    import replica
+    import sheets
+    store = replica.SheetReplica(path)
+    for sheet_name, frame in [('Sheet1', make_invoice_frame(n_rows)), ('Sheet2', make_po_frame())]:
+        worksheet = sheets.FakeWorksheet([list(frame.columns)] + frame.astype(str).values.tolist(), title=sheet_name)
+        store.sync(sheet_name, lambda: worksheet, force=True)
+
+# script timing the cold run and the warm rerun of a page, run in a clean interpreter because this module
+# already imports pandas and would hide the import cost of the pages
+_STARTUP_SCRIPT = '''
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+main_script, page = sys.argv[1:3]
+# pages are opened through the main script so the sidebar page links resolve like in the server
+app = AppTest.from_file(main_script, default_timeout=60)
+if page != 'streamlit_app.py':
+    app.session_state['logged_in'] = True
+    app.switch_page(page)
+timings = []
+for _ in range(2):
+    start = time.perf_counter()
+    app.run()
+    timings.append(time.perf_counter() - start)
+print(json.dumps({'cold': timings[0], 'warm': timings[1], 'errors': [str(e.value) for e in app.exception]}))
+'''
+
+# function to time a page in a fresh process, returns (cold seconds, warm seconds, errors)
+def measure_startup(page, replica_path):
+    import subprocess
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, REPLICA_PATH=replica_path, REPLICA_SYNC_INTERVAL=str(10**9))
+    result = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT, os.path.join(base_dir, 'streamlit_app.py'), page],
+                            cwd=base_dir, env=env, capture_output=True, text=True, check=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings['cold'], timings['warm'], timings['errors']
+
+# function to measure every page against its startup budget
+def bench_startup():
+    import tempfile
+    replica_path = os.path.join(tempfile.mkdtemp(), 'replica.sqlite')
+    seed_replica(replica_path)
+    within_budget = True
+    print(f"{'page':<22} {'cold (s)':>9} {'budget':>7} {'warm (s)':>9} {'budget':>7}")
+    for page, (cold_budget, warm_budget) in STARTUP_BUDGETS.items():
+        cold, warm, errors = measure_startup(page, replica_path)
+        print(f'{page:<22} {cold:>9.3f} {cold_budget:>7.2f} {warm:>9.3f} {warm_budget:>7.2f}')
+        for error in errors:
+            print(f'  error: {error}')
+        within_budget &= cold <= cold_budget and warm <= warm_budget and not errors
+    return within_budget
+
+if __name__ == '__main__':
+    pd.options.mode.chained_assignment = None
+    parser = argparse.ArgumentParser(description='Benchmark the invoice data pipeline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='JSON file holding the baseline timings')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown against the baseline (0.25 = 25%%)')
+    parser.add_argument('--compare-clean-df', action='store_true', help='only compare clean_df with the element-wise version')
+    parser.add_argument('--memory', action='store_true', help='only run the extraction memory check')
+    parser.add_argument('--dtypes', action='store_true', help='only check the footprint of the compact cleaned frame')
+    parser.add_argument('--sheet-load', type=float, metavar='LATENCY',
+                        help='only compare sequential and concurrent worksheet loading, LATENCY seconds per fake request')
+    parser.add_argument('--startup', action='store_true', help='only check the page start-up times against their budget')
+    args = parser.parse_args()
+    if args.memory:
+        sys.exit(0 if bench_memory() else 1)
+    if args.dtypes:
+        sys.exit(0 if bench_dtypes() else 1)
+    if args.sheet_load is not None:
+        bench_sheet_load(args.sheet_load)
+        sys.exit(0)
+    if args.startup:
+        sys.exit(0 if bench_startup() else 1)
+    if args.compare_clean_df:
+        bench_clean_df(args.sizes)
+        sys.exit(0)
+
+    results = run_suite(args.sizes)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'baseline saved to {args.baseline}')
+        sys.exit(0)
+    regressions = find_regressions(results, baseline, args.threshold)
+    for stage, (before, after) in regressions.items():
+        print(f'REGRESSION {stage}: {before:.4f}s -> {after:.4f}s')
+    sys.exit(1 if regressions else 0)
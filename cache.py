@@ -0,0 +1,280 @@
+# load the required dependencies
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import perf
+
+
+DEFAULT_CACHE_PATH = Path(__file__).parent / '.cache' / 'extraction_cache.sqlite'
+# seconds a data cache entry is served before it is loaded again, even when its version did not change
+# (only the SQLite backend, the Sheets replica version changes with every edit of the rows it replicates)
+DATA_CACHE_TTL = float(os.environ.get('DATA_CACHE_TTL', 600))
+
+
+# function to compute the cache key of a PDF: SHA-256 of the raw bytes plus the parser version
+def pdf_digest(pdf_bytes, parser_version):
+    return f'{hashlib.sha256(pdf_bytes).hexdigest()}:{parser_version}'
+
+
+########################################################################################################
+# persistent cache of extracted invoice records, stored in a local SQLite file
+# a file that failed to parse is stored as well, with its error, so it is not parsed again on every rerun
+# entries are evicted least recently used first once max_entries is exceeded, the access time of an entry is only
+# written when it is older than touch_interval seconds, so the reruns serving the same files do not write
+class ExtractionCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=5000, touch_interval=3600):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS extraction (
+                    digest TEXT PRIMARY KEY,
+                    record TEXT NOT NULL,
+                    last_access REAL NOT NULL,
+                    error TEXT
+                )''')
+            # caches created before the failures were stored
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(extraction)')]
+            if 'error' not in columns:
+                self._conn.execute('ALTER TABLE extraction ADD COLUMN error TEXT')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_extraction_access ON extraction (last_access)')
+
+    # function to look up a file, returns None on a miss, otherwise (record, error): the record and None when the
+    # file was parsed, None and the error message when it failed to parse
+    def lookup(self, digest):
+        with self._lock:
+            row = self._conn.execute('SELECT record, error, last_access FROM extraction WHERE digest = ?',
+                                     (digest,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            if now - row[2] >= self.touch_interval:
+                with self._conn:
+                    self._conn.execute('UPDATE extraction SET last_access = ? WHERE digest = ?', (now, digest))
+        record, error, _ = row
+        return (None, error) if error is not None else (json.loads(record), None)
+
+    # function to read the Invoice_Number of a cached record, None when the PDF was not parsed yet
+    # unlike get, the lookup is not counted as a hit or miss and does not decode the record
+    def invoice_number(self, digest):
+        with self._lock:
+            row = self._conn.execute("SELECT json_extract(record, '$.Invoice_Number') FROM extraction WHERE digest = ?",
+                                     (digest,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return str(row[0]).strip() or None
+
+    # function to store a record and evict the least recently used entries above max_entries
+    def put(self, digest, record):
+        self._store(digest, json.dumps(record), None)
+
+    # function to store the error of a file that failed to parse, like put
+    def put_failure(self, digest, error):
+        self._store(digest, 'null', error)
+
+    def _store(self, digest, record, error):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO extraction (digest, record, last_access, error) '
+                               'VALUES (?, ?, ?, ?)', (digest, record, time.time(), error))
+            self._conn.execute('''
+                DELETE FROM extraction WHERE digest IN (
+                    SELECT digest FROM extraction ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )''', (self.max_entries,))
+
+    # function to remove every cached record
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM extraction')
+
+    # function to report the hit/miss counters and the number of cached records
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM extraction').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+########################################################################################################
+
+
+########################################################################################################
+# in-memory cache of the dashboard figures, shared by every session and rerun of the process
+# a figure is keyed by the version of the data it is drawn from, the plotting function and its other arguments,
+# entries of older data versions are dropped as soon as a newer version is seen (e.g. after invoices were pushed)
+# and the least recently used figures are evicted once max_entries is exceeded
+class FigureCache:
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        # seconds the hits did not spend building their figure again
+        self.seconds_saved = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # function to return the figure built by func(*data, *args), it is only built on a miss
+    # version: version of the data, data: the dataframes the figure is drawn from (identified by version),
+    # args: the other arguments of func, they must be hashable (e.g. the selected year)
+    # the figures are shared, they must not be modified by the caller
+    def figure(self, version, func, data=(), args=()):
+        key = (version, func.__name__, tuple(args))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.seconds_saved += entry[1]
+        if entry is not None:
+            perf.count('figure_cache_hits')
+            perf.count('figure_seconds_saved', entry[1])
+            return entry[0]
+
+        start = time.perf_counter()
+        figure = func(*data, *args)
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.misses += 1
+            if version != self.version:
+                self._entries = OrderedDict((k, v) for k, v in self._entries.items() if k[0] == version)
+                self.version = version
+            self._entries[key] = (figure, seconds)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        perf.count('figure_cache_misses')
+        return figure
+
+    # function to remove every cached figure
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # function to report the hit/miss counters, the time saved by the hits and the number of cached figures
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'seconds_saved': self.seconds_saved,
+                    'entries': len(self._entries)}
+########################################################################################################
+
+
+########################################################################################################
+# in-memory cache of the data read from the storage backend (e.g. the invoices and the PO/WBS map),
+# shared by every session and rerun of the process so N sessions cost one read instead of N
+# an entry is keyed by name and served while the version given by the caller is unchanged (e.g. the version of
+# the invoice rows), it is loaded again after invalidate() (e.g. when invoices were pushed) and, unless the caller
+# says its version shows every edit, once it is older than ttl to catch the edits the version does not show
+# concurrent misses of an entry are collapsed into a single load, the other callers wait for its result
+class DataCache:
+    def __init__(self, ttl=DATA_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.loads = 0
+        # misses served by the load of another caller
+        self.waits = 0
+        # name -> {'value', 'version', 'loaded_at', 'expires', 'stale', 'refreshes'}
+        self._entries = {}
+        # name -> load in progress {'version', 'done' (Event), 'value', 'refreshes', 'error'}
+        self._loads = {}
+        # name -> number of invalidations, a load started before an invalidation is not stored
+        self._invalidations = {}
+        self._lock = threading.Lock()
+
+    # function to return the value of an entry, like get_with_refreshes without the number of refreshes
+    def get(self, name, version, load, expires=True):
+        return self.get_with_refreshes(name, version, load, expires)[0]
+
+    # function to return (value, refreshes) of an entry, load() is only called on a miss
+    # version: version of the data, the entry is loaded again when it changes (must support ==)
+    # expires: False when the version changes with every edit of the data, the entry is then never reloaded on ttl
+    # refreshes: number of times the entry was loaded again without its version changing (ttl expiry or
+    # invalidation), taken from the same load as the value, data derived from the entry incrementally has to be
+    # rebuilt when it changes
+    # the values are shared, they must not be modified by the caller
+    def get_with_refreshes(self, name, version, load, expires=True):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and self._valid(entry, version):
+                self.hits += 1
+                perf.count('data_cache_hits')
+                return entry['value'], entry['refreshes']
+            flight = self._loads.get(name)
+            leader = flight is None or flight['version'] != version
+            if leader:
+                flight = {'version': version, 'done': threading.Event(), 'value': None, 'refreshes': 0, 'error': None}
+                self._loads[name] = flight
+                invalidations = self._invalidations.get(name, 0)
+            else:
+                self.waits += 1
+        if not leader:
+            perf.count('data_cache_waits')
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['value'], flight['refreshes']
+
+        try:
+            with perf.span(f'data_cache_load_{name}'):
+                flight['value'] = load()
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                if self._loads.get(name) is flight:
+                    del self._loads[name]
+                if flight['error'] is None:
+                    self.loads += 1
+                    # a reload of the same version means the data changed without its version changing
+                    current = self._entries.get(name)
+                    if current is not None:
+                        flight['refreshes'] = current['refreshes'] + (current['version'] == version)
+                    if self._invalidations.get(name, 0) == invalidations:
+                        self._entries[name] = {'value': flight['value'], 'version': version,
+                                               'loaded_at': time.monotonic(), 'expires': expires, 'stale': False,
+                                               'refreshes': flight['refreshes']}
+            flight['done'].set()
+        perf.count('data_cache_loads')
+        return flight['value'], flight['refreshes']
+
+    def _valid(self, entry, version):
+        return (not entry['stale'] and entry['version'] == version
+                and (not entry['expires'] or time.monotonic() - entry['loaded_at'] < self.ttl))
+
+    # function to mark an entry (every entry when name is None) for reloading on its next use,
+    # the loads in progress are not stored
+    def invalidate(self, name=None):
+        with self._lock:
+            names = list(self._entries) + list(self._loads) if name is None else [name]
+            for key in names:
+                self._invalidations[key] = self._invalidations.get(key, 0) + 1
+                if key in self._entries:
+                    self._entries[key]['stale'] = True
+
+    # function to report the hit, load and wait counters and the number of cached entries
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'loads': self.loads, 'waits': self.waits, 'entries': len(self._entries)}
+########################################################################################################
+
+
+_data_cache = None
+_data_cache_lock = threading.Lock()
+
+# function to return the data cache shared by every page and session of the process
+def get_data_cache():
+    global _data_cache
+    with _data_cache_lock:
+        if _data_cache is None:
+            _data_cache = DataCache()
+        return _data_cache
@@ -1,149 +1,649 @@
-# function to extract and parse the text from the PDF
-def extract_pdf_data(document):
-    import pymupdf
-    import fitz 
-    text = ""
-    
-    # Iterate through all the pages and extract text
+import itertools
+import os
+
+import perf
+import templates
+from lazy import lazy_import
+
+# heavy libraries are only loaded when a helper first needs them
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+go = lazy_import('plotly.graph_objects')
+pcolors = lazy_import('plotly.colors')
+pymupdf = lazy_import('pymupdf')
+
+
+# function to stream the text of a PDF, loading one page at a time
+def iter_page_texts(document):
     for page_num in range(len(document)):
-        page = document.load_page(page_num)
-        text += page.get_text()
-    
-    # Parse the text to extract relevant data
-    data = {}
-    lines = text.split('\n')
-    
-    # Define the keywords to search for and their corresponding field names
-    keywords = {
-        "Invoice Nbr:": "Invoice_Number",
-        "Invoice Date:": "Invoice_Date",
-        "Order Total:": "Order_Total",
-        "Tax:": "Tax",
-        "Invoice Total:": "Invoice_Total",
-        "Package Ids:": "DO_Number",
-        "P.O. #": "PO_Number",
-        "Order Date" : "Order_Date",
-        "Sales Order #": "Sale_Order",
-        "Ship Date": "Delivery_Date"
-    }
-    # Initialize variables to keep track of parsing state
-    key = None
-    
-    for i, line in enumerate(lines):
-        # Remove leading and trailing whitespace from the line
-        line = line.strip()
-        
-        if key:
-            # Assign the value to the corresponding key in the data dictionary
-            data[key] = line
-            key = None
-            continue
+        with perf.span('pdf_text'):
+            page = document.load_page(page_num)
+            text = page.get_text()
+        yield text
 
-        for keyword, field in keywords.items():
-            if keyword in line:
-                # Special handling for "Sales Order #"
-                if keyword == "P.O. #":
-                    # Extract the second line after "Sales Order #"
-                    if i + 6 < len(lines):
-                        data[field] = lines[i + 6].strip()
-                    break
-                elif keyword == "Order Date":
-                    if i + 6 < len(lines):
-                        data[field] = lines[i + 6].strip()
-                    break
-                elif keyword == "Sales Order #":
-                    if i + 6 < len(lines):
-                        data[field] = lines[i + 6].strip()
-                    break
-                elif keyword == "Ship Date":
-                    if i + 6 < len(lines):
-                        data[field] = lines[i + 6].strip()
-                    break
-                
-                # Extract the value directly if it's in the same line
-                value = line.split(keyword)[1].strip()
-                if value:
-                    data[field] = value
-                else:
-                    key = field
-                break
-    
-    # Standardize output based on the order of keywords
-    standardized_data = {field: data.get(field, "") for field in keywords.values()}
-    return standardized_data
+# function to split streamed page texts into lines
+# yields the same lines as joining the text of every page and splitting it on newlines
+def iter_text_lines(texts):
+    partial = ""
+    for text in texts:
+        lines = (partial + text).split('\n')
+        # the last piece may continue on the next page
+        partial = lines.pop()
+        yield from lines
+    yield partial
+
+# function to stream the lines of a PDF, loading one page at a time
+def iter_pdf_lines(document):
+    return iter_text_lines(iter_page_texts(document))
+
+# function to extract and parse the text from the PDF
+# the vendor template is picked from the first page, the document is then read once by that template,
+# pages are loaded lazily and the parsing stops as soon as every field has a value,
+# set early_exit=False to always read the whole document
+@perf.timed('pdf_parse')
+def extract_pdf_data(document, early_exit=True):
+    texts = iter_page_texts(document)
+    first_page = next(texts, '')
+    template = templates.detect_template(first_page)
+    perf.count(f'template_{template.vendor}')
+    return template.parse(iter_text_lines(itertools.chain([first_page], texts)), early_exit=early_exit)
 
 ########################################################################################################
+# field names of the standardized record returned by extract_pdf_data, its line items are listed under 'Line_Items'
+INVOICE_FIELDS = templates.INVOICE_FIELDS
+LINE_ITEM_FIELDS = templates.LINE_ITEM_FIELDS
+# bump whenever the parser output changes, so cached extraction results are not reused
+PARSER_VERSION = '5'
+
+
+# function to build an empty record for an invoice that could not be parsed
+def empty_record():
+    return dict({field: "" for field in INVOICE_FIELDS}, Line_Items=[])
+
+# function to extract the data from the raw bytes of a PDF (also used by the worker processes)
+def extract_pdf_bytes(pdf_bytes):
+    with perf.span('pdf_open'):
+        document = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        return extract_pdf_data(document)
+    finally:
+        document.close()
+
+# function to read the invoice number from the first page only, without parsing the rest of the invoice
+# returns the invoice number found by the template of the page, or None when the page does not have one
+@perf.timed('pdf_peek')
+def peek_invoice_number(pdf_bytes):
+    document = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        if len(document) == 0:
+            return None
+        text = document.load_page(0).get_text()
+    finally:
+        document.close()
+    return templates.detect_template(text).peek(text.split('\n'), 'Invoice_Number')
+
+# function to split the uploaded files into those to parse and those whose invoice is already stored
+# known_invoice_numbers: set of the stored Invoice_Numbers (as stripped strings)
+# cache: optional cache.ExtractionCache, the invoice number of a file already parsed is read from its cached record,
+#        only the other files are opened to read their first page
+# returns (indices of the documents to parse, {index: invoice number} of the documents skipped)
+def screen_known_invoices(documents, known_invoice_numbers, cache=None):
+    from cache import pdf_digest
+    pending, skipped = [], {}
+    for index, document in enumerate(documents):
+        invoice_number = None
+        if known_invoice_numbers and isinstance(document, (bytes, bytearray, memoryview)):
+            if cache is not None:
+                invoice_number = cache.invoice_number(pdf_digest(document, PARSER_VERSION))
+            if invoice_number is None:
+                try:
+                    invoice_number = peek_invoice_number(document)
+                except Exception:
+                    # unreadable files are left to the full parse, which reports the error
+                    invoice_number = None
+        if invoice_number is not None and invoice_number in known_invoice_numbers:
+            skipped[index] = invoice_number
+        else:
+            pending.append(index)
+    perf.count('known_invoices_skipped', len(skipped))
+    return pending, skipped
+
+# function to extract a single document, given either raw PDF bytes or an opened fitz document
+def _extract_document(document):
+    if isinstance(document, (bytes, bytearray, memoryview)):
+        return extract_pdf_bytes(document)
+    return extract_pdf_data(document)
+
+# start method of the worker processes parsing the PDFs: the Streamlit server runs many threads (script runs,
+# push queue, replica syncs), a child forked from it may inherit a lock held by another thread and hang forever,
+# the workers are forked from a single-threaded fork server instead ('spawn' starts them from scratch)
+PDF_POOL_START_METHOD = os.environ.get('PDF_POOL_START_METHOD', 'forkserver')
+
+# function to return the multiprocessing context of the PDF worker pools, the fork server preloads this module
+def pdf_pool_context():
+    import multiprocessing
+    context = multiprocessing.get_context(PDF_POOL_START_METHOD)
+    if PDF_POOL_START_METHOD == 'forkserver':
+        context.set_forkserver_preload([__name__])
+    return context
+
 # function to process all PDF files in a directory
-def process_pdf_directory(documents):
-    import pymupdf
-    import fitz 
-    import os
+# documents: list of raw PDF bytes or memoryviews of them (or opened fitz documents, which are always processed serially and never cached)
+# max_workers: number of worker processes, 1 keeps the extraction in the current process, None uses every core
+# progress_callback: called as progress_callback(completed, total, index, error) after each file,
+#                    error is None on success or the error message of the failed file
+# cache: optional cache.ExtractionCache, files whose bytes were already parsed are not parsed again
+# a file that fails to parse does not abort the batch, it yields an empty record at its position
+@perf.timed('pdf_batch')
+def process_pdf_directory(documents, max_workers=1, progress_callback=None, cache=None):
+    from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+    from cache import pdf_digest
     # List all PDF files in the directory
     # pdf_files = [f for f in os.listdir(directory_path) if f.endswith('.pdf')]
-    
-    all_extracted_data = []
-    
-    for pdf_file in documents:
-        #pdf_path = os.path.join(directory_path, pdf_file)
-        #document = fitz.open(pdf_path)
-        extracted_data = extract_pdf_data(pdf_file)
-        all_extracted_data.append(extracted_data)
-    
+
+    documents = list(documents)
+    total = len(documents)
+    all_extracted_data = [None] * total
+    digests = [None] * total
+    completed = 0
+
+    # function to store the result of one file and report the progress
+    # store: False for the results served from the cache, and for the errors not caused by the file itself
+    def record_result(index, record, error, store=True):
+        nonlocal completed
+        completed += 1
+        if store and cache is not None and digests[index] is not None:
+            if error is None:
+                cache.put(digests[index], record)
+            else:
+                cache.put_failure(digests[index], error)
+        all_extracted_data[index] = record if error is None else empty_record()
+        if progress_callback is not None:
+            progress_callback(completed, total, index, error)
+
+    # serve the files already parsed from the cache, those that failed to parse are reported failed again
+    pending = []
+    for index, doc in enumerate(documents):
+        if cache is not None and isinstance(doc, (bytes, bytearray, memoryview)):
+            digests[index] = pdf_digest(doc, PARSER_VERSION)
+            cached = cache.lookup(digests[index])
+            if cached is not None:
+                perf.count('extraction_cache_hits')
+                record_result(index, *cached, store=False)
+                continue
+        pending.append(index)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(pending))
+    all_bytes = all(isinstance(documents[index], (bytes, bytearray, memoryview)) for index in pending)
+
+    if max_workers <= 1 or not all_bytes:
+        for index in pending:
+            #pdf_path = os.path.join(directory_path, pdf_file)
+            #document = fitz.open(pdf_path)
+            try:
+                record_result(index, _extract_document(documents[index]), None)
+            except Exception as e:
+                record_result(index, None, str(e) or type(e).__name__)
+        return all_extracted_data
+
+    # parse the raw PDF bytes in a pool of worker processes, results are written back by input position
+    # at most 2 * max_workers files are handed to the pool at a time, so the copies sent to the workers stay bounded
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=pdf_pool_context()) as executor:
+        pending = iter(pending)
+        running = {}
+        while True:
+            for index in pending:
+                running[executor.submit(extract_pdf_bytes, bytes(documents[index]))] = index
+                if len(running) >= 2 * max_workers:
+                    break
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = running.pop(future)
+                try:
+                    record_result(index, future.result(), None)
+                except Exception as e:
+                    # a worker that died is not a reason to skip the file next time
+                    record_result(index, None, str(e) or type(e).__name__, store=not isinstance(e, BrokenExecutor))
+
     return all_extracted_data
 ########################################################################################################
 
 
 ########################################################################################################
+# column schema of the invoice table, drives the parsing done by clean_df
+# 'date' columns are parsed with DATE_FORMAT, 'currency' columns hold amounts such as 'S$ 123.45'
+INVOICE_SCHEMA = {
+    'Invoice_Number': 'str',
+    'Invoice_Date': 'date',
+    'Order_Total': 'currency',
+    'Tax': 'currency',
+    'Invoice_Total': 'currency',
+    'DO_Number': 'str',
+    'PO_Number': 'str',
+    'Order_Date': 'date',
+    'Sale_Order': 'str',
+    'Delivery_Date': 'date'
+}
+DATE_FORMAT = templates.DATE_FORMAT
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+# compact dtypes of the derived columns: month and PO_Number are categoricals (one code per row instead of
+# a Python string), year and lead time fit in small integers; the amounts stay float64 so the totals are exact
+YEAR_DTYPE = 'int16'
+LEADTIME_DTYPE = 'int32'
+
+# function to parse amounts such as 'S$ 123.45', NaN where the value is not an amount
+def parse_currency(raw):
+    return pd.to_numeric(raw.astype(str).str.strip('S$ '), errors='coerce').astype(float)
+
+# function to clean the imported dataframe from DB and report the rows that could not be parsed
+# returns (cleaned dataframe, report) where the report lists the Invoice_Number, column and value
+# of every unparseable cell, those rows are left out of the cleaned dataframe
+@perf.timed('clean_df')
+def clean_df_with_report(df):
+    df_deduped = df.drop_duplicates(subset=['Invoice_Number']).copy()
+    invalid = pd.Series(False, index=df_deduped.index)
+    problems = []
+
+    for column, kind in INVOICE_SCHEMA.items():
+        raw = df_deduped[column]
+        if kind == 'date':
+            parsed = pd.to_datetime(raw.astype(str), format=DATE_FORMAT, errors='coerce')
+        elif kind == 'currency':
+            parsed = parse_currency(raw)
+        else:
+            df_deduped[column] = raw.astype(str)
+            continue
+        failed = parsed.isna()
+        if failed.any():
+            invalid |= failed
+            problems.append(pd.DataFrame({'Invoice_Number': df_deduped.loc[failed, 'Invoice_Number'].astype(str),
+                                          'Column': column,
+                                          'Value': raw[failed].astype(str)}))
+        df_deduped[column] = parsed
+
+    cleaned = df_deduped[~invalid].copy()
+    cleaned['Delivery_Leadtime'] = (cleaned['Delivery_Date'] - cleaned['Order_Date']).dt.days.astype(LEADTIME_DTYPE)
+    cleaned['Invoice_Year'] = cleaned['Invoice_Date'].dt.year.astype(YEAR_DTYPE)
+    cleaned['Invoice_Month'] = pd.Categorical.from_codes(cleaned['Invoice_Date'].dt.month.to_numpy() - 1,
+                                                         categories=MONTH_NAMES, ordered=True)
+    cleaned['PO_Number'] = cleaned['PO_Number'].astype('category')
+
+    if problems:
+        report = pd.concat(problems, ignore_index=True)
+    else:
+        report = pd.DataFrame(columns=['Invoice_Number', 'Column', 'Value'])
+    return cleaned, report
+
 # function to clean the imported dataframe from DB
 def clean_df(df):
-    import pandas as pd
-    month_mapping = {1:'Jan', 2:'Feb', 3: 'Mar', 4: 'Apr', 5: 'May', 6: 'Jun', 7: 'Jul', 8: 'Aug', 9: 'Sep', 10: 'Oct', 11: 'Nov', 12: 'Dec'}
-    df_deduped = df.drop_duplicates(subset=['Invoice_Number'])
-    df_deduped['Invoice_Date'] = df_deduped['Invoice_Date'].apply(lambda x: pd.to_datetime(x, format='%d %b %Y'))
-    df_deduped['Order_Date'] = df_deduped['Order_Date'].apply(lambda x: pd.to_datetime(x, format='%d %b %Y'))
-    df_deduped['Delivery_Date'] = df_deduped['Delivery_Date'].apply(lambda x: pd.to_datetime(x, format='%d %b %Y'))
-    df_deduped['Order_Total'] = df_deduped['Order_Total'].apply(lambda x: float(x.strip('S$ ')))
-    df_deduped['Tax'] = df_deduped['Tax'].apply(lambda x: float(x.strip('S$ ')))
-    df_deduped['PO_Number'] = df_deduped['PO_Number'].astype(str)
-    df_deduped['Delivery_Leadtime'] = (df_deduped['Delivery_Date'] - df_deduped['Order_Date']).dt.days
-    df_deduped['Invoice_Number'] = df_deduped['Invoice_Number'].astype(str)
-    df_deduped['Sale_Order'] = df_deduped['Sale_Order'].astype(str)
-    df_deduped['DO_Number'] = df_deduped['DO_Number'].astype(str)
-    df_deduped['Invoice_Total'] = df_deduped['Invoice_Total'].apply(lambda x: float(x.strip('S$ ')))
-    df_deduped['Invoice_Year'] = df_deduped['Invoice_Date'].dt.year
-    df_deduped['Invoice_Month'] = df_deduped['Invoice_Date'].dt.month
-    df_deduped['Invoice_Month'] = df_deduped['Invoice_Month'].map(month_mapping)
-    return df_deduped
+    cleaned, report = clean_df_with_report(df)
+    return cleaned
 #########################################################################################################
 
 
 #########################################################################################################
-# function to extract key metrics
-def display_key_metrics(year, data):
-    import pandas as pd
+# line items, cleaned into a columnar table: Invoice_Number and Scale are categoricals, the sequences are reduced
+# to their number of bases, the amounts are float64, so the metrics are computed on whole arrays
+LINE_ITEM_COLUMNS = ['Invoice_Number', 'Scale', 'Bases', 'Quantity', 'Line_Total']
+ITEM_CUBE_MEASURES = ['Oligos', 'Bases', 'Item_Spend', 'Covered_Order_Total']
+BASES_DTYPE = 'int32'
+# modifications are printed between slashes (e.g. /5Phos/) and are not bases
+SEQUENCE_MODIFICATION = r'/[^/]*/'
+# nucleotides, IUPAC ambiguity codes included, in upper case: lower case letters mark modified bases
+# (e.g. mA for a 2'-O-methyl A)
+SEQUENCE_BASES = 'ACGTUIRYKMSWBDHVN'
+# some items print their length instead of their sequence, e.g. '25' or '25 bases'
+SEQUENCE_LENGTH = r'^\s*(\d+)\s*(?:bases?|nt|mer)?\s*$'
+# the dashboard used to estimate the bases from the amount spent (S$ 0.20 per base), the estimate is kept
+# for the invoices stored without line items
+ESTIMATED_PRICE_PER_BASE = 0.2
+
+# function to count the bases of every sequence on whole arrays: the sequences are joined into one byte buffer,
+# each byte is looked up in a table of the base letters and the matches are summed per sequence
+def count_bases(sequences, read_lower_case=True):
+    is_base = np.zeros(256, dtype=np.uint8)
+    is_base[[ord(letter) for letter in SEQUENCE_BASES]] = 1
+    # one byte per character (the others are replaced by '?', which is not a base), every sequence is followed
+    # by a separator, so each sum covers at least one byte
+    buffer = np.frombuffer(('\n'.join(sequences) + '\n').encode('ascii', 'replace'), dtype=np.uint8)
+    lengths = sequences.str.len().to_numpy()
+    starts = np.cumsum(lengths + 1) - (lengths + 1)
+    bases = pd.Series(np.add.reduceat(is_base[buffer], starts, dtype=np.int64) if len(starts) else [],
+                      index=sequences.index, dtype='int64')
+    # sequences without any upper case base are read in upper case
+    lower_case = (bases == 0) & (lengths > 0)
+    if read_lower_case and lower_case.any():
+        bases[lower_case] = count_bases(sequences[lower_case].str.upper(), read_lower_case=False)
+    return bases
+
+# function to clean the raw line items (LINE_ITEM_FIELDS and their Invoice_Number) into the columnar table
+@perf.timed('clean_line_items')
+def clean_line_items(df):
+    sequences = df['Sequence'].astype(str)
+    # the regular expressions only run on the few sequences holding a modification or a length
+    modified = sequences.str.contains('/', regex=False)
+    if modified.any():
+        sequences = sequences.where(~modified, sequences[modified].str.replace(SEQUENCE_MODIFICATION, '', regex=True))
+    bases = count_bases(sequences)
+    numeric = sequences.str[:1].str.isdigit()
+    if numeric.any():
+        lengths = pd.to_numeric(sequences[numeric].str.extract(SEQUENCE_LENGTH, expand=False), errors='coerce')
+        bases[lengths.dropna().index] = lengths.dropna()
+    return pd.DataFrame({
+        'Invoice_Number': df['Invoice_Number'].astype(str).astype('category'),
+        'Scale': df['Scale'].astype(str).astype('category'),
+        'Bases': bases.astype(BASES_DTYPE),
+        'Quantity': pd.to_numeric(df['Quantity'], errors='coerce').fillna(1).astype(BASES_DTYPE),
+        'Line_Total': parse_currency(df['Line_Total']),
+    }, columns=LINE_ITEM_COLUMNS).reset_index(drop=True)
+
+# function to append cleaned line items to the columnar table, the categoricals are merged
+def _append_line_items(items, new_items):
+    combined = pd.concat([items, new_items], ignore_index=True)
+    for column in ('Invoice_Number', 'Scale'):
+        combined[column] = combined[column].astype('category')
+    return combined
+
+# function to aggregate the line items by invoice month: oligos, bases and amount spent, and the
+# Order_Total of the invoices having line items (the bases of the other invoices are estimated)
+# periods: Invoice_Year, Invoice_Month and Order_Total of the cleaned invoices, indexed by Invoice_Number
+# per_invoice: line_items_per_invoice(items, periods) when the caller already computed it
+@perf.timed('item_cube')
+def build_item_cube(items, periods, per_invoice=None):
+    if per_invoice is None:
+        per_invoice = line_items_per_invoice(items, periods)
+    return per_invoice.groupby(['Invoice_Year', 'Invoice_Month'], as_index=False, observed=True)[ITEM_CUBE_MEASURES].sum()
+
+# function to sum the line items of every invoice, joined with the invoice periods (PERIOD_COLUMNS)
+def line_items_per_invoice(items, periods):
+    items = items.assign(Oligos=items['Quantity'], Bases=items['Bases'] * items['Quantity'],
+                         Item_Spend=items['Line_Total'])
+    per_invoice = items.groupby('Invoice_Number', observed=True)[['Oligos', 'Bases', 'Item_Spend']].sum()
+    # invoices whose dates could not be parsed are left out, like in the invoice cube
+    positions = periods.index.get_indexer(per_invoice.index.astype(str))
+    found = positions >= 0
+    joined = periods.iloc[positions[found]].reset_index(drop=True)
+    joined = joined.rename(columns={'Order_Total': 'Covered_Order_Total'})
+    for column in ['Oligos', 'Bases', 'Item_Spend']:
+        joined[column] = per_invoice[column].to_numpy()[found]
+    return joined
+
+# function to bring the line items of the dashboard up to date, after sync_dashboard_data
+# read_rows: callable returning the raw line items stored from row `start` on (see StorageBackend.read_line_items)
+# generation: like in sync_dashboard_data, only the rows appended since the last call are read and cleaned
+@perf.timed('line_item_sync')
+def sync_line_item_data(state, read_rows, generation):
+    start = state['item_row_count'] if state.get('line_items') is not None and state['item_generation'] == generation else 0
+    if start == 0:
+        state['line_items'] = None
+    new_rows = read_rows(start)
+    if state['line_items'] is None or new_rows.shape[0] >= 1:
+        cleaned = clean_line_items(new_rows)
+        state['line_items'] = cleaned if state['line_items'] is None else _append_line_items(state['line_items'], cleaned)
+    state['item_generation'] = generation
+    state['item_row_count'] = start + new_rows.shape[0]
+    # the item cube depends on the invoices too, it is rebuilt when either of them changed
+    key = (state['generation'], state['row_count'], generation, state['item_row_count'])
+    if state.get('item_cube_key') != key:
+        per_invoice = line_items_per_invoice(state['line_items'], state['periods'])
+        state['item_cube'] = build_item_cube(state['line_items'], state['periods'], per_invoice)
+        state['item_time_index'] = build_time_index(per_invoice, ITEM_CUBE_MEASURES)
+        state['item_cube_key'] = key
+    return state
+
+# function to compute the line item metrics of a year ('All Years' for every year)
+# returns the number of oligos and bases ordered and the amount spent per oligo and per base,
+# None when no invoice of the selection has line items
+def line_item_metrics(year, item_cube):
+    cells = cube_for_year(item_cube, year)
+    return _line_item_metrics({measure: cells[measure].sum() for measure in ITEM_CUBE_MEASURES})
+
+# function to compute the line item metrics of the invoices dated from start to end, like line_item_metrics
+# item_time_index: time index of the line items per invoice (ITEM_CUBE_MEASURES), from sync_line_item_data
+def range_line_item_metrics(item_time_index, start=None, end=None):
+    return _line_item_metrics(time_index_sums(item_time_index, start, end))
+
+def _line_item_metrics(sums):
+    oligos = int(round(sums['Oligos']))
+    if oligos == 0:
+        return None
+    bases = int(round(sums['Bases']))
+    spend = sums['Item_Spend']
+    return {'Oligos': oligos, 'Bases': bases, 'Covered_Order_Total': sums['Covered_Order_Total'],
+            'Spend_per_Oligo': round(spend / oligos, 2), 'Spend_per_Base': round(spend / bases, 3) if bases else 0.0}
+#########################################################################################################
+
+
+#########################################################################################################
+# keys and measures of the aggregate cube answering the dashboard metrics and charts
+CUBE_KEYS = ['Invoice_Year', 'Invoice_Month', 'PO_Number']
+CUBE_MEASURES = ['Orders', 'Order_Total', 'Invoice_Total', 'Delivery_Leadtime']
+
+# function to aggregate the cleaned dataframe into one cell per year, month and PO
+def build_cube(data):
+    cube = data.groupby(CUBE_KEYS, as_index=False, sort=False, observed=True).agg(
+        Orders=('Sale_Order', 'count'),
+        Order_Total=('Order_Total', 'sum'),
+        Invoice_Total=('Invoice_Total', 'sum'),
+        Delivery_Leadtime=('Delivery_Leadtime', 'sum'),
+    )
+    return cube
+
+# function to add newly cleaned invoices to an existing cube
+def update_cube(cube, new_data):
+    if new_data.shape[0] == 0:
+        return cube
+    merged = pd.concat([cube, build_cube(new_data)], ignore_index=True)
+    return merged.groupby(CUBE_KEYS, as_index=False, sort=False, observed=True)[CUBE_MEASURES].sum()
+
+# function to bring the dashboard data (cube, PO index and parse report) up to date with the raw rows of Sheet1
+# state: dict kept between reruns, holding the derived data, the known invoice numbers and the number of rows seen
+# generation: changes whenever rows that were already processed have been edited, everything is then rebuilt,
+#             otherwise only the rows appended since the last call are cleaned and added
+@perf.timed('aggregation')
+def sync_dashboard_data(state, df_sheet1, generation):
+    start = state['row_count'] if state.get('generation') == generation else 0
+    if start == 0:
+        state.update(invoices=set(), cube=None, po_index={}, parse_report=None, periods=None)
+    if state['cube'] is not None and start == df_sheet1.shape[0]:
+        return state
+
+    new_rows = df_sheet1.iloc[start:]
+    invoice_numbers = new_rows['Invoice_Number'].astype(str)
+    # invoices already processed are duplicates, like in clean_df the first occurrence wins
+    new_rows = new_rows[~invoice_numbers.isin(state['invoices']).to_numpy()]
+    state['invoices'].update(invoice_numbers)
+    cleaned, report = clean_df_with_report(new_rows)
+    state['cube'] = build_cube(cleaned) if state['cube'] is None else update_cube(state['cube'], cleaned)
+    update_po_index(state['po_index'], cleaned)
+    periods = cleaned.set_index('Invoice_Number')[PERIOD_COLUMNS]
+    state['periods'] = periods if state['periods'] is None else pd.concat([state['periods'], periods])
+    state['time_index'] = build_time_index(state['periods'])
+    if state['parse_report'] is None:
+        state['parse_report'] = report
+    elif report.shape[0] >= 1:
+        state['parse_report'] = pd.concat([state['parse_report'], report], ignore_index=True)
+    state['generation'] = generation
+    state['row_count'] = df_sheet1.shape[0]
+    return state
+
+# columns of the cleaned invoices kept per Invoice_Number, to place the line items and build the time index
+PERIOD_COLUMNS = ['Invoice_Date', 'Invoice_Year', 'Invoice_Month', 'Order_Total', 'Invoice_Total', 'Delivery_Leadtime']
+
+# function to measure the memory held by the dashboard data in bytes, per part of the state
+def dashboard_memory(state):
+    return {
+        'cube': int(state['cube'].memory_usage(deep=True).sum()),
+        'po_index': sum(int(entry['rows'].memory_usage(deep=True).sum()) for entry in state['po_index'].values()),
+        'parse_report': int(state['parse_report'].memory_usage(deep=True).sum()),
+        'periods': int(state['periods'].memory_usage(deep=True).sum()),
+        'line_items': int(state['line_items'].memory_usage(deep=True).sum()) if state.get('line_items') is not None else 0,
+        'time_index': sum(_time_index_memory(state.get(name)) for name in ('time_index', 'item_time_index')),
+    }
+
+def _time_index_memory(index):
+    if index is None:
+        return 0
+    return int(index['dates'].nbytes + sum(sums.nbytes for sums in index['sums'].values()))
+
+# function to select the cube cells of one year ('All Years' keeps every cell)
+def cube_for_year(cube, year):
     if year == 'All Years':
-        fil_data = data
+        return cube
+    return cube[cube['Invoice_Year'] == year]
+
+# function to list the years holding invoices, in ascending order
+def cube_years(cube):
+    return sorted(int(year) for year in cube.loc[cube['Orders'] > 0, 'Invoice_Year'].unique())
+
+#########################################################################################################
+
+
+#########################################################################################################
+# measures of the invoice time index, 'Orders' counts the invoices
+TIME_INDEX_MEASURES = ['Orders', 'Order_Total', 'Invoice_Total', 'Delivery_Leadtime']
+
+# function to build a time index: the invoice dates in ascending order with the running totals of the measures
+# frame: one row per invoice with an Invoice_Date column, e.g. the periods of sync_dashboard_data
+# sums[measure][k] is the total of the k earliest invoices, so any date range is summed from two binary searches
+def build_time_index(frame, measures=TIME_INDEX_MEASURES):
+    dates = frame['Invoice_Date'].to_numpy(dtype='datetime64[ns]')
+    order = np.argsort(dates, kind='stable')
+    sums = {}
+    for measure in measures:
+        values = np.ones(len(dates)) if measure == 'Orders' else frame[measure].to_numpy(dtype=float)[order]
+        sums[measure] = np.concatenate([[0.0], np.cumsum(values)])
+    return {'dates': dates[order], 'sums': sums}
+
+# function to sum the measures of the invoices dated from start to end (both included, None for no bound)
+def time_index_sums(index, start=None, end=None):
+    dates = index['dates']
+    first = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start).normalize()), 'left')
+    last = len(dates) if end is None else \
+        np.searchsorted(dates, np.datetime64(pd.Timestamp(end).normalize() + pd.Timedelta(days=1)), 'left')
+    last = max(first, last)
+    return {measure: sums[last] - sums[first] for measure, sums in index['sums'].items()}
+
+# function to return the first and last invoice dates of a time index, None when it is empty
+def time_index_bounds(index):
+    if len(index['dates']) == 0:
+        return None
+    return pd.Timestamp(index['dates'][0]).date(), pd.Timestamp(index['dates'][-1]).date()
+
+# function to return the first day of the `months` months ending on `end`, e.g. 2023-07-01 for 12 months to 2024-06-30
+def window_start(end, months=12):
+    return (pd.Timestamp(end).normalize() - pd.DateOffset(months=months) + pd.Timedelta(days=1)).date()
+
+# function to sum the amounts spent over the `months` months ending on `end` (the last invoice date when None)
+def rolling_spend(index, end=None, months=12):
+    if end is None:
+        bounds = time_index_bounds(index)
+        if bounds is None:
+            return {'Order_Total': 0.0, 'Invoice_Total': 0.0}
+        end = bounds[1]
+    sums = time_index_sums(index, window_start(end, months), end)
+    return {'Order_Total': round(sums['Order_Total'], 2), 'Invoice_Total': round(sums['Invoice_Total'], 2)}
+#########################################################################################################
+
+
+#########################################################################################################
+# columns of the invoices listed in the PO analysis section
+PO_TABLE_COLUMNS = ['Invoice_Date', 'Invoice_Number', 'DO_Number', 'Sale_Order', 'Invoice_Total']
+# measures of the time index kept per PO, to compute its burn rate
+PO_TIME_INDEX_MEASURES = ['Orders', 'Order_Total', 'Invoice_Total']
+
+# function to build the index entry of one PO from its invoices
+def _po_entry(rows):
+    rows = rows.sort_values(by='Invoice_Date')
+    return {
+        'rows': rows,
+        'Orders': rows.shape[0],
+        'Order_Total': rows['Order_Total'].sum(),
+        'Invoice_Total': rows['Invoice_Total'].sum(),
+        'Invoice_Number': rows['Invoice_Number'].tolist(),
+        'DO_Number': rows['DO_Number'].tolist(),
+        'Sale_Order': rows['Sale_Order'].tolist(),
+        'time_index': build_time_index(rows, PO_TIME_INDEX_MEASURES),
+    }
+
+# function to compute the burn rate of a PO: the amount spent per month over the `months` months ending on `end`
+# entry: PO index entry from po_lookup, end: the last invoice date of the PO when None
+def po_burn_rate(entry, end=None, months=12):
+    spend = rolling_spend(entry['time_index'], end, months)
+    return round(spend['Invoice_Total'] / months, 2)
+
+# function to add newly cleaned invoices to a PO index, only the entries of the affected POs are rebuilt
+def update_po_index(po_index, new_data):
+    for po_number, group in new_data.groupby('PO_Number', sort=False, observed=True):
+        rows = group[PO_TABLE_COLUMNS + ['Order_Total']]
+        if po_number in po_index:
+            rows = pd.concat([po_index[po_number]['rows'], rows])
+        po_index[po_number] = _po_entry(rows)
+    return po_index
+
+# function to index the cleaned dataframe by PO_Number
+def build_po_index(data):
+    return update_po_index({}, data)
+
+# function to look up a PO, joined with its funding source (WBS_Number) from Sheet2
+# po_wbs: dict mapping the Sheet2 PO_Number to its WBS_Number
+def po_lookup(po_index, po_wbs, po_number):
+    entry = po_index.get(str(po_number))
+    if entry is None:
+        entry = _po_entry(pd.DataFrame(columns=PO_TABLE_COLUMNS + ['Order_Total']))
+    return dict(entry, WBS_Number=po_wbs.get(po_number, ''))
+#########################################################################################################
+
+
+#########################################################################################################
+# function to extract key metrics
+# cube: aggregate cube from build_cube, item_cube: line item cube from build_item_cube
+# the bases are counted from the line items, and estimated from the amount spent for the invoices without them
+@perf.timed('key_metrics')
+def display_key_metrics(year, cube, item_cube=None):
+    fil_data = cube_for_year(cube, year)
+    sums = {measure: fil_data[measure].sum() for measure in CUBE_MEASURES}
+    item_metrics = line_item_metrics(year, item_cube) if item_cube is not None else None
+    return _key_metrics(sums, item_metrics)
+
+# function to extract the key metrics of the invoices dated from start to end (both included), like display_key_metrics
+# time_index: invoice time index from sync_dashboard_data, item_time_index: line item time index from sync_line_item_data
+@perf.timed('key_metrics_range')
+def range_key_metrics(time_index, start=None, end=None, item_time_index=None):
+    sums = time_index_sums(time_index, start, end)
+    item_metrics = range_line_item_metrics(item_time_index, start, end) if item_time_index is not None else None
+    return _key_metrics(sums, item_metrics)
+
+# key metrics list - [total_expenses_notax, total_expenses, total_number_order, average_order, average_lead_time, total_base]
+def _key_metrics(sums, item_metrics):
+    order_total = sums['Order_Total']
+
+    total_expenses_notax = round(order_total, 2)
+    total_expenses = round(sums['Invoice_Total'], 2)
+    total_number_order = int(round(sums['Orders']))
+    # a selection without invoices has no average
+    average_order = round(total_expenses/total_number_order, 2) if total_number_order else 0.0
+    if item_metrics is None:
+        total_base = int(order_total / ESTIMATED_PRICE_PER_BASE)
     else:
-        fil_data = data[data['Invoice_Year'] == year]
-    
-    total_expenses_notax = round(sum(fil_data['Order_Total']),2)
-    total_expenses = round(sum(fil_data['Invoice_Total']),2)
-    total_number_order = fil_data.shape[0]
-    average_order = round(total_expenses/total_number_order, 2)
-    total_base = int(sum(fil_data['Order_Total']) / 0.2)
-    average_lead_time = round((sum(fil_data['Delivery_Leadtime'] / fil_data.shape[0])),2)
-    
+        uncovered = max(order_total - item_metrics['Covered_Order_Total'], 0)
+        total_base = item_metrics['Bases'] + int(uncovered / ESTIMATED_PRICE_PER_BASE)
+    average_lead_time = round(sums['Delivery_Leadtime'] / total_number_order, 2) if total_number_order else 0.0
+
     return [total_expenses_notax, total_expenses, total_number_order, average_order, average_lead_time, total_base]
 #############################################################################################################
 
 
 #############################################################################################################
 # function to plot the heatmap
-def plot_heatmap(data):
-    import pandas as pd
-    import plotly.graph_objects as go
-    # aggregate the data to get total invoice amount per month per year
-    monthly_totals = data.groupby(['Invoice_Year', 'Invoice_Month'])['Invoice_Total'].sum().reset_index()
+@perf.timed('plot_heatmap')
+def plot_heatmap(cube):
+    # aggregate the cube cells to get total invoice amount per month per year
+    monthly_totals = cube.groupby(['Invoice_Year', 'Invoice_Month'], observed=True)['Invoice_Total'].sum().reset_index()
 
     # pivot the data to create a matrix suitable for heatmap
     pivot_table = monthly_totals.pivot(index='Invoice_Year', columns='Invoice_Month', values='Invoice_Total').fillna(0)
@@ -179,13 +679,19 @@ def plot_heatmap(data):
 
 
 ###############################################################################################################
+# function to pick one blue per bar, from light to dark, whatever the number of bars
+# the lightest quarter of the scale is left out, it would hardly show on a white background
+def bar_colors(n):
+    if n <= 1:
+        return pcolors.sample_colorscale(pcolors.sequential.Blues, [1.0]) * n
+    return pcolors.sample_colorscale(pcolors.sequential.Blues, [0.25 + 0.75 * i / (n - 1) for i in range(n)])
+
 # function to plot bar chart (orders by year)
-def plot_bar(data):
-    import pandas as pd
-    import plotly.graph_objects as go
-    colors = ['#d0e1f2','#9cc9e1','#1f6eb3','#08336f']
-    grouped_data = data.groupby('Invoice_Year')
-    agg_data = grouped_data['Sale_Order'].count()
+@perf.timed('plot_bar')
+def plot_bar(cube):
+    grouped_data = cube.groupby('Invoice_Year', observed=True)
+    agg_data = grouped_data['Orders'].sum()
+    colors = bar_colors(len(agg_data))
 
     fig = go.Figure(data=[go.Bar(
         x=agg_data.index,
@@ -213,14 +719,13 @@ def plot_bar(data):
 
 #################################################################################################################
 # function to plot bar chart by month
-def plot_bar_month(data, year):
-    import pandas as pd
-    import plotly.graph_objects as go
+@perf.timed('plot_bar_month')
+def plot_bar_month(cube, year):
     custom_order = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
     #colors = ['#d0e1f2','#9cc9e1','#1f6eb3','#08336f']
-    selected_data = data[data['Invoice_Year']==year]
-    grouped_data = selected_data.groupby('Invoice_Month')
-    agg_data = grouped_data['Sale_Order'].count()
+    selected_data = cube_for_year(cube, year)
+    grouped_data = selected_data.groupby('Invoice_Month', observed=True)
+    agg_data = grouped_data['Orders'].sum()
     agg_data_sorted = agg_data.reindex(custom_order)
 
     fig = go.Figure(data=[go.Bar(
@@ -250,8 +755,8 @@ def plot_bar_month(data, year):
 
 ##################################################################################################################
 # function to plot donut chart
+@perf.timed('plot_donut')
 def plot_donut(po_spending, total_spending):
-    import plotly.graph_objects as go
     fig = go.Figure(data=[go.Pie(labels=['Selected PO', 'Other POs'],
                                 values=[po_spending, total_spending - po_spending],
                                 hole=.5, textfont=dict(size=18))])
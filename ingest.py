@@ -0,0 +1,293 @@
+# load the required dependencies
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import helper
+import storage
+
+
+OUTPUT_FIELDS = ['File'] + helper.INVOICE_FIELDS
+
+
+################################################################################################################
+# function to list the PDF files below a directory, in a stable order
+def find_pdf_files(root):
+    pdf_files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith('.pdf'):
+                pdf_files.append(os.path.join(dirpath, filename))
+    return pdf_files
+
+# function to read the files already ingested by a previous run from the checkpoint file
+def load_checkpoint(path):
+    done = set()
+    if path and os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['status'] in ('ok', 'known'):
+                    done.add(entry['file'])
+    return done
+
+# function to tell whether the invoice of a file is already stored, from its first page
+def is_known_invoice(pdf_bytes, known_invoices):
+    if not known_invoices:
+        return False
+    try:
+        return helper.peek_invoice_number(pdf_bytes) in known_invoices
+    except Exception:
+        return False
+
+# function to extract the invoices as they finish, yields (path, record, error, size in bytes)
+# files whose invoice is in known_invoices are not parsed, they are yielded with record and error set to None
+# at most 2 * max_workers files are held in memory at any time
+def iter_extracted_files(pdf_files, max_workers, known_invoices=None):
+    if max_workers <= 1:
+        for path in pdf_files:
+            with open(path, 'rb') as f:
+                pdf_bytes = f.read()
+            if is_known_invoice(pdf_bytes, known_invoices):
+                yield path, None, None, len(pdf_bytes)
+                continue
+            try:
+                yield path, helper.extract_pdf_bytes(pdf_bytes), None, len(pdf_bytes)
+            except Exception as e:
+                yield path, helper.empty_record(), str(e) or type(e).__name__, len(pdf_bytes)
+        return
+
+    pending_files = iter(pdf_files)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=helper.pdf_pool_context()) as executor:
+        running = {}
+        while True:
+            for path in pending_files:
+                with open(path, 'rb') as f:
+                    pdf_bytes = f.read()
+                if is_known_invoice(pdf_bytes, known_invoices):
+                    yield path, None, None, len(pdf_bytes)
+                    continue
+                running[executor.submit(helper.extract_pdf_bytes, pdf_bytes)] = (path, len(pdf_bytes))
+                if len(running) >= 2 * max_workers:
+                    break
+            if not running:
+                return
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path, size = running.pop(future)
+                try:
+                    yield path, future.result(), None, size
+                except Exception as e:
+                    yield path, helper.empty_record(), str(e) or type(e).__name__, size
+################################################################################################################
+
+
+################################################################################################################
+# writers streaming the records to the output file
+# on_stored: called once the record is safely on disk, the file it came from is then checkpointed
+class CsvRecordWriter:
+    def __init__(self, path):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        # the line items do not fit in the invoice rows, only the JSON lines output keeps them
+        self.writer = csv.DictWriter(self.file, fieldnames=OUTPUT_FIELDS, extrasaction='ignore')
+        if new_file:
+            self.writer.writeheader()
+
+    def write(self, record, on_stored=None):
+        self.writer.writerow(record)
+        self.file.flush()
+        if on_stored is not None:
+            on_stored()
+
+    def close(self):
+        self.file.close()
+
+class JsonlRecordWriter:
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def write(self, record, on_stored=None):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        if on_stored is not None:
+            on_stored()
+
+    def close(self):
+        self.file.close()
+
+# Parquet files cannot be appended to and are only readable once their footer is written, so every batch of
+# batch_size records is written as a complete part file next to the output (out.parquet, out.part1.parquet, ...)
+# a part is written under a temporary name and renamed once complete, its records are reported stored after that
+class ParquetRecordWriter:
+    def __init__(self, path, batch_size=500):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.pq = pq
+        self.schema = pa.schema([(field, pa.string()) for field in OUTPUT_FIELDS])
+        self.path = path
+        self.part = 0
+        self.batch_size = batch_size
+        self.batch = []
+        self.on_stored = []
+
+    # function to return the name of the next part, the parts written by a previous run are kept
+    def _next_path(self):
+        stem, ext = os.path.splitext(self.path)
+        while True:
+            path = self.path if self.part == 0 else f'{stem}.part{self.part}{ext}'
+            self.part += 1
+            if not os.path.exists(path):
+                return path
+
+    def write(self, record, on_stored=None):
+        self.batch.append(record)
+        if on_stored is not None:
+            self.on_stored.append(on_stored)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        path = self._next_path()
+        temporary_path = f'{path}.tmp'
+        self.pq.write_table(self.pa.Table.from_pylist(self.batch, schema=self.schema), temporary_path)
+        os.replace(temporary_path, path)
+        for on_stored in self.on_stored:
+            on_stored()
+        self.batch = []
+        self.on_stored = []
+
+    def close(self):
+        self.flush()
+
+RECORD_WRITERS = {'.csv': CsvRecordWriter, '.jsonl': JsonlRecordWriter, '.parquet': ParquetRecordWriter}
+################################################################################################################
+
+
+################################################################################################################
+# function to ingest a directory tree of invoices, returns the run statistics
+# skip_known: invoices already stored in the database are recognised from their first page and not parsed
+def ingest(root, output=None, checkpoint=None, max_workers=1, push=False, push_batch_size=200, skip_known=False,
+           log=sys.stderr):
+    pdf_files = find_pdf_files(root)
+    done = load_checkpoint(checkpoint)
+    pdf_files = [path for path in pdf_files if os.path.relpath(path, root) not in done]
+
+    writer = None
+    if output:
+        ext = os.path.splitext(output)[1].lower()
+        if ext not in RECORD_WRITERS:
+            raise ValueError(f'unsupported output format {ext}, expected one of {", ".join(RECORD_WRITERS)}')
+        writer = RECORD_WRITERS[ext](output)
+    checkpoint_file = open(checkpoint, 'a') if checkpoint else None
+
+    known_invoices = None
+    if skip_known:
+        backend = storage.get_backend()
+        backend.sync()
+        known_invoices = backend.invoice_numbers()
+
+    stats = {'files': 0, 'failed': 0, 'bytes': 0, 'skipped': len(done), 'known': 0,
+             'inserted': 0, 'duplicates': 0, 'rejected': 0, 'line_items': 0}
+    push_batch = []
+    push_files = []
+    start = time.perf_counter()
+
+    # function to record the outcome of a file in the checkpoint
+    def write_checkpoint(relative_paths, status):
+        if checkpoint_file is not None:
+            for relative_path in relative_paths:
+                checkpoint_file.write(json.dumps({'file': relative_path, 'status': status}) + '\n')
+            checkpoint_file.flush()
+
+    # number of outputs (output file and database) that have not stored the record of a file yet,
+    # the file is checkpointed once all of them stored it
+    unstored = {}
+    def stored(relative_path):
+        unstored[relative_path] -= 1
+        if unstored[relative_path] == 0:
+            del unstored[relative_path]
+            write_checkpoint([relative_path], 'ok')
+
+    # function to write a record to the output file
+    def write_record(record, relative_path):
+        writer.write(dict(record, File=relative_path), on_stored=lambda: stored(relative_path))
+
+    # function to append the batched records to the database, they are written to the output file only once pushed:
+    # when the push fails, neither output has them and a resumed run parses them again without duplicating rows
+    def push_records():
+        result = storage.get_backend().append_invoices(push_batch)
+        for key, count in result.items():
+            stats[key] += count
+        for record, relative_path in zip(push_batch, push_files):
+            if writer is not None:
+                write_record(record, relative_path)
+            stored(relative_path)
+        push_batch.clear()
+        push_files.clear()
+
+    try:
+        for path, record, error, size in iter_extracted_files(pdf_files, max_workers, known_invoices):
+            relative_path = os.path.relpath(path, root)
+            stats['files'] += 1
+            stats['bytes'] += size
+            if record is None and error is None:
+                stats['known'] += 1
+                write_checkpoint([relative_path], 'known')
+            elif error is not None:
+                stats['failed'] += 1
+                print(f'failed: {relative_path}: {error}', file=log)
+                write_checkpoint([relative_path], 'failed')
+            else:
+                unstored[relative_path] = (writer is not None) + push + 1
+                if push:
+                    push_batch.append(record)
+                    push_files.append(relative_path)
+                    if len(push_batch) >= push_batch_size:
+                        push_records()
+                elif writer is not None:
+                    write_record(record, relative_path)
+                stored(relative_path)
+            if stats['files'] % 50 == 0:
+                print(format_stats(stats, time.perf_counter() - start, len(pdf_files)), file=log)
+        if push_batch:
+            push_records()
+    finally:
+        if writer is not None:
+            writer.close()
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+
+    stats['seconds'] = time.perf_counter() - start
+    print(format_stats(stats, stats['seconds'], len(pdf_files)), file=log)
+    return stats
+
+# function to format the throughput of a run
+def format_stats(stats, seconds, total):
+    seconds = max(seconds, 1e-9)
+    return (f"{stats['files']}/{total} files ({stats['failed']} failed, {stats['known']} already stored), "
+            f"{stats['files'] / seconds:.1f} files/s, {stats['bytes'] / seconds / 1e6:.2f} MB/s")
+################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract IDT invoices from a directory tree without the web application')
+    parser.add_argument('directory', help='directory searched recursively for invoice PDFs')
+    parser.add_argument('-o', '--output', help='output file, the format follows the extension (.csv, .jsonl or .parquet)')
+    parser.add_argument('--checkpoint', help='checkpoint file, files listed in it are skipped when the run is resumed')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--push', action='store_true', help='append the new invoices to the database (STORAGE_BACKEND)')
+    parser.add_argument('--skip-known', action='store_true',
+                        help='skip the invoices already stored in the database, recognised from their first page')
+    args = parser.parse_args()
+    if not args.output and not args.push:
+        parser.error('nothing to do, give an --output file and/or --push')
+    ingest(args.directory, args.output, args.checkpoint, args.workers, args.push, skip_known=args.skip_known)
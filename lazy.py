@@ -0,0 +1,31 @@
+# load the required dependencies
+import importlib
+import sys
+
+
+# module imported on first attribute access, so pages and helpers only pay for the heavy libraries
+# (pandas, plotly, pymupdf) once they really use them
+# the proxy is deliberately not registered in sys.modules: Streamlit walks sys.modules on every rerun
+# (inspect.getmodule, file watcher) and would otherwise trigger the import straight away
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self._name!r} ({state})>'
+
+# function to return the module when it is already imported, otherwise a lazy proxy for it
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -1,11 +1,15 @@
 # load the required dependencies
 import streamlit as st
-import pandas as pd
 import helper
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import os
+import datetime
+import threading
 from navigation import make_sidebar
+import perf
+import storage
+import assets
+import tables
+from cache import FigureCache, get_data_cache
 
 
 # Streamlit page configuration
@@ -17,80 +21,93 @@ st.set_page_config(
 )
 
 make_sidebar()
+perf.start_run('Dashboard')
 
 st.subheader(':blue[BCEAD Oligomers Usage Tracker System]', divider='gray')
-st.sidebar.image('image/BCEAD.png')
+st.sidebar.image(assets.load_image('image/BCEAD.png'))
 st.sidebar.subheader(':blue[Welcome to the BCEAD Oligomers Usage Tracker System]', divider='gray')
 st.sidebar.write('''
 This dashboard provides a comprehensive overview of the BCEAD lab's research funding usage on oligomers. 
-You can view expenses by year using the year selection box. 
+You can view expenses by year, or over any range of dates, using the year selection box. 
 Additionally, the PO Analysis section offers detailed insights into each purchase order (PO), 
 including associated invoices, delivery orders (DOs), and sales orders. 
 For your convenience, you can download a summary of this data in CSV format.
 ''')
 
-################################################################################################################
-# function to authenticate and open the Google Sheet
-def authenticate_google_sheets_from_secrets():
-    secrets = st.secrets["gcp_service_account"]
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(secrets, scope)
-    return credentials
-
-# function to open the Google spreadsheet
-def open_sheet(credentials, spreadsheet_name, sheet_name):
-    client = gspread.authorize(credentials)
-    spreadsheet = client.open(spreadsheet_name)
-    sheet = spreadsheet.worksheet(sheet_name)
-    return sheet
-
-# function to convert the Google spreadsheet into pandas dataframe
-def sheet_to_dataframe(sheet):
-    data = sheet.get_all_records()
-    df = pd.DataFrame(data)
-    return df
-
-# function to convert Google Sheet data to a pandas DataFrame
-def sheet_to_dataframe2(sheet, worksheet_name):
-    worksheet = sheet.worksheet(worksheet_name)
-    data = worksheet.get_all_records()
-    df = pd.DataFrame(data)
-    return df
-#################################################################################################################
-
-
-# connect to Google account and get the spreadhseets
-credentials = authenticate_google_sheets_from_secrets()
-spreadsheet_name = 'IDT_Invoice_Record'
-sheet1 = open_sheet(credentials, spreadsheet_name, 'Sheet1')
-sheet2 = open_sheet(credentials, spreadsheet_name, 'Sheet2')
-df_sheet1 = sheet_to_dataframe(sheet1)
-df_sheet2 = sheet_to_dataframe(sheet2)
-
-# data cleaning
-cleaned_df = helper.clean_df(df_sheet1)
-cleaned_df_sorted = cleaned_df.sort_values(by='Invoice_Date')
+# bring the local copy of the database up to date, the Google account is only contacted when a sync is due
+backend = storage.get_backend()
+backend.sync()
+if backend.offline:
+    st.warning('The database is unavailable, showing the data from the last successful sync.')
+# the rows are read once for every session of the process, see cache.DataCache
+df_invoices, invoices_generation = backend.cached_invoices()
+
+# data cleaning, aggregate cube and PO index shared by every session
+# only the invoices appended since the last rerun are cleaned and added to them
+@st.cache_resource
+def get_dashboard_state():
+    return {'lock': threading.Lock(), 'generation': None, 'row_count': 0, 'cube': None}
+
+dashboard_state = get_dashboard_state()
+with dashboard_state['lock']:
+    helper.sync_dashboard_data(dashboard_state, df_invoices, invoices_generation)
+    cube = dashboard_state['cube']
+    time_index = dashboard_state['time_index']
+    po_index = dashboard_state['po_index']
+    parse_report = dashboard_state['parse_report']
+    # line items (one per oligo), only those stored since the last rerun are read and cleaned
+    helper.sync_line_item_data(dashboard_state, backend.read_line_items, backend.line_items_generation())
+    item_cube = dashboard_state['item_cube']
+    item_time_index = dashboard_state['item_time_index']
+    # version of the cube, it changes whenever invoices were added or replaced
+    data_version = (dashboard_state['generation'], dashboard_state['row_count'])
+    # memory report of the shared data, shown in the performance panel
+    if perf.enabled:
+        for part, size in helper.dashboard_memory(dashboard_state).items():
+            perf.gauge(f'memory_{part}_bytes', size)
+if parse_report.shape[0] >= 1:
+    with st.sidebar.expander(f':warning: {parse_report.shape[0]} value(s) could not be parsed'):
+        st.dataframe(parse_report, use_container_width=True)
+
+# figures shared by every session, they are only rebuilt when the data or the selection changed
+@st.cache_resource
+def get_figure_cache():
+    return FigureCache(int(os.environ.get('FIGURE_CACHE_SIZE', 64)))
+
+figure_cache = get_figure_cache()
 
 # PO list with WBS number
-po_list = df_sheet2['PO_Number']
-wbs_list = df_sheet2['WBS_Number']
-po_option = dict(zip(po_list, wbs_list))
+po_option = backend.cached_po_wbs()
 
 
 # divide the body into 3 columns
 col1, col2, col3 = st.columns([1.25, 3, 2.75], gap='large')
 
 #################################################################################################################
-# container 1 --- select year and display key metrics
+# container 1 --- select year (or date range) and display key metrics
 cont1 = col1.container(border=False)
 cont1.markdown('#### :blue[Year]')
-year = cont1.selectbox('Select year:', ['All Years', 2021, 2022, 2023, 2024])
+# the years holding invoices, the date range covers the first to the last invoice
+years = helper.cube_years(cube)
+date_bounds = helper.time_index_bounds(time_index)
+year = cont1.selectbox('Select year:', ['All Years'] + years + (['Date Range'] if date_bounds else []))
+date_range = None
+if year == 'Date Range':
+    picked = cont1.date_input('Select dates:', value=date_bounds, min_value=date_bounds[0], max_value=date_bounds[1])
+    # the range is only applied once both dates are picked
+    date_range = tuple(picked) if isinstance(picked, (tuple, list)) and len(picked) == 2 else date_bounds
 cont1.markdown('### ')
 cont1.markdown('#### :blue[Usage Summary]')
 
 # obtain the key metrics
 # key metrics list - [total_expenses_notax, total_expenses, total_number_order, average_order, average_lead_time, total_base]
-key_metrics = helper.display_key_metrics(year, cleaned_df_sorted)
+if date_range is None:
+    key_metrics = helper.display_key_metrics(year, cube, item_cube)
+    item_metrics = helper.line_item_metrics(year, item_cube)
+else:
+    # answered from the prefix sums of the time index
+    key_metrics = helper.range_key_metrics(time_index, *date_range, item_time_index)
+    item_metrics = helper.range_line_item_metrics(item_time_index, *date_range)
 
 # define a custom css script
 custom_css = """
@@ -158,24 +175,47 @@ cont1.markdown(f"""
     <p style="font-size: 22px; font-weight: bold; margin: 0;">{key_metrics[5]} bases</p>
 </div>
 """, unsafe_allow_html=True)
+if item_metrics is None:
+    cont1.caption('Estimated from the amount spent, the invoices have no line items.')
+else:
+    estimated = ', estimated for the invoices without line items' \
+        if key_metrics[0] - item_metrics['Covered_Order_Total'] >= 0.01 else ''
+    cont1.caption(f"Counted from {item_metrics['Oligos']} oligo(s) ({item_metrics['Bases']} bases){estimated}. "
+                  f"S$ {item_metrics['Spend_per_Oligo']} per oligo, S$ {item_metrics['Spend_per_Base']} per base.")
+
+# spend over the 12 months ending on the last date of the selection
+if date_bounds:
+    if date_range is not None:
+        rolling_end = date_range[1]
+    elif year == 'All Years':
+        rolling_end = date_bounds[1]
+    else:
+        rolling_end = min(date_bounds[1], datetime.date(year, 12, 31))
+    rolling = helper.rolling_spend(time_index, rolling_end)
+    cont1.caption(f"Spent over the 12 months to {rolling_end:%d %b %Y}: S$ {rolling['Order_Total']} "
+                  f"(S$ {rolling['Invoice_Total']} with GST).")
 
 
 
 ##########################################################################################################
 # container 2 --- heatmap and bar chart
 cont2 = col2.container(border=False)
-heatmap = helper.plot_heatmap(cleaned_df)
+heatmap = figure_cache.figure(data_version, helper.plot_heatmap, data=(cube,))
 cont2.markdown('#### :blue[Total Expenses by Month]')
-cont2.plotly_chart(heatmap, theme='streamlit', use_container_width=True)
-
-if year == 'All Years':
-    cont2.markdown('#### :blue[Number of Orders from 2021 to 2024]')
-    bar = helper.plot_bar(cleaned_df_sorted)
-    cont2.plotly_chart(bar, theme='streamlit', use_container_width=True)
+with perf.span('render'):
+    cont2.plotly_chart(heatmap, theme='streamlit', use_container_width=True)
+
+if year in ('All Years', 'Date Range'):
+    year_span = f'from {years[0]} to {years[-1]}' if len(years) > 1 else f"in {years[0] if years else ''}"
+    cont2.markdown(f'#### :blue[Number of Orders {year_span}]')
+    bar = figure_cache.figure(data_version, helper.plot_bar, data=(cube,))
+    with perf.span('render'):
+        cont2.plotly_chart(bar, theme='streamlit', use_container_width=True)
 else:
     cont2.markdown(f'#### :blue[Number of Orders in {year}]')
-    bar = helper.plot_bar_month(cleaned_df_sorted, year)
-    cont2.plotly_chart(bar, theme='streamlit', use_container_width=True)
+    bar = figure_cache.figure(data_version, helper.plot_bar_month, data=(cube,), args=(year,))
+    with perf.span('render'):
+        cont2.plotly_chart(bar, theme='streamlit', use_container_width=True)
 ###########################################################################################################
 
 
@@ -185,25 +225,45 @@ else:
 cont3 = col3.container(border=False)
 cont3.markdown('#### :blue[Analysis for Purchase Order (PO)]')
 user_option = cont3.selectbox('Select a purchase order (PO)', list(po_option.keys()))
-selected_df = cleaned_df_sorted[cleaned_df_sorted['PO_Number'] == str(user_option)]
-selected_df_subset = selected_df[['Invoice_Date','Invoice_Number','DO_Number','Sale_Order','Invoice_Total']]
+if backend.supports_queries:
+    # only the invoices of the selected PO are read, through the PO_Number index of the database
+    selected_po = helper.po_lookup(helper.build_po_index(backend.query_invoices(po_number=user_option)),
+                                   po_option, user_option)
+else:
+    selected_po = helper.po_lookup(po_index, po_option, user_option)
+selected_df_subset = selected_po['rows'][helper.PO_TABLE_COLUMNS]
 
 # display the metric card with the custom class using HTML
 cont3.markdown(f"""
 <div class="custom-metric-card">Funding Source:
-    <p style="font-size: 20px; font-weight: bold; margin: 0;"> {po_option[user_option]}</p>
+    <p style="font-size: 20px; font-weight: bold; margin: 0;"> {selected_po['WBS_Number']}</p>
 </div>
 """, unsafe_allow_html=True)
 
-# display the selected data based on PO
-cont3.dataframe(selected_df_subset, use_container_width=True)
+# display the selected data based on PO, one page at a time
+tables.paginated_dataframe(cont3, selected_df_subset, key='po_invoices')
+tables.export_buttons(cont3, selected_df_subset, key='po_invoices', version=(data_version, user_option),
+                      file_stem=f'PO_{user_option}')
 
 # donut chart
-total_spending  = cleaned_df_sorted['Invoice_Total'].sum()
-po_spending = cleaned_df_sorted[cleaned_df_sorted['PO_Number'] == str(user_option)]['Invoice_Total'].sum()
+total_spending = cube['Invoice_Total'].sum()
+po_spending = selected_po['Invoice_Total']
 cont3.markdown(f'#### :blue[Purchase Order (PO) Value: S$ {po_spending}]')
-donut = helper.plot_donut(po_spending, total_spending)
-cont3.plotly_chart(donut)
+# average monthly spend of the PO over the 12 months to its last invoice, from its own time index
+if selected_po['Orders']:
+    cont3.caption(f"Burn rate: S$ {helper.po_burn_rate(selected_po)} per month over the 12 months to "
+                  f"{selected_po['rows']['Invoice_Date'].max():%d %b %Y}.")
+donut = figure_cache.figure(data_version, helper.plot_donut, args=(po_spending, total_spending))
+with perf.span('render'):
+    cont3.plotly_chart(donut)
 ############################################################################################################
 
+figure_stats = figure_cache.stats()
+st.sidebar.caption(f"Figure cache: {figure_stats['hits']} hits, {figure_stats['misses']} misses, "
+                   f"{figure_stats['seconds_saved']:.2f} s saved, {figure_stats['entries']} figure(s) stored")
+data_stats = get_data_cache().stats()
+st.sidebar.caption(f"Data cache: {data_stats['hits']} hits, {data_stats['loads']} loads, "
+                   f"{data_stats['waits']} shared load(s)")
 
+# performance panel, only shown when PERF_INSTRUMENTATION is set
+perf.render_panel()
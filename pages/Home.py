@@ -1,15 +1,19 @@
 # load the required dependencies
 import streamlit as st
 from streamlit_lottie import st_lottie
-import json
-import pandas as pd
-import pymupdf
-import fitz 
 import helper
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import os
+import time
 from navigation import make_sidebar
+import perf
+from cache import ExtractionCache, DEFAULT_CACHE_PATH
+import storage
+from push_queue import get_push_queue
+import assets
+import tables
+from lazy import lazy_import
+
+pd = lazy_import('pandas')
 
 
 # Streamlit page configuration
@@ -22,52 +26,52 @@ st.set_page_config(
 
 
 make_sidebar()
+perf.start_run('Home')
 
 ################################################################################################################
-# function to load the lottie file
-def load_lottiefile(filepath: str):
-    with open(filepath, 'r') as f:
-        return json.load(f)
-
-# function to authenticate for connecting to the Google spreadsheet    
-def authenticate_google_sheets_from_secrets():
-    secrets = st.secrets["gcp_service_account"]
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(secrets, scope)
-    return credentials
-
-# function to open the Google spreadsheet
-def open_sheet(credentials, spreadsheet_name, sheet_name):
-    client = gspread.authorize(credentials)
-    spreadsheet = client.open(spreadsheet_name)
-    sheet = spreadsheet.worksheet(sheet_name)
-    return sheet
-
-# function to convert the Google spreadsheet into pandas dataframe
-def sheet_to_dataframe(sheet):
-    data = sheet.get_all_records()
-    df = pd.DataFrame(data)
-    return df
-
-# function to convert Google Sheet data to a pandas DataFrame
-def sheet_to_dataframe2(sheet, worksheet_name):
-    worksheet = sheet.worksheet(worksheet_name)
-    data = worksheet.get_all_records()
-    df = pd.DataFrame(data)
-    return df
-
-# function to update Google Sheet with DataFrame
-def update_google_sheet(worksheet, data):
-    # worksheet.clear()
-    worksheet.update([data.columns.values.tolist()] + data.values.tolist())
+# function to open the extraction cache once per process, shared by every session
+@st.cache_resource
+def get_extraction_cache():
+    return ExtractionCache(os.environ.get('EXTRACTION_CACHE_PATH', DEFAULT_CACHE_PATH))
+
+# function to return the Invoice_Numbers stored in the database or waiting to be pushed, only the queued ones
+# when the database cannot be reached (the invoices are then parsed, and duplicates are still left out when pushed)
+def get_known_invoices():
+    backend = storage.get_backend()
+    known = get_push_queue().invoice_numbers()
+    try:
+        backend.sync()
+        return known | backend.invoice_numbers()
+    except Exception:
+        return known
+
+# function to show the invoices waiting to be pushed and the outcome of the last push, refreshed every few seconds
+# while the queue drains in the background
+@st.experimental_fragment(run_every=5)
+def show_push_status():
+    status = get_push_queue().status()
+    if status['dead_letters']:
+        st.error(f"{status['dead_letters']} invoice(s) were refused by the database and are no longer retried, "
+                 f"see python push_queue.py")
+    if status['depth'] == 0 and status['last_flush_at'] is None and status['last_error'] is None:
+        return
+    st.caption(f"Push queue: {status['depth']} invoice(s) waiting")
+    if status['last_error'] is not None:
+        retry_in = max(status['next_attempt_at'] - time.time(), 0)
+        st.warning(f"Last push failed ({status['last_error']}), retrying in {retry_in:.0f} s")
+    elif status['last_result'] is not None:
+        result = status['last_result']
+        st.caption(f"Last push at {time.strftime('%H:%M:%S', time.localtime(status['last_flush_at']))}: "
+                   f"{result['inserted']} invoice(s) added, {result['duplicates']} already stored, "
+                   f"{result['rejected']} rejected, {result.get('line_items', 0)} line item(s) added")
 #################################################################################################################
 
-# load the lottie animation    
-lottie_cover = load_lottiefile('image/animation.json')
+# load the lottie animation, parsed once per process
+lottie_cover = assets.load_lottiefile('image/animation.json')
 
 st.title(':blue[BCEAD Oligomers Usage Tracker]')
 st.lottie(lottie_cover, speed=1, reverse=False, loop=True, quality='low', height=800, key='first_animate')
-st.sidebar.image('image/BCEAD.png')
+st.sidebar.image(assets.load_image('image/BCEAD.png'))
 st.sidebar.subheader(':blue[Welcome to the BCEAD Oligomers Usage Tracker System]', divider='gray')
 st.sidebar.write('''
 This application is designed to automate data extraction from invoices received from Integrated DNA Technologies for oligomer orders in the BCEAD laboratory. 
@@ -87,41 +91,87 @@ container = st.container(border=True)
 container.markdown('### Data Extracted from Uploaded Invoice(s)')
 
 if uploaded_files is not None:
-    documents = []
-    for uploaded_file in uploaded_files:
-        doc = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-        documents.append(doc)
-
-    df = helper.process_pdf_directory(documents)
-    data = pd.DataFrame(df)
-
-if data.shape[0] >= 1:
-    container.dataframe(data, use_container_width=True)
-    container.download_button(
-    label=':floppy_disk: Download Dataset',
-    data=data.to_csv().encode('utf-8'),
-    file_name=f'Invoice_Record.csv',
-    mime='text/csv')
+    # number of worker processes used to parse the invoices, defaults to every available core
+    pdf_workers = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 1))
+    # zero-copy views of the upload buffers, each document is opened, parsed and closed one at a time
+    documents = [uploaded_file.getbuffer() for uploaded_file in uploaded_files]
+    failed_files = []
+
+    extraction_cache = get_extraction_cache()
+
+    # invoices already in the database are recognised from their first page and neither parsed nor pushed again
+    # a file is screened once, when it is uploaded: the invoice number of every uploaded file is kept for the
+    # session (None when the file is parsed), so the invoices pushed from this page stay in the table afterwards
+    uploaded_ids = {uploaded_file.file_id for uploaded_file in uploaded_files}
+    screened = {file_id: invoice_number for file_id, invoice_number in st.session_state.get('screened', {}).items()
+                if file_id in uploaded_ids}
+    new_files = [index for index, uploaded_file in enumerate(uploaded_files) if uploaded_file.file_id not in screened]
+    if new_files:
+        _, new_skipped = helper.screen_known_invoices([documents[index] for index in new_files], get_known_invoices(),
+                                                      cache=extraction_cache)
+        for position, index in enumerate(new_files):
+            screened[uploaded_files[index].file_id] = new_skipped.get(position)
+    st.session_state['screened'] = screened
+    skipped = {index: screened[uploaded_file.file_id] for index, uploaded_file in enumerate(uploaded_files)
+               if screened[uploaded_file.file_id] is not None}
+    pending = [index for index in range(len(uploaded_files)) if index not in skipped]
+    pending_files = [uploaded_files[index] for index in pending]
+    documents = [documents[index] for index in pending]
+
+    if documents:
+        progress_bar = container.progress(0.0, text='Extracting data from the uploaded invoice(s)...')
+
+    # function to update the progress bar and collect the invoices that failed to parse
+    def update_progress(completed, total, index, error):
+        progress_bar.progress(completed / total, text=f'Extracted {completed} of {total} invoice(s)')
+        if error is not None:
+            failed_files.append(f'{pending_files[index].name}: {error}')
+
+    df = helper.process_pdf_directory(documents, max_workers=pdf_workers, progress_callback=update_progress,
+                                      cache=extraction_cache)
+
+    if documents:
+        progress_bar.empty()
+    for failed_file in failed_files:
+        container.warning(f'Unable to extract data from {failed_file}')
+    if skipped:
+        with container.expander(f':information_source: {len(skipped)} invoice(s) already in the database were skipped'):
+            for index, invoice_number in skipped.items():
+                st.write(f'{uploaded_files[index].name}: invoice {invoice_number}')
+    cache_stats = extraction_cache.stats()
+    st.sidebar.caption(f"Extraction cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                       f"{cache_stats['entries']} invoice(s) stored")
+
+if len(df) >= 1:
+    data = pd.DataFrame(df, columns=helper.INVOICE_FIELDS)
+    # only the visible page is sent to the browser, the export is generated when it is requested
+    tables.paginated_dataframe(container, data, key='extracted')
+    tables.export_buttons(container, data, key='extracted', file_stem='Invoice_Record',
+                          version=tuple(uploaded_file.file_id for uploaded_file in uploaded_files))
+    # one row per oligo, pushed to the database together with the invoices
+    line_items = pd.DataFrame([dict(item, Invoice_Number=record['Invoice_Number'])
+                               for record in df for item in record.get('Line_Items') or []],
+                              columns=storage.LINE_ITEM_HEADER)
+    if line_items.shape[0] >= 1:
+        with container.expander(f':dna: {line_items.shape[0]} line item(s)'):
+            tables.paginated_dataframe(st, line_items, key='line_items')
 else:
     container.write('Upload invoice to extract information')
 
 
-credentials = authenticate_google_sheets_from_secrets()
-spreadsheet_name = 'IDT_Invoice_Record'
-sheet1 = open_sheet(credentials, spreadsheet_name, 'Sheet1')
-df_sheet1 = sheet_to_dataframe(sheet1)
-
-
-if data.shape[0] >= 1:
+if len(df) >= 1:
     button = st.sidebar.button('Push extracted data to the database')
     if button:
-        with st.spinner('Upload data to the database...'):
-            merged_df = pd.concat([df_sheet1, data], axis=0)
-            # update Google Sheet with combined DataFrame
-            update_google_sheet(sheet1, merged_df)
-            st.success('Data successfully updated in the database!')
+        # the invoices are written to the local journal and sent to the database in the background,
+        # those already in the database are left out when they are sent
+        result = get_push_queue().enqueue(df)
+        st.success(f"{result['queued']} invoice(s) queued for the database, "
+                   f"{result['duplicates']} already queued, {result['rejected']} rejected.")
 else:
     pass
 
+with st.sidebar:
+    show_push_status()
 
-
+# performance panel, only shown when PERF_INSTRUMENTATION is set
+perf.render_panel()
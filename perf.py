@@ -0,0 +1,217 @@
+# load the required dependencies
+import functools
+import json
+import os
+import threading
+import time
+
+
+# instrumentation is off unless PERF_INSTRUMENTATION is set, span() and timed() then cost a flag check
+enabled = os.environ.get('PERF_INSTRUMENTATION', '') not in ('', '0', 'false')
+# optional export files, written at the end of every rerun
+JSONL_EXPORT_PATH = os.environ.get('PERF_EXPORT_JSONL')
+PROMETHEUS_EXPORT_PATH = os.environ.get('PERF_EXPORT_PROMETHEUS')
+
+# Streamlit runs every rerun of a session in its own script thread, each thread records its own run
+_local = threading.local()
+# totals across all runs of the process, exported in the Prometheus text format
+_totals = {}
+_counter_totals = {}
+_gauge_values = {}
+_totals_lock = threading.Lock()
+
+
+########################################################################################################
+# spans and counters recorded during one rerun of a page
+class Run:
+    def __init__(self, page):
+        self.page = page
+        self.started_at = time.time()
+        self.spans = []
+        self.counters = {}
+        self.gauges = {}
+
+    # function to summarise the spans by name: number of calls and total seconds
+    def summary(self):
+        summary = {}
+        for name, seconds in self.spans:
+            count, total = summary.get(name, (0, 0.0))
+            summary[name] = (count + 1, total + seconds)
+        return summary
+
+    def to_dict(self):
+        return {
+            'page': self.page,
+            'started_at': self.started_at,
+            'spans': [{'name': name, 'seconds': seconds} for name, seconds in self.spans],
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+        }
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_span(self.name, time.perf_counter() - self.start)
+        return False
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+########################################################################################################
+
+
+########################################################################################################
+# function to start recording a new rerun of a page in the current thread
+def start_run(page):
+    _local.run = Run(page) if enabled else None
+    return _local.run
+
+# function to return the run recorded by the current thread (None when disabled or not started)
+def current_run():
+    return getattr(_local, 'run', None)
+
+# function to time a block of code: `with perf.span('clean_df'): ...`
+def span(name):
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+# decorator timing every call of a function under the given span name
+def timed(name):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# function to wrap a callable so the spans it records in a worker thread go to the run of the calling thread
+def bind(func):
+    run = current_run()
+    if run is None:
+        return func
+    @functools.wraps(func)
+    def bound(*args, **kwargs):
+        _local.run = run
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.run = None
+    return bound
+
+# function to store a finished span in the current run and in the process totals
+def record_span(name, seconds):
+    run = current_run()
+    if run is not None:
+        run.spans.append((name, seconds))
+    with _totals_lock:
+        count, total = _totals.get(name, (0, 0.0))
+        _totals[name] = (count + 1, total + seconds)
+
+# function to increase a counter, e.g. cache hits or rows appended
+def count(name, value=1):
+    if not enabled:
+        return
+    run = current_run()
+    if run is not None:
+        run.counters[name] = run.counters.get(name, 0) + value
+    with _totals_lock:
+        _counter_totals[name] = _counter_totals.get(name, 0) + value
+
+# function to record the current value of a measurement, e.g. the bytes held by the shared dashboard data
+def gauge(name, value):
+    if not enabled:
+        return
+    run = current_run()
+    if run is not None:
+        run.gauges[name] = value
+    with _totals_lock:
+        _gauge_values[name] = value
+########################################################################################################
+
+
+########################################################################################################
+# function to append a run to a JSON lines file
+def export_jsonl(run, path):
+    with open(path, 'a') as f:
+        f.write(json.dumps(run.to_dict()) + '\n')
+
+# function to render the process totals in the Prometheus text exposition format
+def prometheus_text():
+    with _totals_lock:
+        totals = dict(_totals)
+        counters = dict(_counter_totals)
+        gauges = dict(_gauge_values)
+    lines = ['# HELP oligo_span_seconds_total Time spent in each instrumented stage.',
+             '# TYPE oligo_span_seconds_total counter']
+    lines += [f'oligo_span_seconds_total{{span="{name}"}} {total:.6f}' for name, (_, total) in sorted(totals.items())]
+    lines += ['# HELP oligo_span_calls_total Number of calls of each instrumented stage.',
+              '# TYPE oligo_span_calls_total counter']
+    lines += [f'oligo_span_calls_total{{span="{name}"}} {calls}' for name, (calls, _) in sorted(totals.items())]
+    lines += ['# HELP oligo_events_total Instrumentation counters.',
+              '# TYPE oligo_events_total counter']
+    lines += [f'oligo_events_total{{name="{name}"}} {value}' for name, value in sorted(counters.items())]
+    lines += ['# HELP oligo_gauge Last recorded value of each measurement.',
+              '# TYPE oligo_gauge gauge']
+    lines += [f'oligo_gauge{{name="{name}"}} {value}' for name, value in sorted(gauges.items())]
+    return '\n'.join(lines) + '\n'
+
+# function to write the Prometheus text file, replaced atomically so a scraper never reads half a file
+def export_prometheus(path):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+# function to finish the current run and write the configured export files
+def end_run():
+    run = current_run()
+    _local.run = None
+    if run is None:
+        return None
+    if JSONL_EXPORT_PATH:
+        export_jsonl(run, JSONL_EXPORT_PATH)
+    if PROMETHEUS_EXPORT_PATH:
+        export_prometheus(PROMETHEUS_EXPORT_PATH)
+    return run
+
+# function to finish the current run and show it in a collapsible sidebar panel (only when enabled)
+def render_panel():
+    run = end_run()
+    if run is None:
+        return
+    import pandas as pd
+    import streamlit as st
+    with st.sidebar.expander(':stopwatch: Performance (admin)', expanded=False):
+        rows = [{'Stage': name, 'Calls': calls, 'Seconds': round(total, 4)}
+                for name, (calls, total) in sorted(run.summary().items(), key=lambda item: -item[1][1])]
+        st.caption(f'Last rerun of {run.page}, nested stages (e.g. pdf_text inside pdf_parse) are counted in both')
+        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+        for name, value in sorted(run.counters.items()):
+            st.caption(f'{name}: {round(value, 4)}')
+        for name, value in sorted(run.gauges.items()):
+            if name.endswith('_bytes'):
+                st.caption(f"{name[:-len('_bytes')]}: {value / 2**20:.1f} MB")
+            else:
+                st.caption(f'{name}: {value}')
+        st.download_button('Download run (JSON lines)', data=json.dumps(run.to_dict()) + '\n',
+                           file_name='perf_run.jsonl', mime='application/json')
+        st.download_button('Download totals (Prometheus)', data=prometheus_text(),
+                           file_name='perf_metrics.prom', mime='text/plain')
+########################################################################################################
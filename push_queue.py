@@ -0,0 +1,258 @@
+# load the required dependencies
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import perf
+import sheets
+import storage
+from cache import get_data_cache
+
+
+DEFAULT_JOURNAL_PATH = Path(__file__).parent / '.cache' / 'push_journal.sqlite'
+# seconds the worker waits after a push before flushing, the pushes made meanwhile are sent in the same batch
+FLUSH_DELAY = float(os.environ.get('PUSH_FLUSH_DELAY', 1.0))
+# maximum number of invoices sent to the database in one append
+MAX_BATCH = int(os.environ.get('PUSH_MAX_BATCH', 500))
+# a failed flush is tried again after RETRY_BASE_DELAY * 2**failures seconds, capped at RETRY_MAX_DELAY
+RETRY_BASE_DELAY = float(os.environ.get('PUSH_RETRY_BASE_DELAY', 5.0))
+RETRY_MAX_DELAY = float(os.environ.get('PUSH_RETRY_MAX_DELAY', 300.0))
+
+
+# function to decide whether a failed flush is worth retrying: the database could not be reached or was busy
+# (see sheets._is_retryable), any other error means the invoices were refused and sending them again would fail too
+def is_transient(error):
+    return sheets._is_retryable(error) or isinstance(error, (OSError, sqlite3.OperationalError))
+
+
+########################################################################################################
+# write-behind queue of the invoices pushed to the database
+# a push is stored in a local SQLite journal and returns straight away, a worker thread drains the journal
+# to the storage backend in batches, retrying with backoff while the database cannot be reached
+# the journal survives restarts, the invoices left in it are sent when the queue is opened again
+# every invoice is stored once: the journal keeps one entry per Invoice_Number and the backend skips the
+# Invoice_Numbers it already holds, so a batch sent again after a crash does not create duplicates
+# an invoice the database refuses (an error that is not worth retrying, see is_transient) is moved to the
+# dead-letter table, so it does not hold back the invoices queued behind it
+class PushQueue:
+    def __init__(self, path=DEFAULT_JOURNAL_PATH, backend=None, flush_delay=FLUSH_DELAY, max_batch=MAX_BATCH):
+        self.path = Path(path)
+        self.backend = backend
+        self.flush_delay = flush_delay
+        self.max_batch = max_batch
+        self.failures = 0
+        self.last_flush_at = None
+        self.last_result = None
+        self.last_error = None
+        self.next_attempt_at = None
+        self._lock = threading.Lock()
+        # set when invoices were queued or a flush is requested, wakes the worker up
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._worker = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._conn:
+            # the journal is written before a push returns, WAL keeps the writes cheap and durable
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS push_journal (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    Invoice_Number TEXT NOT NULL UNIQUE,
+                    record TEXT NOT NULL,
+                    queued_at REAL NOT NULL
+                )''')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS push_dead_letter (
+                    seq INTEGER PRIMARY KEY,
+                    Invoice_Number TEXT NOT NULL,
+                    record TEXT NOT NULL,
+                    queued_at REAL NOT NULL,
+                    failed_at REAL NOT NULL,
+                    error TEXT NOT NULL
+                )''')
+
+    def _backend(self):
+        return self.backend if self.backend is not None else storage.get_backend()
+
+    # function to start the worker thread, it first sends the invoices left in the journal by a previous run
+    def start(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._stopped.clear()
+                self._worker = threading.Thread(target=self._run, name='push-queue', daemon=True)
+                self._worker.start()
+                self._wakeup.set()
+        return self
+
+    # function to stop the worker thread after its current flush, the queued invoices stay in the journal
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    # function to queue invoices for the database, returns the number queued, already queued and rejected
+    # records: list of dicts keyed by column name, e.g. the output of helper.process_pdf_directory
+    @perf.timed('push_enqueue')
+    def enqueue(self, records):
+        records = list(records)
+        result = {'queued': 0, 'duplicates': 0, 'rejected': 0}
+        rows = []
+        for record in records:
+            invoice_number = '' if record.get('Invoice_Number') is None else str(record['Invoice_Number']).strip()
+            if not invoice_number:
+                result['rejected'] += 1
+                continue
+            rows.append((invoice_number, json.dumps(dict(record, Invoice_Number=invoice_number), default=str),
+                         time.time()))
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany('INSERT OR IGNORE INTO push_journal (Invoice_Number, record, queued_at) '
+                                   'VALUES (?, ?, ?)', rows)
+            result['queued'] = self._conn.total_changes - before
+        result['duplicates'] = len(rows) - result['queued']
+        perf.count('push_queued', result['queued'])
+        self._wakeup.set()
+        return result
+
+    # function to return the number of invoices waiting in the journal
+    def depth(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM push_journal').fetchone()[0]
+
+    # function to return the Invoice_Numbers waiting in the journal
+    def invoice_numbers(self):
+        with self._lock:
+            return {value for (value,) in self._conn.execute('SELECT Invoice_Number FROM push_journal')}
+
+    # function to return the invoices the database refused, newest first: (Invoice_Number, error, failed_at)
+    def dead_letters(self):
+        with self._lock:
+            return self._conn.execute('SELECT Invoice_Number, error, failed_at FROM push_dead_letter '
+                                      'ORDER BY failed_at DESC, seq DESC').fetchall()
+
+    # function to send the oldest queued invoices to the database, returns the backend result (None when empty)
+    # the invoices are only removed from the journal once the backend stored them, a transient error leaves them
+    # queued and is raised; when the batch is refused, its invoices are sent one by one and those refused again
+    # are moved to the dead-letter table
+    def flush(self):
+        with self._lock:
+            entries = self._conn.execute('SELECT seq, Invoice_Number, record, queued_at FROM push_journal '
+                                         'ORDER BY seq LIMIT ?', (self.max_batch,)).fetchall()
+        if not entries:
+            return None
+        try:
+            result = self._send(entries)
+        except Exception as e:
+            if is_transient(e):
+                raise
+            result = {'inserted': 0, 'duplicates': 0, 'rejected': 0, 'line_items': 0}
+            for entry in entries:
+                try:
+                    entry_result = self._send([entry])
+                except Exception as entry_error:
+                    if is_transient(entry_error):
+                        raise
+                    self._dead_letter(entry, entry_error)
+                    continue
+                for key, count in entry_result.items():
+                    result[key] = result.get(key, 0) + count
+        # the sessions read the stored data through the shared data cache, the next rerun reads it again
+        if result.get('inserted') or result.get('line_items'):
+            get_data_cache().invalidate()
+        perf.count('push_flushed', len(entries))
+        return result
+
+    # function to append journal entries to the database and remove them from the journal
+    def _send(self, entries):
+        with perf.span('push_flush'):
+            result = self._backend().append_invoices([json.loads(record) for _, _, record, _ in entries])
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM push_journal WHERE seq = ?', [(seq,) for seq, _, _, _ in entries])
+        return result
+
+    # function to move a journal entry the database refused to the dead-letter table
+    def _dead_letter(self, entry, error):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO push_dead_letter (seq, Invoice_Number, record, queued_at, '
+                               'failed_at, error) VALUES (?, ?, ?, ?, ?, ?)',
+                               (*entry, time.time(), f'{type(error).__name__}: {error}'))
+            self._conn.execute('DELETE FROM push_journal WHERE seq = ?', (entry[0],))
+        perf.count('push_dead_letters')
+
+    # function to drain the journal, waiting between the attempts while the database cannot be reached
+    def _run(self):
+        while not self._stopped.is_set():
+            if self.next_attempt_at is None:
+                self._wakeup.wait()
+            else:
+                self._wakeup.wait(max(self.next_attempt_at - time.time(), 0))
+            if self._stopped.is_set():
+                break
+            self._wakeup.clear()
+            if self.next_attempt_at is not None and time.time() < self.next_attempt_at:
+                # woken up by a new push while backing off, it is sent with the retry
+                continue
+            # let the pushes made right after this one join the batch
+            self._stopped.wait(self.flush_delay)
+            self._drain()
+
+    def _drain(self):
+        try:
+            while not self._stopped.is_set():
+                result = self.flush()
+                if result is None:
+                    break
+                self.last_result = result
+                self.last_flush_at = time.time()
+            self.failures = 0
+            self.last_error = None
+            self.next_attempt_at = None
+        except Exception as e:
+            self.failures += 1
+            self.last_error = f'{type(e).__name__}: {e}'
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (self.failures - 1))
+            self.next_attempt_at = time.time() + delay
+            perf.count('push_flush_failures')
+
+    # function to report the queue depth, the outcome of the last flush and the invoices the database refused
+    def status(self):
+        with self._lock:
+            dead_letters = self._conn.execute('SELECT COUNT(*) FROM push_dead_letter').fetchone()[0]
+        return {'depth': self.depth(), 'last_flush_at': self.last_flush_at, 'last_result': self.last_result,
+                'last_error': self.last_error, 'failures': self.failures, 'next_attempt_at': self.next_attempt_at,
+                'dead_letters': dead_letters}
+########################################################################################################
+
+
+_push_queue = None
+_push_queue_lock = threading.Lock()
+
+# function to return the push queue shared by every page and session of the process, its worker is started
+# on first use so the invoices left in the journal by the previous run are sent
+def get_push_queue():
+    global _push_queue
+    with _push_queue_lock:
+        if _push_queue is None:
+            _push_queue = PushQueue(os.environ.get('PUSH_JOURNAL_PATH', DEFAULT_JOURNAL_PATH)).start()
+        return _push_queue
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send the invoices left in the push journal to the database')
+    parser.add_argument('--path', default=os.environ.get('PUSH_JOURNAL_PATH', DEFAULT_JOURNAL_PATH),
+                        help='push journal file')
+    args = parser.parse_args()
+    queue = PushQueue(args.path)
+    print(f'{queue.depth()} invoice(s) queued')
+    while (result := queue.flush()) is not None:
+        print(f"{result['inserted']} invoice(s) added, {result['duplicates']} already stored, "
+              f"{result['rejected']} rejected")
+    for invoice_number, error, failed_at in queue.dead_letters():
+        print(f"refused by the database at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(failed_at))}: "
+              f"invoice {invoice_number}: {error}")
@@ -0,0 +1,255 @@
+# load the required dependencies
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+import perf
+
+
+DEFAULT_REPLICA_PATH = Path(__file__).parent / '.cache' / 'sheet_replica.sqlite'
+# seconds between two checks of the remote worksheet for new rows
+DEFAULT_SYNC_INTERVAL = 300
+
+
+# function to drop the trailing empty cells, the Sheets API omits them as well
+def _trim_row(row):
+    row = [str(value) for value in row]
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+# function to fingerprint a row, used to detect edits to the rows already replicated
+def row_fingerprint(row):
+    return hashlib.sha1(json.dumps(_trim_row(row)).encode('utf-8')).hexdigest()
+
+
+########################################################################################################
+# local SQLite replica of the worksheets of the IDT_Invoice_Record spreadsheet
+# reads are always served from disk, sync() only downloads the rows appended since the last sync
+# and falls back to the last snapshot (offline mode) when the Sheets API cannot be reached
+class SheetReplica:
+    def __init__(self, path=DEFAULT_REPLICA_PATH, sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.path = Path(path)
+        self.sync_interval = sync_interval
+        # _lock guards the SQLite connection, the network requests of a sync only hold the lock of their sheet
+        self._lock = threading.Lock()
+        self._sync_locks = {}
+        self._offline = set()
+        # optional worksheet -> time it was found missing or could not be downloaded, it is not requested again
+        # before the next sync interval
+        self._unavailable = {}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS sheet_meta (
+                    sheet TEXT PRIMARY KEY,
+                    header TEXT NOT NULL,
+                    row_count INTEGER NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    synced_at REAL NOT NULL,
+                    generation INTEGER NOT NULL DEFAULT 0
+                )''')
+            # replicas created before generations were tracked
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(sheet_meta)')]
+            if 'generation' not in columns:
+                self._conn.execute('ALTER TABLE sheet_meta ADD COLUMN generation INTEGER NOT NULL DEFAULT 0')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS sheet_rows (
+                    sheet TEXT NOT NULL,
+                    row_idx INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (sheet, row_idx)
+                )''')
+
+    # function to read the stored header, row count, fingerprint and sync time of a worksheet
+    def _meta(self, sheet_name):
+        row = self._conn.execute('SELECT header, row_count, fingerprint, synced_at, generation FROM sheet_meta '
+                                 'WHERE sheet = ?', (sheet_name,)).fetchone()
+        if row is None:
+            return None
+        return {'header': json.loads(row[0]), 'row_count': row[1], 'fingerprint': row[2], 'synced_at': row[3],
+                'generation': row[4]}
+
+    # function to store rows starting at data row number `start` (0-based, header excluded)
+    def _store_rows(self, sheet_name, header, rows, start):
+        rows = [_trim_row(row) for row in rows]
+        if start == 0:
+            self._conn.execute('DELETE FROM sheet_rows WHERE sheet = ?', (sheet_name,))
+        self._conn.executemany('INSERT OR REPLACE INTO sheet_rows (sheet, row_idx, data) VALUES (?, ?, ?)',
+                               [(sheet_name, start + i, json.dumps(row)) for i, row in enumerate(rows)])
+        row_count = start + len(rows)
+        last_row = rows[-1] if rows else []
+        # a full reload starts a new generation, appends keep the rows stored so far
+        meta = self._meta(sheet_name)
+        generation = 0 if meta is None else meta['generation'] + (start == 0)
+        self._conn.execute('INSERT OR REPLACE INTO sheet_meta (sheet, header, row_count, fingerprint, synced_at, generation) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           (sheet_name, json.dumps(_trim_row(header)), row_count, row_fingerprint(last_row), time.time(),
+                            generation))
+
+    # True when at least one worksheet is served from its last snapshot because the Sheets API failed
+    @property
+    def offline(self):
+        return bool(self._offline)
+
+    def _sync_lock(self, sheet_name):
+        with self._lock:
+            return self._sync_locks.setdefault(sheet_name, threading.Lock())
+
+    # function to bring the replica of a worksheet up to date
+    # open_worksheet: callable returning the gspread worksheet, only called when the remote sheet is checked
+    # returns 'fresh' (synced less than sync_interval ago), 'unchanged', 'appended', 'reloaded' or 'offline'
+    def sync(self, sheet_name, open_worksheet, force=False):
+        with self._sync_lock(sheet_name):
+            with self._lock:
+                meta = self._meta(sheet_name)
+            if not force and meta is not None and time.time() - meta['synced_at'] < self.sync_interval:
+                return 'fresh'
+            try:
+                with perf.span('sheet_fetch'):
+                    status = self._sync(sheet_name, open_worksheet(), meta)
+            except Exception:
+                if meta is None:
+                    raise
+                # serve the last snapshot while the Sheets API is unavailable
+                self._offline.add(sheet_name)
+                return 'offline'
+            self._offline.discard(sheet_name)
+            with self._lock:
+                self._unavailable.pop(sheet_name, None)
+            perf.count(f'replica_{status}')
+            return status
+
+    def _sync(self, sheet_name, worksheet, meta):
+        # the first column gives the remote row count at the cost of a single column download
+        remote_count = max(len(worksheet.col_values(1)) - 1, 0)
+        if meta is not None and 0 < meta['row_count'] <= remote_count:
+            last_row = worksheet.row_values(meta['row_count'] + 1)
+            if row_fingerprint(last_row) == meta['fingerprint']:
+                if remote_count == meta['row_count']:
+                    with self._lock, self._conn:
+                        self._conn.execute('UPDATE sheet_meta SET synced_at = ? WHERE sheet = ?',
+                                           (time.time(), sheet_name))
+                    return 'unchanged'
+                new_rows = worksheet.get_values(f"{meta['row_count'] + 2}:{remote_count + 1}")
+                with self._lock, self._conn:
+                    self._store_rows(sheet_name, meta['header'], new_rows, meta['row_count'])
+                return 'appended'
+
+        # rows were edited or deleted, download the whole worksheet again
+        values = worksheet.get_all_values()
+        header, rows = (values[0], values[1:]) if values else ([], [])
+        with self._lock, self._conn:
+            self._store_rows(sheet_name, header, rows, 0)
+        return 'reloaded'
+
+    # function to sync several worksheets concurrently, so the page waits for the slowest sheet instead of the sum
+    # open_worksheet: callable taking the sheet name and returning the gspread worksheet (e.g. sheets.open_sheet)
+    # timeout: seconds to wait, a worksheet still syncing after that is served from its last snapshot
+    # optional: worksheets the page can do without, they are reported 'unavailable' instead of raising when they
+    # could not be downloaded and have no snapshot yet, and are not requested again before the next sync interval
+    # returns the status of every worksheet, like sync()
+    def sync_many(self, sheet_names, open_worksheet, force=False, timeout=None, optional=()):
+        statuses = {}
+        with self._lock:
+            for sheet_name in optional:
+                if not force and time.time() - self._unavailable.get(sheet_name, -math.inf) < self.sync_interval:
+                    statuses[sheet_name] = 'unavailable'
+        sheet_names = [sheet_name for sheet_name in sheet_names if sheet_name not in statuses]
+        executor = ThreadPoolExecutor(max_workers=max(len(sheet_names), 1), thread_name_prefix='replica-sync')
+        futures = {executor.submit(perf.bind(self.sync), sheet_name, lambda name=sheet_name: open_worksheet(name),
+                                   force): sheet_name for sheet_name in sheet_names}
+        done, _ = wait(futures, timeout=timeout)
+        # a sync that timed out keeps running in the background and stores its rows when it finishes
+        executor.shutdown(wait=False)
+        for future, sheet_name in futures.items():
+            if future in done:
+                try:
+                    statuses[sheet_name] = future.result()
+                except Exception:
+                    if sheet_name not in optional:
+                        raise
+                    statuses[sheet_name] = self._mark_unavailable(sheet_name)
+            elif sheet_name in optional and self.generation(sheet_name) is None:
+                statuses[sheet_name] = self._mark_unavailable(sheet_name)
+            elif self.generation(sheet_name) is None:
+                raise TimeoutError(f'{sheet_name} could not be downloaded within {timeout} s')
+            else:
+                self._offline.add(sheet_name)
+                statuses[sheet_name] = 'offline'
+        return statuses
+
+    def _mark_unavailable(self, sheet_name):
+        with self._lock:
+            self._unavailable[sheet_name] = time.time()
+        return 'unavailable'
+
+    # function to read a replicated worksheet as a pandas dataframe, typed like gspread's get_all_records
+    # start: first data row to read (0-based), e.g. the number of rows already read by a previous call
+    @perf.timed('replica_read')
+    def read(self, sheet_name, start=0):
+        import pandas as pd
+        from gspread.utils import numericise_all
+        with self._lock:
+            meta = self._meta(sheet_name)
+            if meta is None:
+                raise KeyError(f'{sheet_name} has not been replicated yet')
+            rows = [json.loads(data) for (data,) in self._conn.execute(
+                'SELECT data FROM sheet_rows WHERE sheet = ? AND row_idx >= ? ORDER BY row_idx', (sheet_name, start))]
+        header = meta['header']
+        records = [numericise_all(row + [''] * (len(header) - len(row)), default_blank='')[:len(header)] for row in rows]
+        return pd.DataFrame(records, columns=header)
+
+    # function to read a single column of a replicated worksheet as strings, without decoding the other cells
+    def column(self, sheet_name, column_name):
+        with self._lock:
+            meta = self._meta(sheet_name)
+            if meta is None:
+                raise KeyError(f'{sheet_name} has not been replicated yet')
+            if column_name not in meta['header']:
+                raise KeyError(f'{sheet_name} has no column {column_name}')
+            path = f"$[{meta['header'].index(column_name)}]"
+            return [value if value is not None else '' for (value,) in self._conn.execute(
+                'SELECT json_extract(data, ?) FROM sheet_rows WHERE sheet = ? ORDER BY row_idx', (path, sheet_name))]
+
+    # function to return a version string that changes whenever the replicated rows change
+    def version(self, sheet_name):
+        with self._lock:
+            meta = self._meta(sheet_name)
+        if meta is None:
+            return None
+        return f"{meta['generation']}.{meta['row_count']}:{meta['fingerprint']}"
+
+    # function to return the generation of a worksheet, it only changes when stored rows were replaced,
+    # so rows 0..n-1 read under the same generation are still the first n rows
+    def generation(self, sheet_name):
+        with self._lock:
+            meta = self._meta(sheet_name)
+        return None if meta is None else meta['generation']
+
+    # function to return the time of the last successful sync
+    def synced_at(self, sheet_name):
+        with self._lock:
+            meta = self._meta(sheet_name)
+        return None if meta is None else meta['synced_at']
+########################################################################################################
+
+
+_replica = None
+_replica_lock = threading.Lock()
+
+# function to return the replica shared by every page and session of the process
+def get_replica():
+    global _replica
+    with _replica_lock:
+        if _replica is None:
+            _replica = SheetReplica(os.environ.get('REPLICA_PATH', DEFAULT_REPLICA_PATH),
+                                    int(os.environ.get('REPLICA_SYNC_INTERVAL', DEFAULT_SYNC_INTERVAL)))
+        return _replica
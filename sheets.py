@@ -0,0 +1,309 @@
+# load the required dependencies
+import itertools
+import os
+import random
+import threading
+import time
+
+import perf
+
+
+SPREADSHEET_NAME = 'IDT_Invoice_Record'
+SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+# maximum number of Sheets API requests in flight across all sessions of the process
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('SHEETS_MAX_CONCURRENT_REQUESTS', 4))
+# seconds before a single Sheets API request is abandoned
+REQUEST_TIMEOUT = float(os.environ.get('SHEETS_REQUEST_TIMEOUT', 20))
+# quota errors (HTTP 429), server errors and timeouts are retried with exponential backoff and jitter
+MAX_RETRIES = int(os.environ.get('SHEETS_MAX_RETRIES', 4))
+RETRY_BASE_DELAY = float(os.environ.get('SHEETS_RETRY_BASE_DELAY', 1.0))
+RETRY_MAX_DELAY = 32.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# seconds a page waits for its worksheets before it falls back to the last local snapshot
+LOAD_TIMEOUT = float(os.environ.get('SHEETS_LOAD_TIMEOUT', 30))
+
+_client = None
+_spreadsheets = {}
+_worksheets = {}
+# _client_lock only guards the shared client and the handle dicts, it is never held during a network request
+_client_lock = threading.Lock()
+# one lock per spreadsheet and per worksheet being opened, the other handles can be opened meanwhile
+_open_locks = {}
+# serializes the access token refreshes, separate from _client_lock so a refresh can happen while a handle is opened
+_token_lock = threading.Lock()
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+
+########################################################################################################
+# function to authenticate for connecting to the Google spreadsheet
+def authenticate_google_sheets_from_secrets():
+    import streamlit as st
+    from oauth2client.service_account import ServiceAccountCredentials
+    secrets = st.secrets["gcp_service_account"]
+    credentials = ServiceAccountCredentials.from_json_keyfile_dict(secrets, SCOPE)
+    return credentials
+
+# function to refresh the access token before it is used, a single refresh is shared by all sessions
+def _refresh_token(http):
+    credentials = getattr(http, 'auth', None)
+    if credentials is not None and getattr(credentials, 'expired', False):
+        with _token_lock:
+            if credentials.expired:
+                from google.auth.transport.requests import Request
+                credentials.refresh(Request())
+
+# function to read the HTTP status code of a failed request (gspread 5 and 6 APIError, FakeAPIError)
+def _status_code(error):
+    response = getattr(error, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    return status_code if status_code is not None else getattr(error, 'code', None)
+
+# function to decide whether a failed request is worth sending again
+def _is_retryable(error):
+    if _status_code(error) in RETRY_STATUS_CODES:
+        return True
+    try:
+        from requests.exceptions import ConnectionError, Timeout
+    except ImportError:
+        return False
+    return isinstance(error, (ConnectionError, Timeout))
+
+# function to decide whether a failed request is known not to have been applied by the server, so it can be
+# sent again even when it is not idempotent: quota errors (rejected before any work) and failed connections
+def _failed_before_sending(error):
+    if _status_code(error) == 429:
+        return True
+    try:
+        from requests.exceptions import ConnectionError, ConnectTimeout
+        from urllib3.exceptions import NewConnectionError
+    except ImportError:
+        return False
+    if isinstance(error, ConnectTimeout):
+        return True
+    if isinstance(error, ConnectionError):
+        # requests wraps the urllib3 error in a MaxRetryError, its reason tells whether the connection was made
+        reason = error.args[0] if error.args else None
+        return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+    return False
+
+# function to wait before the next attempt of a request, exponential backoff with jitter
+def _backoff(attempt):
+    time.sleep(min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+# function to send a request through the concurrency cap, retrying quota and server errors
+# idempotent: False for requests that change the spreadsheet (e.g. appending rows), they are only sent again
+# when they failed before reaching the server, a timeout or server error may come after the change was applied
+# the request slot is given back while waiting, so a throttled session does not block the others
+def send_request(request, *args, idempotent=True, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with _request_slots, perf.span('sheets_request'):
+                return request(*args, **kwargs)
+        except Exception as e:
+            retryable = _is_retryable(e) if idempotent else _failed_before_sending(e)
+            if attempt == MAX_RETRIES or not retryable:
+                raise
+        perf.count('sheets_retries')
+        _backoff(attempt)
+
+# HTTP methods sent again after a timeout or server error, the Sheets API writes are POST and PUT requests
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+# function to route every request of the client through the concurrency cap, retries and the token refresh
+def _limit_requests(http):
+    request = http.request
+    def limited_request(*args, **kwargs):
+        method = args[0] if args else kwargs.get('method', 'GET')
+        def refreshed_request():
+            _refresh_token(http)
+            return request(*args, **kwargs)
+        return send_request(refreshed_request, idempotent=str(method).upper() in IDEMPOTENT_METHODS)
+    http.request = limited_request
+
+# function to return the authorized client shared by every page and session of the process
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            import gspread
+            with perf.span('sheets_auth'):
+                client = gspread.authorize(authenticate_google_sheets_from_secrets())
+            if hasattr(client, 'set_timeout'):
+                client.set_timeout(REQUEST_TIMEOUT)
+            # gspread 6 sends the requests through client.http_client, gspread 5 through the client itself
+            _limit_requests(getattr(client, 'http_client', client))
+            _client = client
+        return _client
+
+# function to return the lock serializing the opening of a spreadsheet or worksheet handle
+def _open_lock(key):
+    with _client_lock:
+        return _open_locks.setdefault(key, threading.Lock())
+
+# function to open a spreadsheet, the handle is cached per process
+def _open_spreadsheet(client, spreadsheet_name):
+    with _open_lock((spreadsheet_name,)):
+        with _client_lock:
+            spreadsheet = _spreadsheets.get(spreadsheet_name)
+        if spreadsheet is None:
+            spreadsheet = client.open(spreadsheet_name)
+            with _client_lock:
+                _spreadsheets[spreadsheet_name] = spreadsheet
+        return spreadsheet
+
+# function to open a worksheet, the spreadsheet and worksheet handles are cached per process
+# header: when given, a missing worksheet is created with this header row instead of raising WorksheetNotFound
+def open_sheet(sheet_name, spreadsheet_name=SPREADSHEET_NAME, header=None):
+    import gspread
+    client = get_client()
+    key = (spreadsheet_name, sheet_name)
+    # the requests are sent holding the lock of this worksheet only: they may have to refresh the token
+    # or wait for a request slot, which must not block the other sessions
+    with _open_lock(key):
+        with _client_lock:
+            worksheet = _worksheets.get(key)
+        if worksheet is None:
+            spreadsheet = _open_spreadsheet(client, spreadsheet_name)
+            try:
+                worksheet = spreadsheet.worksheet(sheet_name)
+            except gspread.exceptions.WorksheetNotFound:
+                if header is None:
+                    raise
+                worksheet = spreadsheet.add_worksheet(title=sheet_name, rows=1, cols=len(header))
+                worksheet.append_rows([list(header)], value_input_option='RAW')
+            with _client_lock:
+                _worksheets[key] = worksheet
+        return worksheet
+########################################################################################################
+
+
+########################################################################################################
+# function to append only the invoices that are not stored in the worksheet yet
+# worksheet: gspread worksheet, or any object with the same row_values/col_values/append_rows methods (e.g. FakeWorksheet)
+# records: list of dicts keyed by column name, e.g. the output of helper.process_pdf_directory
+# key: column identifying a row, or tuple of columns (e.g. ('Invoice_Number', 'Item') for the line items)
+# the new rows are sent in a single append call, returns the number of rows inserted, skipped and rejected
+# an append failing with a timeout or server error may still have been applied, the stored keys are then read
+# again and only the rows still missing are sent, so a row is never appended twice
+@perf.timed('sheet_write')
+def append_new_invoices(worksheet, records, key='Invoice_Number'):
+    records = list(records)
+    first = None
+    for attempt in range(MAX_RETRIES + 1):
+        result, rows = _new_rows(worksheet, records, key)
+        if first is None:
+            first = result
+        if not result['inserted']:
+            break
+        try:
+            worksheet.append_rows(rows, value_input_option='RAW')
+        except Exception as e:
+            if attempt == MAX_RETRIES or not _is_retryable(e):
+                raise
+            perf.count('sheets_append_retries')
+            _backoff(attempt)
+            continue
+        perf.count('rows_appended', result['inserted'])
+        break
+    # rows applied by a failed attempt are found stored by the next one, they were still inserted by this call
+    return first
+
+# function to build the rows of the records whose key is not stored yet, returns (result counts, rows to append)
+def _new_rows(worksheet, records, key):
+    result = {'inserted': 0, 'duplicates': 0, 'rejected': 0}
+    rows = []
+    if not records:
+        return result, rows
+
+    header = worksheet.row_values(1)
+    if not header:
+        # empty worksheet, write the header together with the first batch
+        header = list(records[0].keys())
+        rows.append(header)
+    key_columns = (key,) if isinstance(key, str) else tuple(key)
+    stored_values = [[str(value).strip() for value in worksheet.col_values(header.index(column) + 1)[1:]]
+                     for column in key_columns]
+    stored_keys = set(itertools.zip_longest(*stored_values, fillvalue=''))
+
+    for record in records:
+        value = tuple('' if record.get(column) is None else str(record.get(column)).strip() for column in key_columns)
+        if not all(value):
+            result['rejected'] += 1
+        elif value in stored_keys:
+            result['duplicates'] += 1
+        else:
+            stored_keys.add(value)
+            rows.append(['' if record.get(column) is None else record.get(column) for column in header])
+            result['inserted'] += 1
+    return result, rows
+########################################################################################################
+
+
+########################################################################################################
+# error raised by FakeWorksheet, shaped like gspread's APIError (status code on .response)
+class FakeAPIError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f'fake Sheets API error {status_code}')
+        self.response = type('FakeResponse', (), {'status_code': status_code})()
+
+# in-memory stand-in for a gspread worksheet, used to run the database code offline
+# every call is sent like an API request (concurrency cap and retries), latency: seconds added to each request,
+# errors: status codes raised by the next requests, e.g. [429, 429] for two quota errors in a row
+# late_errors: status codes raised by the next writes after they were applied, e.g. [503] for a write the server
+# completed but whose response was lost
+class FakeWorksheet:
+    def __init__(self, rows=None, title='Sheet1', latency=0.0, errors=None, late_errors=None):
+        self.title = title
+        self.rows = [list(row) for row in (rows or [])]
+        self.latency = latency
+        self.errors = list(errors or [])
+        self.late_errors = list(late_errors or [])
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self, respond, idempotent=True):
+        def request():
+            with self._lock:
+                self.requests += 1
+                error = self.errors.pop(0) if self.errors else None
+                late_error = self.late_errors.pop(0) if not idempotent and error is None and self.late_errors else None
+            if self.latency:
+                time.sleep(self.latency)
+            if error is not None:
+                raise FakeAPIError(error)
+            response = respond()
+            if late_error is not None:
+                raise FakeAPIError(late_error)
+            return response
+        return send_request(request, idempotent=idempotent)
+
+    def row_values(self, row):
+        return self._request(lambda: list(self.rows[row - 1]) if row <= len(self.rows) else [])
+
+    def col_values(self, col):
+        return self._request(lambda: [row[col - 1] if col <= len(row) else '' for row in self.rows])
+
+    def get_all_values(self):
+        return self._request(lambda: [list(row) for row in self.rows])
+
+    def get_values(self, range_name):
+        # only whole-row ranges such as '5:9' are supported
+        first, last = (int(bound) for bound in range_name.split(':'))
+        return self._request(lambda: [list(row) for row in self.rows[first - 1:last]])
+
+    def get_all_records(self):
+        def records():
+            if not self.rows:
+                return []
+            header = self.rows[0]
+            return [dict(zip(header, row)) for row in self.rows[1:]]
+        return self._request(records)
+
+    def append_rows(self, values, value_input_option='RAW'):
+        return self._request(lambda: self.rows.extend(list(row) for row in values), idempotent=False)
+
+    def update(self, values, range_name='A1'):
+        def replace():
+            self.rows = [list(row) for row in values]
+        return self._request(replace)
+########################################################################################################
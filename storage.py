@@ -0,0 +1,419 @@
+# load the required dependencies
+import argparse
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import helper
+import perf
+import sheets
+from cache import get_data_cache
+from lazy import lazy_import
+from replica import get_replica
+
+pd = lazy_import('pandas')
+
+
+# storage backend used by the pages and the ingestion command line: 'sheets' (Google Sheets through the local
+# replica) or 'sqlite' (local indexed database)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sheets')
+DEFAULT_SQLITE_PATH = Path(__file__).parent / '.cache' / 'invoices.sqlite'
+
+INVOICE_SHEET = 'Sheet1'
+PO_SHEET = 'Sheet2'
+# one row per oligo, created on the first sync when the spreadsheet does not have it yet
+LINE_ITEM_SHEET = 'Line_Items'
+LINE_ITEM_HEADER = ['Invoice_Number'] + helper.LINE_ITEM_FIELDS
+
+
+# function to split extracted records into their invoice rows and their line item rows (keyed by Invoice_Number)
+def split_line_items(records):
+    invoices, items = [], []
+    for record in records:
+        invoices.append({field: record.get(field) for field in helper.INVOICE_FIELDS})
+        invoice_number = '' if record.get('Invoice_Number') is None else str(record['Invoice_Number']).strip()
+        items += [dict(item, Invoice_Number=invoice_number) for item in record.get('Line_Items') or []]
+    return invoices, items
+
+
+########################################################################################################
+# interface of the storage backends
+# read_invoices() returns the raw invoice rows (the Sheet1 columns, uncleaned), in insertion order
+# read_line_items() returns the raw line item rows (LINE_ITEM_HEADER), in insertion order
+# query_invoices() returns the cleaned invoices matching the filters, see helper.clean_df
+class StorageBackend:
+    name = None
+    # True when query_invoices() runs the filters in the database instead of on a full download
+    supports_queries = False
+    # True when invoices_version() and po_wbs_version() change with every edit of the rows, the data cache then
+    # serves them until their version changes instead of reading them again once its ttl expired
+    version_shows_edits = False
+
+    # function to bring the local data up to date, returns the status of every table (see SheetReplica.sync)
+    def sync(self, force=False):
+        return {}
+
+    # True when the data is served from the last snapshot because the remote database is unavailable
+    @property
+    def offline(self):
+        return False
+
+    def read_invoices(self):
+        raise NotImplementedError
+
+    # function to return the generation of the invoice rows, it only changes when stored rows were replaced
+    def invoices_generation(self):
+        raise NotImplementedError
+
+    # function to return the PO_Number -> WBS_Number map
+    def read_po_wbs(self):
+        raise NotImplementedError
+
+    # function to return a version that changes whenever the PO_Number -> WBS_Number map changed
+    def po_wbs_version(self):
+        raise NotImplementedError
+
+    # function to store the invoices that are not stored yet, returns the number inserted, skipped and rejected
+    # the line items of the records (their 'Line_Items') are stored too, those already stored are skipped, so
+    # a batch sent again stores the line items a previous attempt missed; 'line_items' gives the number inserted
+    def append_invoices(self, records):
+        raise NotImplementedError
+
+    # function to read the line items from row `start` on (0-based), e.g. the rows not read by a previous call
+    def read_line_items(self, start=0):
+        raise NotImplementedError
+
+    # function to return the generation of the line item rows, like invoices_generation
+    def line_items_generation(self):
+        raise NotImplementedError
+
+    # function to return a version that changes whenever invoices were added or replaced
+    def invoices_version(self):
+        raise NotImplementedError
+
+    # function to read the stored Invoice_Numbers
+    def _read_invoice_numbers(self):
+        return self.read_invoices()['Invoice_Number'].tolist()
+
+    # function to return the set of stored Invoice_Numbers (stripped strings), used to skip known invoices before
+    # they are parsed, the set is rebuilt from the store whenever its version changed
+    def invoice_numbers(self):
+        version = self.invoices_version()
+        if version is None:
+            # nothing stored yet
+            return set()
+        known = getattr(self, '_known_invoices', None)
+        if known is None or known[0] != version:
+            with perf.span('invoice_index'):
+                known = (version, {str(value).strip() for value in self._read_invoice_numbers()} - {''})
+            self._known_invoices = known
+        return known[1]
+
+    # name of the backend's entries in the data cache, backends storing different data must not share it
+    @property
+    def cache_key(self):
+        return self.name
+
+    # function to read the invoice rows through the data cache shared by every session of the process,
+    # they are only read again when their version changed, after invalidation or once the cache ttl expired
+    # returns (frame, generation), the generation is read with the rows and, like invoices_generation, only changes
+    # when rows that were already read may have changed: also when the cache read them again under the same version
+    # the frame is shared, it must not be modified by the caller
+    def cached_invoices(self):
+        # the generation is read first, rows replaced in between are then read again under the next version
+        def load():
+            generation = self.invoices_generation()
+            return self.read_invoices(), generation
+        (frame, generation), refreshes = get_data_cache().get_with_refreshes(
+            (self.cache_key, 'invoices'), self.invoices_version(), load, expires=not self.version_shows_edits)
+        return frame, (generation, refreshes)
+
+    # function to read the PO_Number -> WBS_Number map through the data cache, like cached_invoices
+    def cached_po_wbs(self):
+        return get_data_cache().get((self.cache_key, 'po_wbs'), self.po_wbs_version(), self.read_po_wbs,
+                                    expires=not self.version_shows_edits)
+
+    # year: invoice year (int), po_number: PO_Number, start_date/end_date: inclusive invoice date bounds (date)
+    def query_invoices(self, year=None, po_number=None, start_date=None, end_date=None):
+        data = helper.clean_df(self.read_invoices())
+        if year is not None:
+            data = data[data['Invoice_Year'] == year]
+        if po_number is not None:
+            data = data[data['PO_Number'] == str(po_number)]
+        if start_date is not None:
+            data = data[data['Invoice_Date'] >= pd.Timestamp(start_date)]
+        if end_date is not None:
+            data = data[data['Invoice_Date'] <= pd.Timestamp(end_date)]
+        return data
+########################################################################################################
+
+
+########################################################################################################
+# Google Sheets backend, reads are served from the local replica of the spreadsheet
+class SheetsBackend(StorageBackend):
+    name = 'sheets'
+    # the replica versions hold a fingerprint of the rows, updated by every sync
+    version_shows_edits = True
+
+    def __init__(self, replica=None):
+        self.replica = replica if replica is not None else get_replica()
+
+    def sync(self, force=False):
+        # the invoices and POs are shown without line items when the line item worksheet does not exist yet or cannot
+        # be read, it is only created when line items are pushed
+        return self.replica.sync_many([INVOICE_SHEET, PO_SHEET, LINE_ITEM_SHEET], sheets.open_sheet, force=force,
+                                      timeout=sheets.LOAD_TIMEOUT, optional=[LINE_ITEM_SHEET])
+
+    @property
+    def offline(self):
+        return self.replica.offline
+
+    def read_invoices(self):
+        return self.replica.read(INVOICE_SHEET)
+
+    def invoices_generation(self):
+        return self.replica.generation(INVOICE_SHEET)
+
+    def invoices_version(self):
+        return self.replica.version(INVOICE_SHEET)
+
+    def _read_invoice_numbers(self):
+        return self.replica.column(INVOICE_SHEET, 'Invoice_Number')
+
+    def read_po_wbs(self):
+        df_sheet2 = self.replica.read(PO_SHEET)
+        return dict(zip(df_sheet2['PO_Number'], df_sheet2['WBS_Number']))
+
+    def po_wbs_version(self):
+        return self.replica.version(PO_SHEET)
+
+    def read_line_items(self, start=0):
+        if self.replica.generation(LINE_ITEM_SHEET) is None:
+            return pd.DataFrame(columns=LINE_ITEM_HEADER)
+        return self.replica.read(LINE_ITEM_SHEET, start)
+
+    def line_items_generation(self):
+        return self.replica.generation(LINE_ITEM_SHEET)
+
+    def append_invoices(self, records):
+        invoices, items = split_line_items(records)
+        worksheet = sheets.open_sheet(INVOICE_SHEET)
+        result = sheets.append_new_invoices(worksheet, invoices)
+        # refresh the replica straight away, so the new invoices show up without waiting for the next sync
+        if result['inserted']:
+            self.replica.sync(INVOICE_SHEET, lambda: worksheet, force=True)
+        result['line_items'] = 0
+        if items:
+            # the line item worksheet is created with its header when it does not exist yet
+            item_worksheet = sheets.open_sheet(LINE_ITEM_SHEET, header=LINE_ITEM_HEADER)
+            result['line_items'] = sheets.append_new_invoices(item_worksheet, items,
+                                                              key=('Invoice_Number', 'Item'))['inserted']
+            if result['line_items']:
+                self.replica.sync(LINE_ITEM_SHEET, lambda: item_worksheet, force=True)
+        return result
+########################################################################################################
+
+
+########################################################################################################
+# function to convert an invoice date to its ISO form (sortable), None when it cannot be parsed
+def _iso_date(value):
+    try:
+        return datetime.strptime(str(value).strip(), helper.DATE_FORMAT).date().isoformat()
+    except ValueError:
+        return None
+
+# function to convert a stored value to the text kept in the database, like the Sheets API returns it
+def _text(value):
+    return '' if value is None else str(value)
+
+# local SQLite database, the invoices are indexed by Invoice_Number (unique), PO_Number and Invoice_Date,
+# so the queries of the dashboard only read the matching rows
+class SQLiteBackend(StorageBackend):
+    name = 'sqlite'
+    supports_queries = True
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        columns = ', '.join(f"{field} TEXT NOT NULL DEFAULT ''" for field in helper.INVOICE_FIELDS
+                            if field != 'Invoice_Number')
+        with self._conn:
+            # Invoice_Date_ISO holds Invoice_Date as YYYY-MM-DD, NULL when it cannot be parsed
+            self._conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS invoices (
+                    row_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    Invoice_Number TEXT NOT NULL UNIQUE,
+                    {columns},
+                    Invoice_Date_ISO TEXT
+                )''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_invoices_po_number ON invoices (PO_Number)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_invoices_invoice_date ON invoices (Invoice_Date_ISO)')
+            item_columns = ', '.join(f"{field} TEXT NOT NULL DEFAULT ''" for field in helper.LINE_ITEM_FIELDS)
+            self._conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS line_items (
+                    row_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    Invoice_Number TEXT NOT NULL,
+                    {item_columns},
+                    UNIQUE (Invoice_Number, Item)
+                )''')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS po_wbs (
+                    PO_Number TEXT PRIMARY KEY,
+                    WBS_Number TEXT NOT NULL DEFAULT ''
+                )''')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS storage_meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )''')
+            self._conn.execute("INSERT OR IGNORE INTO storage_meta (key, value) VALUES ('generation', 0)")
+
+    # function to read the invoice rows, ordered like they were inserted
+    def _select(self, where='', params=()):
+        fields = ', '.join(helper.INVOICE_FIELDS)
+        with self._lock:
+            rows = self._conn.execute(f'SELECT {fields} FROM invoices {where} ORDER BY row_id', params).fetchall()
+        return pd.DataFrame(rows, columns=helper.INVOICE_FIELDS)
+
+    @perf.timed('storage_read')
+    def read_invoices(self):
+        return self._select()
+
+    def invoices_generation(self):
+        with self._lock:
+            return self._conn.execute("SELECT value FROM storage_meta WHERE key = 'generation'").fetchone()[0]
+
+    def invoices_version(self):
+        with self._lock:
+            return self._conn.execute("SELECT (SELECT value FROM storage_meta WHERE key = 'generation'), "
+                                      "(SELECT MAX(row_id) FROM invoices)").fetchone()
+
+    def _read_invoice_numbers(self):
+        with self._lock:
+            return [value for (value,) in self._conn.execute('SELECT Invoice_Number FROM invoices')]
+
+    def read_po_wbs(self):
+        with self._lock:
+            return dict(self._conn.execute('SELECT PO_Number, WBS_Number FROM po_wbs ORDER BY rowid').fetchall())
+
+    # the map is only written by replace_all, which starts a new generation
+    def po_wbs_version(self):
+        return self.invoices_generation()
+
+    @property
+    def cache_key(self):
+        return f'{self.name}:{self.path}'
+
+    def read_line_items(self, start=0):
+        with self._lock:
+            rows = self._conn.execute(f'SELECT {", ".join(LINE_ITEM_HEADER)} FROM line_items ORDER BY row_id '
+                                      'LIMIT -1 OFFSET ?', (start,)).fetchall()
+        return pd.DataFrame(rows, columns=LINE_ITEM_HEADER)
+
+    # the line items are replaced together with the invoices
+    def line_items_generation(self):
+        return self.invoices_generation()
+
+    # function to insert line item rows, those whose (Invoice_Number, Item) is already stored are skipped
+    def _insert_line_items(self, items):
+        rows = [[_text(item.get(field)).strip() if field in ('Invoice_Number', 'Item') else _text(item.get(field))
+                 for field in LINE_ITEM_HEADER] for item in items]
+        rows = [row for row in rows if row[0] and row[1]]
+        before = self._conn.total_changes
+        self._conn.executemany(f'INSERT OR IGNORE INTO line_items ({", ".join(LINE_ITEM_HEADER)}) '
+                               f'VALUES ({", ".join("?" for _ in LINE_ITEM_HEADER)})', rows)
+        return self._conn.total_changes - before
+
+    # function to insert invoice rows, rows whose Invoice_Number is already stored are skipped
+    def _insert(self, records):
+        placeholders = ', '.join('?' for _ in helper.INVOICE_FIELDS)
+        rows = [[_text(record.get(field)) for field in helper.INVOICE_FIELDS] + [_iso_date(record.get('Invoice_Date'))]
+                for record in records]
+        before = self._conn.total_changes
+        self._conn.executemany(f'INSERT OR IGNORE INTO invoices ({", ".join(helper.INVOICE_FIELDS)}, Invoice_Date_ISO) '
+                               f'VALUES ({placeholders}, ?)', rows)
+        return self._conn.total_changes - before
+
+    @perf.timed('storage_write')
+    def append_invoices(self, records):
+        records, items = split_line_items(records)
+        result = {'inserted': 0, 'duplicates': 0, 'rejected': 0}
+        valid = [dict(record, Invoice_Number=_text(record.get('Invoice_Number')).strip()) for record in records]
+        valid = [record for record in valid if record['Invoice_Number']]
+        result['rejected'] = len(records) - len(valid)
+        with self._lock, self._conn:
+            result['inserted'] = self._insert(valid)
+            result['line_items'] = self._insert_line_items(items)
+        result['duplicates'] = len(valid) - result['inserted']
+        perf.count('rows_appended', result['inserted'])
+        return result
+
+    @perf.timed('storage_query')
+    def query_invoices(self, year=None, po_number=None, start_date=None, end_date=None):
+        conditions, params = [], []
+        if year is not None:
+            conditions.append('Invoice_Date_ISO >= ? AND Invoice_Date_ISO < ?')
+            params += [f'{int(year):04d}-01-01', f'{int(year) + 1:04d}-01-01']
+        if po_number is not None:
+            conditions.append('PO_Number = ?')
+            params.append(str(po_number))
+        if start_date is not None:
+            conditions.append('Invoice_Date_ISO >= ?')
+            params.append(start_date.isoformat())
+        if end_date is not None:
+            conditions.append('Invoice_Date_ISO <= ?')
+            params.append(end_date.isoformat())
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return helper.clean_df(self._select(where, params))
+
+    # function to replace the stored data, e.g. with a copy of the Google spreadsheet
+    # invoices: raw invoice records (dicts keyed by the Sheet1 columns), po_wbs: PO_Number -> WBS_Number map,
+    # line_items: raw line item records (dicts keyed by LINE_ITEM_HEADER)
+    def replace_all(self, invoices, po_wbs, line_items=()):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM invoices')
+            self._conn.execute('DELETE FROM po_wbs')
+            self._conn.execute('DELETE FROM line_items')
+            inserted = self._insert(invoices)
+            self._insert_line_items(line_items)
+            self._conn.executemany('INSERT OR REPLACE INTO po_wbs (PO_Number, WBS_Number) VALUES (?, ?)',
+                                   [(_text(po), _text(wbs)) for po, wbs in po_wbs.items()])
+            # the rows were replaced, derived data keyed on row positions has to be rebuilt
+            self._conn.execute("UPDATE storage_meta SET value = value + 1 WHERE key = 'generation'")
+        return inserted
+########################################################################################################
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+# function to return the storage backend shared by every page and session of the process
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if STORAGE_BACKEND == 'sheets':
+                _backend = SheetsBackend()
+            elif STORAGE_BACKEND == 'sqlite':
+                _backend = SQLiteBackend(os.environ.get('STORAGE_SQLITE_PATH', DEFAULT_SQLITE_PATH))
+            else:
+                raise ValueError(f"unknown STORAGE_BACKEND {STORAGE_BACKEND!r}, expected 'sheets' or 'sqlite'")
+        return _backend
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy the Google spreadsheet into the local SQLite database')
+    parser.add_argument('--path', default=os.environ.get('STORAGE_SQLITE_PATH', DEFAULT_SQLITE_PATH),
+                        help='SQLite database file')
+    args = parser.parse_args()
+    source = SheetsBackend()
+    source.sync(force=True)
+    invoices = source.read_invoices().to_dict('records')
+    po_wbs = source.read_po_wbs()
+    line_items = source.read_line_items().to_dict('records')
+    inserted = SQLiteBackend(args.path).replace_all(invoices, po_wbs, line_items)
+    print(f'{inserted} invoice(s) and {len(po_wbs)} PO(s) copied to {args.path}')
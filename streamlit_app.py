@@ -2,9 +2,8 @@
 import streamlit as st
 from time import sleep
 from navigation import make_sidebar
-import pickle
-from pathlib import Path
 import streamlit_authenticator as stauth
+import assets
 
 make_sidebar()
 
@@ -14,9 +13,8 @@ st.markdown('### Please log in to continue...')
 
 names = ['shih jen', 'Chris Sham']
 usernames = ['jen', 'chrissham']
-file_path = Path(__file__).parent / 'hashed_pw.pkl'
-with file_path.open('rb') as file:
-    hashed_passwords = pickle.load(file)
+# hashed passwords are loaded once per process
+hashed_passwords = assets.load_hashed_passwords('hashed_pw.pkl')
 
 credentials = {
     "usernames":{
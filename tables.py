@@ -0,0 +1,92 @@
+# load the required dependencies
+import importlib.util
+import io
+import math
+import os
+
+import streamlit as st
+
+import perf
+
+
+# number of rows serialized and sent to the browser per page of a table
+PAGE_SIZE = int(os.environ.get('TABLE_PAGE_SIZE', 50))
+# Excel export is offered when one of the pandas Excel writers is installed
+EXCEL_ENGINE = next((engine for engine in ['xlsxwriter', 'openpyxl'] if importlib.util.find_spec(engine)), None)
+
+
+########################################################################################################
+# function to keep the rows containing the filter text (in any column) and sort them, before they are paged
+def filter_and_sort(data, query='', sort_by=None, descending=False):
+    if query:
+        matches = data.astype(str).apply(lambda column: column.str.contains(query, case=False, regex=False))
+        data = data[matches.any(axis=1)]
+    if sort_by is not None:
+        data = data.sort_values(sort_by, ascending=not descending, kind='stable')
+    return data
+
+# function to show a table one page at a time, only the rows of the visible page are serialized
+# key: unique name of the table on the page, prefixes the keys of its widgets
+# returns the filtered and sorted rows
+@perf.timed('table_page')
+def paginated_dataframe(container, data, key, page_size=PAGE_SIZE):
+    filter_col, sort_col, order_col, page_col = container.columns([3, 2, 1, 1])
+    query = filter_col.text_input('Filter', key=f'{key}_filter', placeholder='Search all columns')
+    sort_by = sort_col.selectbox('Sort by', [None] + list(data.columns), key=f'{key}_sort',
+                                 format_func=lambda column: 'Original order' if column is None else column)
+    descending = order_col.toggle('Descending', key=f'{key}_descending')
+    rows = filter_and_sort(data, query, sort_by, descending)
+
+    n_pages = max(math.ceil(rows.shape[0] / page_size), 1)
+    # the page may be out of range when the filter or the data changed since the last rerun
+    page_key = f'{key}_page'
+    if st.session_state.get(page_key, 1) > n_pages:
+        st.session_state[page_key] = n_pages
+    page = page_col.number_input('Page', min_value=1, max_value=n_pages, step=1, key=page_key)
+
+    start = (page - 1) * page_size
+    container.dataframe(rows.iloc[start:start + page_size], use_container_width=True)
+    shown = f'{start + 1}-{min(start + page_size, rows.shape[0])}' if rows.shape[0] else '0'
+    filtered = f' ({data.shape[0]} before filtering)' if rows.shape[0] != data.shape[0] else ''
+    container.caption(f'Rows {shown} of {rows.shape[0]}{filtered}, page {page} of {n_pages}')
+    return rows
+########################################################################################################
+
+
+########################################################################################################
+# function to serialize a table as CSV
+def to_csv_bytes(data):
+    return data.to_csv().encode('utf-8')
+
+# function to serialize a table as an Excel workbook
+def to_excel_bytes(data):
+    buffer = io.BytesIO()
+    data.to_excel(buffer, engine=EXCEL_ENGINE)
+    return buffer.getvalue()
+
+# export formats: label -> (file extension, mime type, serializer)
+EXPORT_FORMATS = {
+    'CSV': ('csv', 'text/csv', to_csv_bytes),
+    'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', to_excel_bytes),
+}
+
+# function to offer the table for download, the file is only generated once the user asks for it
+# version: identifies the content of the table, a prepared file is reused by the reruns until it changes
+# file_stem: name of the downloaded file without its extension
+def export_buttons(container, data, key, version, file_stem):
+    formats = [label for label in EXPORT_FORMATS if label != 'Excel' or EXCEL_ENGINE is not None]
+    # the prepared files of the session, only those of the current version are kept
+    exports_key = f'{key}_exports'
+    exports = {export: payload for export, payload in st.session_state.get(exports_key, {}).items()
+               if export[0] == version}
+    for column, label in zip(container.columns(len(formats)), formats):
+        extension, mime, serialize = EXPORT_FORMATS[label]
+        if (version, label) not in exports:
+            if not column.button(f':page_facing_up: Prepare {label}', key=f'{key}_prepare_{extension}'):
+                continue
+            with perf.span('table_export'):
+                exports[(version, label)] = serialize(data)
+        column.download_button(label=f':floppy_disk: Download {label}', data=exports[(version, label)],
+                               file_name=f'{file_stem}.{extension}', mime=mime, key=f'{key}_download_{extension}')
+    st.session_state[exports_key] = exports
+########################################################################################################
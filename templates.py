@@ -0,0 +1,267 @@
+# load the required dependencies
+import re
+from collections import deque
+from datetime import datetime
+
+
+# field names of the standardized record returned for every invoice, whatever its vendor
+INVOICE_FIELDS = ['Invoice_Number', 'Invoice_Date', 'Order_Total', 'Tax', 'Invoice_Total', 'DO_Number', 'PO_Number',
+                  'Order_Date', 'Sale_Order', 'Delivery_Date']
+# field names of the line items (one per oligo) read from the item table of an invoice
+LINE_ITEM_FIELDS = ['Item', 'Name', 'Scale', 'Sequence', 'Quantity', 'Unit_Price', 'Line_Total']
+# format of the dates in a standardized record, dates printed differently by a vendor are converted to it
+DATE_FORMAT = '%d %b %Y'
+
+
+########################################################################################################
+# vendor layouts, declared as data and compiled once per process by compile_template
+# fingerprint: texts identifying the vendor, a template is used when one of them is on the first page
+# date_format: format of the dates printed on the invoice
+# fields: in priority order, a line containing several anchors is assigned to the field listed first
+#   anchor: text printed before the value
+#   value: 'inline' (after the anchor on the same line, or on the next line when nothing follows it)
+#          or 'offset' (on the line `offset` lines below the anchor, e.g. the cell below a table header)
+#   type: 'text', 'currency' (kept as printed) or 'date' (converted to DATE_FORMAT)
+# line_items: optional item table, read in the same pass as the fields
+#   start: header line printed just before the first item, end: text of the line following the last item
+#   item: pattern of the first line of an item, the other lines of the table (e.g. headers repeated on every
+#         page) are skipped
+#   columns: LINE_ITEM_FIELDS printed on the consecutive lines of an item, 'Description' is split into
+#            Name and Scale by the description pattern
+#   skip: optional pattern of the lines printed inside the table at a page break (page footer, header repeated on
+#         the next page), they are left out even in the middle of an item
+#   patterns: optional pattern of the value of a column, checked as the lines of an item are read: an item with a
+#             value that does not match (e.g. a page footer, a header repeated or a description wrapped inside the
+#             item) is dropped and the reading starts again from its second line
+IDT_TEMPLATE = {
+    'vendor': 'IDT',
+    'fingerprint': ['Integrated DNA Technologies', 'Invoice Nbr:'],
+    'date_format': DATE_FORMAT,
+    'fields': [
+        {'field': 'Invoice_Number', 'anchor': 'Invoice Nbr:', 'value': 'inline', 'type': 'text'},
+        {'field': 'Invoice_Date', 'anchor': 'Invoice Date:', 'value': 'inline', 'type': 'date'},
+        {'field': 'Order_Total', 'anchor': 'Order Total:', 'value': 'inline', 'type': 'currency'},
+        {'field': 'Tax', 'anchor': 'Tax:', 'value': 'inline', 'type': 'currency'},
+        {'field': 'Invoice_Total', 'anchor': 'Invoice Total:', 'value': 'inline', 'type': 'currency'},
+        {'field': 'DO_Number', 'anchor': 'Package Ids:', 'value': 'inline', 'type': 'text'},
+        # order table: six header cells followed by their six values
+        {'field': 'PO_Number', 'anchor': 'P.O. #', 'value': 'offset', 'offset': 6, 'type': 'text'},
+        {'field': 'Order_Date', 'anchor': 'Order Date', 'value': 'offset', 'offset': 6, 'type': 'date'},
+        {'field': 'Sale_Order', 'anchor': 'Sales Order #', 'value': 'offset', 'offset': 6, 'type': 'text'},
+        {'field': 'Delivery_Date', 'anchor': 'Ship Date', 'value': 'offset', 'offset': 6, 'type': 'date'},
+    ],
+    'line_items': {
+        'start': 'Amount',
+        'end': 'Order Total:',
+        'item': r'\d+',
+        'columns': ['Item', 'Description', 'Sequence', 'Quantity', 'Unit_Price', 'Line_Total'],
+        'description': r'(?P<Name>.+?)\s+(?P<Scale>\d+(?:\.\d+)?\s*[nuµ]mole)\b.*',
+        'skip': r'Item|Description|Qty|Unit Price|Amount|Page \d+ of \d+',
+        'patterns': {'Quantity': r'\d+', 'Unit_Price': r'[A-Z]*\$\s?-?[\d,]+(?:\.\d+)?',
+                     'Line_Total': r'[A-Z]*\$\s?-?[\d,]+(?:\.\d+)?'},
+    },
+}
+
+# templates in detection order, the first one is also used when no fingerprint is found on the first page
+TEMPLATES = [IDT_TEMPLATE]
+########################################################################################################
+
+
+########################################################################################################
+# function to pair every line with the `size` lines below it, window[k - 1] is the line k lines below
+# (the window is shorter near the end of the document)
+def iter_window(lines, size):
+    window = deque()
+    for line in lines:
+        window.append(line)
+        if len(window) > size:
+            yield window.popleft(), window
+    while window:
+        yield window.popleft(), window
+
+# function to build the converter of a field type, None when the value is kept as printed
+def _converter(kind, date_format):
+    if kind in ('text', 'currency'):
+        return None
+    if kind == 'date':
+        if date_format == DATE_FORMAT:
+            return None
+        def convert(value):
+            try:
+                return datetime.strptime(value, date_format).strftime(DATE_FORMAT)
+            except ValueError:
+                # left for clean_df to report
+                return value
+        return convert
+    raise ValueError(f'unknown field type {kind!r}')
+
+
+# reader of the item table of a template, fed the lines of the invoice one at a time
+# spec: the line_items of the template, with its patterns compiled
+class LineItemReader:
+    def __init__(self, spec):
+        self.start = spec['start']
+        self.end = spec['end']
+        self.item = spec['item']
+        self.columns = spec['columns']
+        self.description = spec['description']
+        self.skip = spec.get('skip')
+        self.patterns = spec.get('patterns', {})
+        # 'before' the table, 'inside' it or 'done' once its end was read
+        self.state = 'before'
+        self.block = []
+
+    @property
+    def done(self):
+        return self.state == 'done'
+
+    # function to read a stripped line, returns the line item it completes or None
+    def feed(self, line):
+        if self.state == 'before':
+            if line == self.start:
+                self.state = 'inside'
+            return None
+        if self.state == 'done':
+            return None
+        if self.end in line:
+            self.state = 'done'
+            return None
+        if self.skip is not None and self.skip.fullmatch(line):
+            return None
+        item = None
+        lines = [line]
+        while lines:
+            line = lines.pop(0)
+            if not self.block and not self.item.fullmatch(line):
+                continue
+            pattern = self.patterns.get(self.columns[len(self.block)])
+            if pattern is not None and not pattern.fullmatch(line):
+                # the block did not start an item, its other lines may
+                lines, self.block = self.block[1:] + [line] + lines, []
+                continue
+            self.block.append(line)
+            if len(self.block) == len(self.columns):
+                item, self.block = self._standardize(dict(zip(self.columns, self.block))), []
+        return item
+
+    def _standardize(self, item):
+        if 'Description' in item:
+            description = item.pop('Description')
+            match = self.description.fullmatch(description)
+            item['Name'], item['Scale'] = (match['Name'], match['Scale']) if match else (description, '')
+        return {field: item.get(field, '') for field in LINE_ITEM_FIELDS}
+
+# reader of the templates without an item table
+class _NoLineItems:
+    done = True
+
+    def feed(self, line):
+        return None
+
+
+# vendor layout compiled into a single regular expression finding every anchor of a line,
+# the fields are read in one pass over the lines of the invoice
+class CompiledTemplate:
+    def __init__(self, spec):
+        self.vendor = spec['vendor']
+        self.fingerprint = tuple(spec['fingerprint'])
+        fields = spec['fields']
+        unknown = [field['field'] for field in fields if field['field'] not in INVOICE_FIELDS]
+        if unknown:
+            raise ValueError(f"{self.vendor} template declares unknown fields {unknown}")
+        # anchor -> (field, offset (0 for inline values), converter)
+        self.rules = {field['anchor']: (field['field'], field.get('offset', 0) if field['value'] == 'offset' else 0,
+                                        _converter(field.get('type', 'text'), spec.get('date_format', DATE_FORMAT)))
+                      for field in fields}
+        self.priority = {anchor: priority for priority, anchor in enumerate(self.rules)}
+        # the lookahead keeps overlapping matches, e.g. 'Tax:' inside a line holding another anchor
+        self.pattern = re.compile('(?=(' + '|'.join(re.escape(anchor) for anchor in self.rules) + '))')
+        self.window = max([offset for _, offset, _ in self.rules.values()] + [1])
+        self.anchors = {field: anchor for anchor, (field, _, _) in self.rules.items()}
+        self.line_items = spec.get('line_items')
+        if self.line_items is not None:
+            unknown = [column for column in self.line_items.get('patterns', {})
+                       if column not in self.line_items['columns']]
+            if unknown:
+                raise ValueError(f"{self.vendor} template declares patterns of unknown columns {unknown}")
+            self.line_items = dict(self.line_items, item=re.compile(self.line_items['item']),
+                                   description=re.compile(self.line_items['description']),
+                                   skip=re.compile(self.line_items['skip']) if 'skip' in self.line_items else None,
+                                   patterns={column: re.compile(pattern) for column, pattern
+                                             in self.line_items.get('patterns', {}).items()})
+
+    def _line_item_reader(self):
+        return _NoLineItems() if self.line_items is None else LineItemReader(self.line_items)
+
+    # function to tell whether the first page of an invoice was printed by this vendor
+    def matches(self, first_page_text):
+        return any(marker in first_page_text for marker in self.fingerprint)
+
+    # function to read the fields and the line items from the lines of an invoice, returns the standardized record,
+    # its 'Line_Items' holding one dict per item (LINE_ITEM_FIELDS)
+    # the reading stops as soon as every field has a value and the item table was read,
+    # set early_exit=False to always read every line
+    def parse(self, lines, early_exit=True):
+        data = {}
+        items = []
+        reader = self._line_item_reader()
+        # field whose value is printed on the next line
+        pending = None
+        for line, below in iter_window(lines, self.window):
+            line = line.strip()
+            item = reader.feed(line)
+            if item is not None:
+                items.append(item)
+            if pending:
+                data[pending[0]] = self._convert(pending[1], line)
+                pending = None
+            else:
+                matches = self.pattern.findall(line)
+                if matches:
+                    anchor = min(matches, key=self.priority.__getitem__)
+                    field, offset, convert = self.rules[anchor]
+                    if offset:
+                        if offset <= len(below):
+                            data[field] = self._convert(convert, below[offset - 1].strip())
+                    else:
+                        value = line.split(anchor)[1].strip()
+                        if value:
+                            data[field] = self._convert(convert, value)
+                        else:
+                            pending = (field, convert)
+
+            if early_exit and pending is None and len(data) == len(self.rules) and reader.done:
+                break
+        record = {field: data.get(field, '') for field in INVOICE_FIELDS}
+        record['Line_Items'] = items
+        return record
+
+    @staticmethod
+    def _convert(convert, value):
+        return value if convert is None else convert(value)
+
+    # function to read a single inline field from the lines of a page, None when the page does not have it
+    def peek(self, lines, field):
+        anchor = self.anchors[field]
+        _, _, convert = self.rules[anchor]
+        for position, line in enumerate(lines):
+            if anchor in line:
+                value = line.split(anchor)[1].strip()
+                if not value and position + 1 < len(lines):
+                    value = lines[position + 1].strip()
+                return self._convert(convert, value) if value else None
+        return None
+
+# function to compile a vendor layout declared like IDT_TEMPLATE
+def compile_template(spec):
+    return CompiledTemplate(spec)
+
+
+# templates compiled at import, once per process (and once per worker process of the PDF pool)
+COMPILED_TEMPLATES = [compile_template(spec) for spec in TEMPLATES]
+
+# function to pick the template of an invoice from the text of its first page
+def detect_template(first_page_text):
+    return next((template for template in COMPILED_TEMPLATES if template.matches(first_page_text)),
+                COMPILED_TEMPLATES[0])
+########################################################################################################
@@ -0,0 +1,122 @@
+# caches shared by the sessions of the process
+import threading
+import time
+
+import pytest
+
+from cache import DataCache, ExtractionCache, FigureCache, pdf_digest
+
+
+def test_concurrent_misses_share_a_single_load():
+    cache = DataCache()
+    loads = []
+    def load():
+        loads.append(1)
+        time.sleep(0.1)
+        return object()
+    values = []
+    threads = [threading.Thread(target=lambda: values.append(cache.get('invoices', 1, load))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+    assert all(value is values[0] for value in values)
+    assert cache.stats()['waits'] == 9
+
+def test_entry_is_loaded_again_when_its_version_changes():
+    cache = DataCache()
+    assert cache.get('invoices', 1, lambda: 'a') == 'a'
+    assert cache.get('invoices', 1, lambda: 'b') == 'a'
+    assert cache.get_with_refreshes('invoices', 2, lambda: 'c') == ('c', 0)
+
+# a reload of the same version is reported, the data derived from the entry has to be rebuilt
+def test_ttl_expiry_and_invalidation_reload_the_entry():
+    cache = DataCache(ttl=0.05)
+    cache.get('invoices', 1, lambda: 'a')
+    time.sleep(0.06)
+    assert cache.get_with_refreshes('invoices', 1, lambda: 'b') == ('b', 1)
+    cache.invalidate()
+    assert cache.get_with_refreshes('invoices', 1, lambda: 'c') == ('c', 2)
+
+# the refreshes are returned with the value they were counted for
+def test_value_and_refreshes_come_from_the_same_load():
+    cache = DataCache()
+    assert cache.get_with_refreshes('invoices', 1, lambda: 'a') == ('a', 0)
+    cache.invalidate()
+    assert cache.get_with_refreshes('invoices', 1, lambda: 'b') == ('b', 1)
+    assert cache.get_with_refreshes('invoices', 1, lambda: 'c') == ('b', 1)
+
+def test_entry_whose_version_shows_edits_does_not_expire():
+    cache = DataCache(ttl=0.05)
+    cache.get('invoices', 1, lambda: 'a', expires=False)
+    time.sleep(0.06)
+    assert cache.get('invoices', 1, lambda: 'b', expires=False) == 'a'
+    assert cache.get('invoices', 2, lambda: 'c', expires=False) == 'c'
+
+def test_load_started_before_invalidation_is_not_stored():
+    cache = DataCache()
+    started = threading.Event()
+    def slow_load():
+        started.set()
+        time.sleep(0.1)
+        return 'old'
+    thread = threading.Thread(target=lambda: cache.get('invoices', 1, slow_load))
+    thread.start()
+    started.wait()
+    cache.invalidate('invoices')
+    thread.join()
+    assert cache.get('invoices', 1, lambda: 'new') == 'new'
+
+def test_failed_load_is_raised_and_not_stored():
+    cache = DataCache()
+    def fail():
+        raise RuntimeError('database unavailable')
+    with pytest.raises(RuntimeError):
+        cache.get('invoices', 1, fail)
+    assert cache.get('invoices', 1, lambda: 'a') == 'a'
+
+def test_extraction_cache_invoice_number(tmp_path):
+    cache = ExtractionCache(tmp_path / 'extraction.sqlite')
+    cache.put('digest', {'Invoice_Number': ' 123 ', 'Line_Items': []})
+    assert cache.invoice_number('digest') == '123'
+    assert cache.invoice_number('other') is None
+    assert cache.stats()['hits'] == 0 and cache.stats()['misses'] == 0
+
+# a hit only writes the access time once it is older than touch_interval
+def test_extraction_cache_hits_do_not_write(tmp_path):
+    cache = ExtractionCache(tmp_path / 'extraction.sqlite', touch_interval=3600)
+    cache.put('digest', {'Invoice_Number': '1'})
+    changes = cache._conn.total_changes
+    assert cache.lookup('digest') == ({'Invoice_Number': '1'}, None)
+    assert cache.lookup('digest') == ({'Invoice_Number': '1'}, None)
+    assert cache._conn.total_changes == changes
+    assert cache.lookup('other') is None
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'entries': 1}
+
+# a broken file is parsed once, the next batches report its error from the cache
+def test_failed_parse_is_cached(tmp_path, monkeypatch):
+    import helper
+    cache = ExtractionCache(tmp_path / 'extraction.sqlite')
+    parsed = []
+    extract = helper._extract_document
+    def counted_extract(document):
+        parsed.append(1)
+        return extract(document)
+    monkeypatch.setattr(helper, '_extract_document', counted_extract)
+    for _ in range(2):
+        errors = []
+        records = helper.process_pdf_directory([b'not a pdf'], cache=cache,
+                                               progress_callback=lambda done, total, index, error: errors.append(error))
+        assert records == [helper.empty_record()] and errors[0] is not None
+    assert len(parsed) == 1
+    assert cache.lookup(pdf_digest(b'not a pdf', helper.PARSER_VERSION))[1] == errors[0]
+
+def test_figure_cache_drops_older_versions():
+    cache = FigureCache()
+    def draw(year):
+        return [year]
+    first = cache.figure(1, draw, args=(2023,))
+    assert cache.figure(1, draw, args=(2023,)) is first
+    assert cache.figure(2, draw, args=(2023,)) is not first
+    assert cache.stats()['entries'] == 1
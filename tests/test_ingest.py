@@ -0,0 +1,42 @@
+# headless ingestion of a directory of invoices, resumed from its checkpoint
+import io
+import json
+
+import pytest
+
+import benchmark
+import ingest
+import storage
+
+
+class FlakyBackend:
+    def __init__(self, failures):
+        self.failures = failures
+        self.pushed = []
+
+    def append_invoices(self, records):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('database unavailable')
+        self.pushed += [record['Invoice_Number'] for record in records]
+        return {'inserted': len(records), 'duplicates': 0, 'rejected': 0, 'line_items': 0}
+
+
+# a failed push leaves its records out of the output file too, the resumed run writes and pushes each file once
+def test_failed_push_is_not_written_twice(tmp_path, monkeypatch):
+    invoices = tmp_path / 'invoices'
+    invoices.mkdir()
+    for i in range(3):
+        (invoices / f'{i}.pdf').write_bytes(benchmark.make_invoice_pdf(10000000 + i, seed=i, n_items=2)[0])
+    output, checkpoint = tmp_path / 'out.jsonl', tmp_path / 'checkpoint.jsonl'
+    backend = FlakyBackend(failures=1)
+    monkeypatch.setattr(storage, 'get_backend', lambda: backend)
+    def run():
+        return ingest.ingest(str(invoices), str(output), str(checkpoint), push=True, push_batch_size=2,
+                             log=io.StringIO())
+    with pytest.raises(ConnectionError):
+        run()
+    assert run()['files'] == 3
+    written = [json.loads(line)['File'] for line in output.read_text().splitlines()]
+    assert sorted(written) == ['0.pdf', '1.pdf', '2.pdf']
+    assert sorted(backend.pushed) == ['10000000', '10000001', '10000002']
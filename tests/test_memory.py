@@ -0,0 +1,13 @@
+# memory footprint of the cleaned invoices and of the extraction of an upload batch
+import benchmark
+
+
+# the compact dtypes shrink the cleaned frame at 100k rows and every number shown by the dashboard stays the same
+def test_compact_dtypes_shrink_cleaned_frame():
+    assert benchmark.bench_dtypes(n_rows=100000)
+
+# the extraction of a batch does not hold the parsed documents: the memory it takes does not grow with the
+# number of files, in the current process and when the files are sent to a pool of workers (measured in fresh
+# processes)
+def test_extraction_memory_does_not_grow_with_batch():
+    assert benchmark.bench_memory(small=5, large=40)
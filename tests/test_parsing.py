@@ -0,0 +1,81 @@
+# parsing of the invoice PDFs and cleaning of the stored rows, checked against synthetic invoices
+import pandas as pd
+import pymupdf
+import pytest
+
+import benchmark
+import helper
+import templates
+
+
+# the parser must return the record the invoice was rendered from, on one page and spread over several pages
+@pytest.mark.parametrize('seed, n_items', [(0, 3), (1, 10), (2, 40)])
+def test_parser_matches_rendered_invoice(seed, n_items):
+    pdf_bytes, expected = benchmark.make_invoice_pdf(10000000 + seed, seed=seed, n_items=n_items)
+    record = helper.extract_pdf_bytes(pdf_bytes)
+    assert {field: record[field] for field in helper.INVOICE_FIELDS} == expected
+    assert len(record['Line_Items']) == n_items
+    assert [item['Item'] for item in record['Line_Items']] == [str(item) for item in range(1, n_items + 1)]
+    assert all(item['Scale'] == '25 nmole' for item in record['Line_Items'])
+
+# a page break inside the item table (footer, header repeated on the next page) does not shift the items
+def test_page_break_inside_item_table():
+    pdf_bytes, expected = benchmark.make_invoice_pdf(10000003, seed=3, n_items=40, page_footer=True)
+    record = helper.extract_pdf_bytes(pdf_bytes)
+    assert {field: record[field] for field in helper.INVOICE_FIELDS} == expected
+    assert [item['Item'] for item in record['Line_Items']] == [str(item) for item in range(1, 41)]
+    assert all(item['Quantity'] == '1' and item['Line_Total'].startswith('S$ ') for item in record['Line_Items'])
+
+# lines that do not fit the columns of an item (a stray page number, a wrapped description) drop that item only,
+# the reading starts again on the next item
+def test_unexpected_lines_inside_item_table_are_dropped():
+    def item(number):
+        return [str(number), f'Oligo-{number} 25 nmole DNA Oligo', 'ACGT', '1', 'S$ 5.00', 'S$ 5.00']
+    lines = (['Invoice Nbr: 1', 'Amount'] + item(1) + ['7'] + item(2) + item(3)[:2] + ['DNA Oligo'] + item(3)[2:]
+             + item(4) + ['Order Total: S$ 15.00'])
+    record = templates.COMPILED_TEMPLATES[0].parse(lines)
+    assert [(item['Item'], item['Name']) for item in record['Line_Items']] == \
+        [('1', 'Oligo-1'), ('2', 'Oligo-2'), ('4', 'Oligo-4')]
+
+# reading the whole document must not change the fields found by the early exit
+def test_early_exit_matches_full_read():
+    pdf_bytes, _ = benchmark.make_invoice_pdf(10000099, seed=99, n_items=25)
+    assert helper.extract_pdf_bytes(pdf_bytes) == \
+        helper.extract_pdf_data(pymupdf.open(stream=pdf_bytes, filetype='pdf'), early_exit=False)
+
+def test_peek_invoice_number():
+    pdf_bytes, expected = benchmark.make_invoice_pdf(10000007, seed=7)
+    assert helper.peek_invoice_number(pdf_bytes) == expected['Invoice_Number']
+
+# a file that fails to parse yields an empty record at its position, the others are still extracted
+def test_batch_keeps_going_after_a_broken_file():
+    pdf_bytes, expected = benchmark.make_invoice_pdf(10000001, seed=1)
+    errors = []
+    records = helper.process_pdf_directory([b'not a pdf', pdf_bytes],
+                                           progress_callback=lambda done, total, index, error: errors.append(error))
+    assert records[0] == helper.empty_record()
+    assert records[1]['Invoice_Number'] == expected['Invoice_Number']
+    assert errors[0] is not None and errors[1] is None
+
+# the schema-driven clean_df gives the values of the element-wise version it replaced
+def test_clean_df_matches_legacy_version():
+    frame = benchmark.make_invoice_frame(500)
+    legacy = benchmark.legacy_clean_df(frame.copy())
+    pd.testing.assert_frame_equal(legacy, helper.clean_df(frame).astype(legacy.dtypes.to_dict()))
+
+def test_clean_df_reports_unparseable_values():
+    frame = benchmark.make_invoice_frame(20)
+    frame.loc[3, 'Invoice_Date'] = 'not a date'
+    frame.loc[5, 'Order_Total'] = 'S$ ???'
+    cleaned, report = helper.clean_df_with_report(frame)
+    assert cleaned.shape[0] == 18
+    assert sorted(report['Column']) == ['Invoice_Date', 'Order_Total']
+
+# modifications are not bases, lower case sequences are read in upper case, lengths are taken as printed
+def test_clean_line_items_counts_bases():
+    raw = pd.DataFrame({'Invoice_Number': ['1'] * 5, 'Scale': ['25 nmole'] * 5,
+                        'Sequence': ['ACGT', 'acgtn', '/5Phos/ACGTT', '25 bases', '40'],
+                        'Quantity': ['1', '2', '1', '1', ''], 'Line_Total': ['S$ 1.00'] * 5})
+    items = helper.clean_line_items(raw)
+    assert items['Bases'].tolist() == [4, 5, 5, 25, 40]
+    assert items['Quantity'].tolist() == [1, 2, 1, 1, 1]
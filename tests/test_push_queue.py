@@ -0,0 +1,44 @@
+# write-behind queue of the pushed invoices, flushed to an in-memory backend
+import pytest
+
+from push_queue import PushQueue
+
+
+class RefusingBackend:
+    def __init__(self, refused=(), unreachable=False):
+        self.refused = set(refused)
+        self.unreachable = unreachable
+        self.stored = []
+
+    def append_invoices(self, records):
+        if self.unreachable:
+            raise ConnectionError('database unavailable')
+        if any(record['Invoice_Number'] in self.refused for record in records):
+            raise ValueError('invalid payload')
+        self.stored += [record['Invoice_Number'] for record in records]
+        return {'inserted': len(records), 'duplicates': 0, 'rejected': 0, 'line_items': 0}
+
+def records(*invoice_numbers):
+    return [{'Invoice_Number': number} for number in invoice_numbers]
+
+
+# an invoice the database refuses is moved to the dead-letter table, the invoices queued with it are still stored
+def test_refused_invoice_does_not_block_the_queue(tmp_path):
+    backend = RefusingBackend(refused={'2'})
+    queue = PushQueue(tmp_path / 'journal.sqlite', backend=backend)
+    queue.enqueue(records('1', '2', '3'))
+    assert queue.flush()['inserted'] == 2
+    assert backend.stored == ['1', '3']
+    assert [(number, error) for number, error, _ in queue.dead_letters()] == [('2', 'ValueError: invalid payload')]
+    assert queue.status()['depth'] == 0 and queue.status()['dead_letters'] == 1
+
+# a database that cannot be reached leaves the invoices queued for the next attempt
+def test_unreachable_database_keeps_the_invoices_queued(tmp_path):
+    backend = RefusingBackend(unreachable=True)
+    queue = PushQueue(tmp_path / 'journal.sqlite', backend=backend)
+    queue.enqueue(records('1', '2'))
+    with pytest.raises(ConnectionError):
+        queue.flush()
+    assert queue.depth() == 2 and queue.dead_letters() == []
+    backend.unreachable = False
+    assert queue.flush()['inserted'] == 2
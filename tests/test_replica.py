@@ -0,0 +1,27 @@
+# local replica of the worksheets, synced from the in-memory FakeWorksheet
+import sheets
+from replica import SheetReplica
+
+HEADER = ['Invoice_Number', 'Order_Total']
+
+
+# an optional worksheet that does not exist is reported unavailable and not requested again before the next sync
+# interval, it is synced as soon as it is written
+def test_missing_optional_worksheet_is_not_requested_on_every_sync(tmp_path):
+    worksheets = {'Sheet1': sheets.FakeWorksheet([HEADER, ['1', 'S$ 1.00']])}
+    opened = []
+    def open_worksheet(sheet_name):
+        opened.append(sheet_name)
+        if sheet_name not in worksheets:
+            raise KeyError(sheet_name)
+        return worksheets[sheet_name]
+    replica = SheetReplica(tmp_path / 'replica.sqlite', sync_interval=0)
+    assert replica.sync_many(['Sheet1', 'Line_Items'], open_worksheet, optional=['Line_Items']) == \
+        {'Sheet1': 'reloaded', 'Line_Items': 'unavailable'}
+    replica.sync_interval = 300
+    statuses = replica.sync_many(['Sheet1', 'Line_Items'], open_worksheet, optional=['Line_Items'])
+    assert statuses == {'Sheet1': 'fresh', 'Line_Items': 'unavailable'}
+    assert opened.count('Line_Items') == 1
+    worksheets['Line_Items'] = sheets.FakeWorksheet([['Invoice_Number', 'Item'], ['1', '1']], title='Line_Items')
+    assert replica.sync('Line_Items', lambda: worksheets['Line_Items'], force=True) == 'reloaded'
+    assert replica.sync_many(['Sheet1', 'Line_Items'], open_worksheet, optional=['Line_Items'])['Line_Items'] == 'fresh'
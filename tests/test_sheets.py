@@ -0,0 +1,57 @@
+# appends to the worksheets and retries of the Sheets API requests, against the in-memory FakeWorksheet
+import pytest
+
+import sheets
+
+HEADER = ['Invoice_Number', 'Order_Total']
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(sheets, 'RETRY_BASE_DELAY', 0.001)
+
+def records(*invoice_numbers):
+    return [{'Invoice_Number': number, 'Order_Total': f'S$ {i}.00'} for i, number in enumerate(invoice_numbers)]
+
+
+def test_append_skips_stored_and_rejects_blank_keys():
+    worksheet = sheets.FakeWorksheet([HEADER, ['1', 'S$ 1.00']])
+    result = sheets.append_new_invoices(worksheet, records('1', ' ', '2', '2', '3'))
+    assert result == {'inserted': 2, 'duplicates': 2, 'rejected': 1}
+    assert [row[0] for row in worksheet.rows] == ['Invoice_Number', '1', '2', '3']
+
+def test_append_writes_header_to_empty_worksheet():
+    worksheet = sheets.FakeWorksheet()
+    assert sheets.append_new_invoices(worksheet, records('1'))['inserted'] == 1
+    assert worksheet.rows == [HEADER, ['1', 'S$ 0.00']]
+
+def test_append_with_composite_key():
+    worksheet = sheets.FakeWorksheet([['Invoice_Number', 'Item'], ['1', '1']])
+    items = [{'Invoice_Number': '1', 'Item': '1'}, {'Invoice_Number': '1', 'Item': '2'},
+             {'Invoice_Number': '2', 'Item': '1'}]
+    result = sheets.append_new_invoices(worksheet, items, key=('Invoice_Number', 'Item'))
+    assert result == {'inserted': 2, 'duplicates': 1, 'rejected': 0}
+
+# quota errors are retried, the request slots are given back
+def test_reads_retry_quota_errors():
+    worksheet = sheets.FakeWorksheet([HEADER], errors=[429, 503])
+    assert worksheet.row_values(1) == HEADER
+    assert worksheet.requests == 3
+
+# an append whose response was lost after the server stored the rows is not sent again as is
+def test_append_applied_before_error_is_not_duplicated():
+    worksheet = sheets.FakeWorksheet([HEADER], late_errors=[503])
+    result = sheets.append_new_invoices(worksheet, records('1', '2'))
+    assert result['inserted'] == 2
+    assert [row[0] for row in worksheet.rows] == ['Invoice_Number', '1', '2']
+
+def test_write_is_not_resent_after_server_error():
+    worksheet = sheets.FakeWorksheet([HEADER], errors=[503])
+    with pytest.raises(sheets.FakeAPIError):
+        worksheet.append_rows([['1', 'S$ 1.00']])
+    assert worksheet.requests == 1 and len(worksheet.rows) == 1
+
+def test_write_is_resent_after_quota_error():
+    worksheet = sheets.FakeWorksheet([HEADER], errors=[429])
+    worksheet.append_rows([['1', 'S$ 1.00']])
+    assert worksheet.rows == [HEADER, ['1', 'S$ 1.00']]
@@ -0,0 +1,61 @@
+# prefix-sum time index of the dashboard, checked against the aggregate cube and plain pandas filters
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+import helper
+
+
+@pytest.fixture(scope='module')
+def state():
+    df_sheet1 = benchmark.make_invoice_frame(3000)
+    df_items = benchmark.make_line_item_frame(df_sheet1)
+    state = helper.sync_dashboard_data({}, df_sheet1, 0)
+    helper.sync_line_item_data(state, lambda start: df_items.iloc[start:], 0)
+    return state
+
+# a whole calendar year gives the metrics of the cube
+def test_range_metrics_match_year_metrics(state):
+    for year in helper.cube_years(state['cube']):
+        assert helper.range_key_metrics(state['time_index'], f'{year}-01-01', f'{year}-12-31',
+                                        state['item_time_index']) == \
+            helper.display_key_metrics(year, state['cube'], state['item_cube'])
+    assert helper.range_key_metrics(state['time_index'], item_time_index=state['item_time_index']) == \
+        helper.display_key_metrics('All Years', state['cube'], state['item_cube'])
+
+def test_range_sums_match_pandas_filter(state):
+    periods = state['periods']
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        start, end = sorted(pd.Timestamp('2020-10-01') + pd.to_timedelta(rng.integers(0, 1700, 2), unit='D'))
+        selected = periods[(periods['Invoice_Date'] >= start) & (periods['Invoice_Date'] <= end)]
+        sums = helper.time_index_sums(state['time_index'], start.date(), end.date())
+        assert sums['Orders'] == selected.shape[0]
+        assert sums['Invoice_Total'] == pytest.approx(selected['Invoice_Total'].sum())
+        assert sums['Delivery_Leadtime'] == pytest.approx(selected['Delivery_Leadtime'].sum())
+
+def test_empty_range_has_no_averages(state):
+    assert helper.range_key_metrics(state['time_index'], '2030-01-01', '2030-12-31') == [0.0, 0.0, 0, 0.0, 0.0, 0]
+
+def test_rolling_spend_and_burn_rate(state):
+    periods = state['periods']
+    end = pd.Timestamp('2023-06-30')
+    selected = periods[(periods['Invoice_Date'] >= '2022-07-01') & (periods['Invoice_Date'] <= end)]
+    assert helper.rolling_spend(state['time_index'], end.date())['Invoice_Total'] == \
+        pytest.approx(selected['Invoice_Total'].sum(), abs=0.01)
+    entry = next(iter(state['po_index'].values()))
+    last = entry['rows']['Invoice_Date'].max()
+    rows = entry['rows'][entry['rows']['Invoice_Date'] > last - pd.DateOffset(months=12)]
+    assert helper.po_burn_rate(entry) == pytest.approx(rows['Invoice_Total'].sum() / 12, abs=0.01)
+
+def test_year_list_follows_the_data(state):
+    assert helper.cube_years(state['cube']) == sorted(state['periods']['Invoice_Year'].unique().tolist())
+
+# one colour per year, whatever the number of years
+def test_bar_colors_follow_the_years(state):
+    years = helper.cube_years(state['cube'])
+    assert len(years) > 4
+    colors = helper.plot_bar(state['cube']).data[0].marker.color
+    assert len(colors) == len(years) and len(set(colors)) == len(years)
+    assert len(helper.bar_colors(1)) == 1 and helper.bar_colors(0) == []